@@ -0,0 +1,527 @@
+# -*- coding: utf-8 -*-
+"""
+    Benchmarks de las funciones de procesamiento con datos sintéticos con el
+    formato de los archivos del CNPV 2018 (columnas y tipos de CNPV_SCHEMA).
+
+    synthetic_department genera los archivos MGN, VIV y PER de un departamento,
+    desde un municipio pequeño hasta un departamento del tamaño de Bogotá, y
+    bench_stages mide el tiempo y la memoria de cada etapa (lectura, filtros,
+    personas, moda, resultados, tipologías y agregación). Los resultados se
+    guardan en un reporte JSON para comparar ejecuciones.
+
+    Uso desde la consola:
+        python benchmark.py --viviendas 1000000
+        python benchmark.py --prueba etapas --tamano departamento --reporte bench.json
+
+"""
+
+import argparse
+import json
+import os
+import platform
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+from functools import reduce
+import cnpv_io
+import procesamiento_datos as pdat
+import pros_taxonomy as tax
+import municipios as mun
+import utilities as ut
+
+MAPPING_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'files', 'Esquema_clasificacion.xlsx')
+
+# Number of dwellings and municipalities of the synthetic departments
+SIZES = {'municipio': (5 * 10**3, 1),
+         'departamento': (6 * 10**5, 40),
+         'bogota': (27 * 10**5, 1)}
+
+# Approximate shares of the codes in the VIV file of the CNPV 2018
+VIV_CODES = {'UVA_USO_UNIDAD': ([1, 2, 3], [0.86, 0.04, 0.10]),
+             'V_TIPO_VIV': ([1, 2, 3, 4, 5, 6], [0.60, 0.33, 0.05, 0.01, 0.005, 0.005]),
+             'V_MAT_PARED': ([1, 2, 3, 4, 5, 6, 7, 8, 9], [0.75, 0.03, 0.02, 0.01, 0.07, 0.09, 0.01, 0.01, 0.01]),
+             'V_MAT_PISO': ([1, 2, 3, 4, 5, 6], [0.02, 0.55, 0.005, 0.295, 0.06, 0.07]),
+             'VA1_ESTRATO': ([0, 1, 2, 3, 4, 5, 6, 9], [0.05, 0.25, 0.30, 0.22, 0.08, 0.03, 0.02, 0.05])}
+
+#%% Datos sintéticos
+def synthetic_households(rng, n_viv):
+    """
+    Households and persons of n_viv dwellings. Each dwelling has 1 to 3 households and
+    each household 1 or more persons.
+
+    Returns
+    -------
+    viv : numpy array
+        Dwelling (0 to n_viv - 1) of each person.
+    hog_nro : numpy array
+        Number of the household of each person in its dwelling.
+    per_nro : numpy array
+        Number of each person in its household.
+
+    """
+    nhog = 1 + rng.binomial(2, 0.05, n_viv)
+    hog_viv = np.repeat(np.arange(n_viv), nhog)
+    hog_nro = np.arange(len(hog_viv)) - np.repeat(np.cumsum(nhog) - nhog, nhog) + 1
+
+    nper = 1 + rng.poisson(2.2, len(hog_viv))
+    per_hog = np.repeat(np.arange(len(hog_viv)), nper)
+    per_nro = np.arange(len(per_hog)) - np.repeat(np.cumsum(nper) - nper, nper) + 1
+
+    return hog_viv[per_hog], hog_nro[per_hog], per_nro
+
+
+def synthetic_per(n_viv=10**5, n_mpios=10, seed=0):
+    """
+    Synthetic PER data. Each dwelling has 1 to 3 households and each household 1 or more
+    persons with random sex and age group.
+
+    Parameters
+    ----------
+    n_viv : int, optional
+        Number of dwellings. The default is 10**5.
+    n_mpios : int, optional
+        Number of municipalities. The default is 10.
+    seed : int, optional
+        Seed of the random generator. The default is 0.
+
+    Returns
+    -------
+    per : pandas DataFrame
+        PER data with the columns and dtypes of CNPV_SCHEMA['PER'].
+
+    """
+    rng = np.random.RandomState(seed)
+
+    # Households by dwelling and persons by household
+    viv, hog_nro, per_nro = synthetic_households(rng, n_viv)
+
+    mpio = np.sort(rng.randint(1, n_mpios + 1, n_viv))
+    clase = rng.randint(1, 4, n_viv)
+
+    per = pd.DataFrame({'U_MPIO': mpio[viv],
+                        'UA_CLASE': clase[viv],
+                        'COD_ENCUESTAS': viv + 1,
+                        'P_NROHOG': hog_nro,
+                        'P_NRO_PER': per_nro,
+                        'P_SEXO': rng.randint(1, 3, len(viv)),
+                        'P_EDADR': rng.randint(1, 22, len(viv))})
+
+    return per.astype(cnpv_io.CNPV_SCHEMA['PER'])
+
+
+def group_sizes(rng, total, mean):
+    """
+    Random sizes (1 or more, geometric with the given mean) of groups that add up to total.
+    """
+    sizes = rng.geometric(1 / mean, total)
+    ngroups = np.searchsorted(np.cumsum(sizes), total) + 1
+    sizes = sizes[:ngroups]
+    sizes[-1] -= sizes.sum() - total
+
+    return sizes
+
+
+def synthetic_department(n_viv=10**5, n_mpios=10, dptocod='68', seed=0):
+    """
+    Synthetic MGN, VIV and PER data of a department with the columns of the CNPV files.
+    The dwellings are grouped in buildings and the buildings in blocks, every block
+    belongs to one municipality of the department (the first ones are larger) and one
+    CLASE. The codes of VIV follow the shares of VIV_CODES and the materials, TIPO_VIV
+    and ESTRATO of some dwellings are missing, as in the DANE files.
+
+    Parameters
+    ----------
+    n_viv : int, optional
+        Number of dwellings. The default is 10**5.
+    n_mpios : int, optional
+        Number of municipalities, the first ones of the department in mpios_list.csv.
+        The default is 10.
+    dptocod : str, optional
+        Code of the department. The default is '68'.
+    seed : int, optional
+        Seed of the random generator. The default is 0.
+
+    Returns
+    -------
+    mgn : pandas DataFrame
+        MGN data.
+    viv : pandas DataFrame
+        VIV data.
+    per : pandas DataFrame
+        PER data.
+
+    """
+    rng = np.random.RandomState(seed)
+    dpto = int(dptocod)
+    mpios = np.array([mpio.u_mpio for mpio in mun.load_registry().department(dptocod)][:n_mpios])
+
+    if not len(mpios):
+        raise ValueError('El departamento {} no tiene municipios'.format(dptocod))
+
+    #%% Dwellings by building and buildings by block
+
+    viv_edif = group_sizes(rng, n_viv, 1.8)
+    edif = np.repeat(np.arange(len(viv_edif)), viv_edif)
+    u_vivienda = np.arange(n_viv) - np.repeat(np.cumsum(viv_edif) - viv_edif, viv_edif) + 1
+
+    edif_mza = group_sizes(rng, len(viv_edif), 12)
+    mza = np.repeat(np.arange(len(edif_mza)), edif_mza)
+    u_edifica = np.arange(len(viv_edif)) - np.repeat(np.cumsum(edif_mza) - edif_mza, edif_mza) + 1
+
+    # Municipality and CLASE of each block
+    weights = 1 / np.arange(1, len(mpios) + 1)
+    mza_mpio = np.sort(rng.choice(len(mpios), len(edif_mza), p=weights / weights.sum()))
+    mza_clase = rng.choice([1, 2, 3], len(edif_mza), p=[0.75, 0.08, 0.17])
+
+    # Number of the block in its municipality
+    first = np.searchsorted(mza_mpio, mza_mpio)
+    k = np.arange(len(edif_mza)) - first
+    urb = mza_clase == 1
+
+    mzas = pd.DataFrame({'U_MPIO': mpios[mza_mpio],
+                         'UA_CLASE': mza_clase,
+                         'U_SECT_RUR': np.where(urb, 0, k // 100 + 1),
+                         'U_SECC_RUR': np.where(urb, 0, (k // 10) % 10 + 1),
+                         'UA2_CPOB': np.where(mza_clase == 2, k % 20 + 1, 0),
+                         'U_SECT_URB': np.where(urb, k // 100 + 1, 0),
+                         'U_SECC_URB': np.where(urb, (k // 10) % 10 + 1, 0),
+                         'U_MZA': np.where(mza_clase == 3, 0, k % 10 + 1)})
+
+    #%% MGN
+
+    viv_mza = mza[edif]
+    mgn = mzas.iloc[viv_mza].reset_index(drop=True)
+    mgn.insert(0, 'TIPO_REG', 1)
+    mgn.insert(1, 'U_DPTO', dpto)
+    mgn['U_EDIFICA'] = u_edifica[edif]
+    mgn['COD_ENCUESTAS'] = np.arange(1, n_viv + 1)
+    mgn['U_VIVIENDA'] = u_vivienda
+    mgn['COD_DANE_ANM'] = (mgn['U_MPIO'].add(dpto * 1000).map('{:05d}'.format) + mgn['UA_CLASE'].astype(str)
+                           + pd.Series(viv_mza + 1).map('{:08d}'.format) + mgn['U_EDIFICA'].map('{:05d}'.format))
+
+    #%% VIV
+
+    codes = {col: rng.choice(values, n_viv, p=p) for col, (values, p) in VIV_CODES.items()}
+
+    # Buildings with many dwellings are mostly apartments
+    apto = (viv_edif[edif] > 2) & (rng.random_sample(n_viv) < 0.85)
+    codes['V_TIPO_VIV'] = np.where(apto, 2, codes['V_TIPO_VIV'])
+
+    residential = codes['UVA_USO_UNIDAD'] != 3
+    occupied = residential & (rng.random_sample(n_viv) < 0.9)
+
+    viv = mgn[['TIPO_REG', 'U_DPTO', 'U_MPIO', 'UA_CLASE', 'COD_ENCUESTAS', 'U_VIVIENDA']].assign(TIPO_REG=2)
+    viv['UVA_USO_UNIDAD'] = codes['UVA_USO_UNIDAD']
+    viv['V_CON_OCUP'] = np.where(occupied, 1, 2)
+    for col in ['V_TIPO_VIV', 'V_MAT_PARED', 'V_MAT_PISO', 'VA1_ESTRATO']:
+        viv[col] = pd.array(codes[col], dtype='Int8')
+
+    # Missing values: non residential units, unoccupied dwellings and rural ESTRATO
+    viv.loc[~residential, 'V_TIPO_VIV'] = pd.NA
+    viv.loc[~occupied, ['V_MAT_PARED', 'V_MAT_PISO', 'VA1_ESTRATO']] = pd.NA
+    viv.loc[viv['UA_CLASE'].to_numpy() == 3, 'VA1_ESTRATO'] = pd.NA
+
+    #%% PER
+
+    residents = np.flatnonzero(occupied)
+    per_viv, hog_nro, per_nro = synthetic_households(rng, len(residents))
+    per_viv = residents[per_viv]
+
+    per = mgn.loc[per_viv, ['TIPO_REG', 'U_DPTO', 'U_MPIO', 'UA_CLASE', 'COD_ENCUESTAS', 'U_VIVIENDA']].reset_index(drop=True).assign(TIPO_REG=5)
+    per['P_NROHOG'] = pd.array(hog_nro, dtype='Int8')
+    per['P_NRO_PER'] = per_nro
+    per['P_SEXO'] = rng.randint(1, 3, len(per))
+    per['P_EDADR'] = rng.randint(1, 22, len(per))
+    per.loc[rng.random_sample(len(per)) < 0.01, 'P_NROHOG'] = pd.NA
+
+    return mgn, viv, per
+
+
+def write_synthetic(folder_path, dptocod='68', depto='Sintetico', n_viv=10**5, n_mpios=10, seed=0):
+    """
+    Write the synthetic MGN, VIV and PER CSV files of a department (see synthetic_department)
+    in the folder structure read by procesamiento_datos.read_files.
+
+    Returns
+    -------
+    filepath : string (path)
+        Folder of the department, folder_path/<dptocod><depto>.
+
+    """
+    filepath = os.path.join(folder_path, str(dptocod) + depto)
+    os.makedirs(filepath, exist_ok=True)
+
+    mgn, viv, per = synthetic_department(n_viv, n_mpios, dptocod, seed)
+
+    for df, name in [(mgn, "CNPV2018_MGN_A2_{}.CSV"), (viv, "CNPV2018_1VIV_A2_{}.CSV"), (per, "CNPV2018_5PER_A2_{}.CSV")]:
+        df.to_csv(os.path.join(filepath, name.format(dptocod)), index=False)
+
+    print('Datos sintéticos en {}: {} viviendas, {} personas'.format(filepath, len(viv), len(per)))
+
+    return filepath
+
+
+#%% Implementaciones de referencia
+def organize_personas_groupby(perestudio, by=None):
+    """
+    Previous implementation of procesamiento_datos.organize_personas: three groupbys
+    (nunique, sex, age) merged by the keys.
+    """
+    keys = (by or []) + ["COD_ENCUESTAS"]
+
+    pdnro = perestudio.groupby(keys)[["P_NROHOG", "P_NRO_PER"]].nunique().reset_index()
+    psexo = perestudio.groupby(keys + ["P_SEXO"]).size().unstack(fill_value=0).reset_index()
+    pedad = perestudio.groupby(keys + ["P_EDADR"]).size().unstack(fill_value=0).reset_index()
+
+    pdnro.rename(columns = {"P_NROHOG": "THOG", "P_NRO_PER": "TPER"}, inplace=True)
+    psexo.rename(columns = pdat.DICGEN, inplace=True)
+    pedad.rename(columns = pdat.DICEDAD, inplace=True)
+
+    dfs = [pdnro, psexo, pedad]
+    personas = reduce(lambda left, right: pd.merge(left,right,on=keys), dfs)
+
+    permpio = pd.DataFrame(columns = keys + pdat.PERSONAS_COLUMNS)
+    personas = pd.concat([permpio, personas]).fillna(0)
+
+    return personas
+
+
+#%% Funciones
+def time_it(func, *args, repeat=3, **kwargs):
+    """
+    Best execution time of func(*args, **kwargs) in 'repeat' runs.
+
+    Returns
+    -------
+    best : float
+        Time in seconds.
+    result : object
+        Output of the last run.
+
+    """
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+
+    return best, result
+
+
+def peak_memory(func, *args, **kwargs):
+    """
+    Peak memory allocated (tracemalloc, includes numpy and pandas buffers) by one run of
+    func(*args, **kwargs).
+
+    Returns
+    -------
+    peak : int
+        Bytes.
+    result : object
+        Output of the run.
+
+    """
+    tracemalloc.start()
+    try:
+        result = func(*args, **kwargs)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return peak, result
+
+
+def bench_personas(n_viv=10**6, n_mpios=10, repeat=3, seed=0):
+    """
+    Compare organize_personas with the groupby implementation on synthetic PER data.
+    Both outputs are checked to be equal.
+
+    Returns
+    -------
+    times : dict
+        {implementation: time in seconds}.
+
+    """
+    per = synthetic_per(n_viv, n_mpios, seed)
+    print('PER sintético: {} viviendas, {} personas'.format(n_viv, len(per)))
+
+    times = {}
+    times['groupby'], expected = time_it(organize_personas_groupby, per, ["U_MPIO"], repeat=repeat)
+    times['bincount'], personas = time_it(pdat.organize_personas, per, ["U_MPIO"], repeat=repeat)
+    times['chunked'], chunked = time_it(pdat.organize_personas_chunked,
+                                        [per.iloc[i:i + 10**6] for i in range(0, len(per), 10**6)], ["U_MPIO"],
+                                        repeat=repeat)
+
+    for result in [personas, chunked]:
+        pd.testing.assert_frame_equal(expected.reset_index(drop=True), result.reset_index(drop=True), check_dtype=False)
+
+    for name, seconds in times.items():
+        print('organize_personas ({}): {:.3f} s, x{:.1f}'.format(name, seconds, times['groupby'] / seconds))
+
+    return times
+
+
+def write_all_results(result_mode, result_nedif, filtClase, dptocod, mza=False):
+    """
+    Run write_results for every municipality, as the municipality loop of func_principal.
+
+    Returns
+    -------
+    result_dptos : pandas DataFrame
+        Results of all the municipalities, with the codes of the MAT combination.
+
+    """
+    result_dptos = ut.ResultCollector()
+    resumen_mpios = ut.ResultCollector()
+
+    modes = pdat.split_mpios(result_mode)
+    nedifs = pdat.split_mpios(result_nedif)
+    for u_mpio, mode in modes.items():
+        mpio = mun.load_registry().lookup(dptocod, u_mpio)
+        pdat.write_results(result_dptos, mode, nedifs.get(u_mpio, result_nedif.iloc[:0]), filtClase, mpio.code, mpio.codmpio, dptocod,
+                           resumen_mpios, mza)
+
+    return result_dptos.to_frame()
+
+
+def conteo_frame(result_dptos):
+    """
+    Input of pros_taxonomy.taxonomy built from the results of write_results, as the csv
+    file written with the output of func_principal.
+    """
+    conteo = pdat.label_combinations(result_dptos).rename(columns={'U_MPIO': 'Municipio',
+                                    'V_MAT_PARED': 'Material Pared',
+                                    'V_MAT_PISO': 'Material Piso',
+                                    'V_TIPO_VIV': 'Tipo Vivienda',
+                                    'U_EDIFICA': 'No. edificaciones',
+                                    'VA1_ESTRATO': 'Estrato'})
+    conteo['cod'] = conteo['cod'].astype(int)
+
+    return conteo
+
+
+def bench_stages(folder_path, dptocod, depto, mapping_path=MAPPING_PATH, filtClase=[1, 2], filtUnidad=[1, 2], filtViv=[1, 2, 3],
+                 repeat=1, memory=True, seed=0):
+    """
+    Time and peak memory of every stage of the pipeline on the files of a department:
+    read_files, filter_files, organize_personas, merge_department, groupby_mode,
+    write_results, taxonomy and aggregate. Each stage runs on the output of the previous one.
+
+    Parameters
+    ----------
+    folder_path : string (path)
+        Folder with the folders of the departments, e.g. written with write_synthetic.
+    dptocod : str
+        Code of the department.
+    depto : str
+        Name of the department (folder <dptocod><depto>).
+    mapping_path : string (path), optional
+        Mapping xlsx file used by taxonomy. The default is files/Esquema_clasificacion.xlsx.
+    filtClase, filtUnidad, filtViv : list, optional
+        Same as func_principal.
+    repeat : int, optional
+        Runs of each stage, the best time is kept. The default is 1.
+    memory : boolean, optional
+        True --> The peak memory of each stage is measured in one more run with tracemalloc,
+        which is slower. The default is True.
+    seed : int, optional
+        Seed of groupby_mode. The default is 0.
+
+    Returns
+    -------
+    stages : list
+        One dict for each stage: {"stage", "seconds", "peak_mb", "rows"}.
+
+    """
+    stages = []
+
+    def stage(name, func, *args, **kwargs):
+        seconds, result = time_it(func, *args, repeat=repeat, **kwargs)
+        peak = peak_memory(func, *args, **kwargs)[0] if memory else None
+
+        first = result[0] if isinstance(result, tuple) else result
+        stages.append({'stage': name,
+                       'seconds': round(seconds, 4),
+                       'peak_mb': round(peak / 2**20, 1) if peak is not None else None,
+                       'rows': len(first) if first is not None else None})
+        print('{}: {:.3f} s{}'.format(name, seconds, ', {:.1f} MB'.format(peak / 2**20) if peak is not None else ''))
+
+        return result
+
+    # filter_files modifies its input, each run filters a copy
+    mgn, viv, per, _ = stage('read_files', pdat.read_files, folder_path, dptocod, depto)
+    mgn, viv, per = stage('filter_files', lambda: pdat.filter_files(mgn.copy(), viv.copy(), per.copy(), filtClase, filtUnidad, filtViv))
+
+    u_mpios = list(viv["U_MPIO"].unique())
+    personas = stage('organize_personas', pdat.organize_personas, per, ["U_MPIO"])
+    result = stage('merge_department', pdat.merge_department, mgn, viv, per, u_mpios, personas)
+
+    mapping_list, mapping, detailed_1, detailed_2 = tax.read_mapping(mapping_path)
+    registry = mun.MunicipalityRegistry(mun.read_mpios_list(), mapping_list)
+    # Municipalities without data or without scheme (e.g. Bogotá) are excluded
+    exclude = [mpio.cod for mpio in registry.department(dptocod) if mpio.u_mpio not in u_mpios or mpio.scheme is None]
+
+    for mza in [False, True]:
+        suffix = ' (manzana)' if mza else ''
+        result_mode, result_nedif = stage('groupby_mode' + suffix, pdat.groupby_mode, result, mza, seed=seed)
+        result_dptos = stage('write_results' + suffix, write_all_results, result_mode, result_nedif, filtClase, dptocod, mza)
+
+        conteo = conteo_frame(result_dptos)
+        tipologias, tiporesumen = stage('taxonomy' + suffix, tax.taxonomy, conteo, mun.read_mpios_list(), mapping_list, mapping,
+                                        detailed_1, detailed_2, [dptocod], exclude, mza=mza)
+        stage('aggregate' + suffix, ut.aggregate, tipologias)
+
+    return stages
+
+
+def write_report(stages, path, **config):
+    """
+    Write the stages of bench_stages and the configuration of the run (sizes, versions)
+    in a JSON file, to compare runs and find regressions.
+    """
+    report = {'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+              'config': config,
+              'environment': {'python': platform.python_version(),
+                              'pandas': pd.__version__,
+                              'numpy': np.__version__,
+                              'platform': platform.platform()},
+              'stages': stages}
+
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print('Reporte guardado en {}'.format(path))
+
+    return report
+
+
+#%% Ejecución desde la consola
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks con datos sintéticos del CNPV.')
+    parser.add_argument('--prueba', choices=['personas', 'etapas'], default='personas', help='organize_personas o todas las etapas')
+    parser.add_argument('--tamano', choices=list(SIZES), default=None, help='Tamaño predefinido (viviendas, municipios)')
+    parser.add_argument('--viviendas', type=int, default=10**6, help='Número de viviendas sintéticas')
+    parser.add_argument('--mpios', type=int, default=10, help='Número de municipios sintéticos')
+    parser.add_argument('--dpto', default='68', help='Código del departamento de los municipios sintéticos')
+    parser.add_argument('--carpeta', default=None, help='Carpeta de los archivos sintéticos (por defecto una temporal)')
+    parser.add_argument('--mapping', default=MAPPING_PATH, help='Archivo xlsx de mapping para las tipologías')
+    parser.add_argument('--reporte', default='benchmark.json', help='Archivo JSON con los resultados de las etapas')
+    parser.add_argument('--sin-memoria', action='store_true', help='No medir la memoria (tracemalloc)')
+    parser.add_argument('--repeat', type=int, default=3, help='Repeticiones de cada medición')
+    parser.add_argument('--seed', type=int, default=0, help='Semilla de los datos sintéticos')
+    opts = parser.parse_args()
+
+    n_viv, n_mpios = SIZES[opts.tamano] if opts.tamano else (opts.viviendas, opts.mpios)
+
+    if opts.prueba == 'personas':
+        bench_personas(n_viv, n_mpios, opts.repeat, opts.seed)
+    else:
+        folder_path = opts.carpeta or tempfile.mkdtemp(prefix='cnpv_sintetico_')
+        write_synthetic(folder_path, opts.dpto, 'Sintetico', n_viv, n_mpios, opts.seed)
+
+        stages = bench_stages(folder_path, opts.dpto, 'Sintetico', opts.mapping, repeat=opts.repeat, memory=not opts.sin_memoria,
+                              seed=opts.seed)
+        write_report(stages, opts.reporte, size=opts.tamano, viviendas=n_viv, mpios=n_mpios, dpto=opts.dpto,
+                     repeat=opts.repeat, seed=opts.seed)
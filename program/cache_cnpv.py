@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+"""
+    Caché columnar de los archivos MGN, VIV y PER del CNPV 2018. Cada archivo
+    se convierte una sola vez a Parquet (solo con las columnas y tipos de
+    CNPV_SCHEMA), particionado por departamento y municipio. La caché se
+    invalida con el checksum del archivo fuente.
+
+    Uso desde la consola:
+        python cache_cnpv.py <ruta_carpetas> 68 Santander 05 Antioquia
+
+"""
+
+import argparse
+import json
+import os
+import shutil
+import pandas as pd
+import cnpv_io
+from checkpoint import file_checksum
+
+CNPV_FILES = {'MGN': "CNPV2018_MGN_A2_{}.CSV",
+              'VIV': "CNPV2018_1VIV_A2_{}.CSV",
+              'PER': "CNPV2018_5PER_A2_{}.CSV"}
+
+#%% Funciones
+def department_paths(folder_path, dptocod, depto, cache_dir=None):
+    """
+    Paths of the source CSV files and of the cache of a department.
+
+    Parameters
+    ----------
+    folder_path : string (path)
+        Path to folder which contains folders and DANE files.
+    dptocod : str
+        Code of the department.
+    depto : str
+        Name of the department.
+    cache_dir : string (path), optional
+        Root folder of the cache. The default is None (a 'parquet' folder inside the
+        department folder).
+
+    Returns
+    -------
+    sources : dict
+        {filetype: path to the CSV file}.
+    cache_path : string (path)
+        Folder of the cache of the department.
+
+    """
+    filepath = os.path.join(folder_path, str(dptocod) + depto)
+    sources = {filetype: os.path.join(filepath, name.format(dptocod)) for filetype, name in CNPV_FILES.items()}
+
+    if cache_dir is None:
+        cache_path = os.path.join(filepath, 'parquet')
+    else:
+        cache_path = os.path.join(cache_dir, str(dptocod) + depto)
+
+    return sources, cache_path
+
+
+def read_manifest(cache_path):
+    """
+    Read the manifest of a department cache. Returns an empty dict if it does not exist.
+    """
+    path = os.path.join(cache_path, 'manifest.json')
+    if not os.path.exists(path):
+        return {}
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_manifest(cache_path, manifest):
+    """
+    Write the manifest of a department cache.
+    """
+    with open(os.path.join(cache_path, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+
+def source_info(path, entry=None):
+    """
+    Size, modification time and checksum of a source file. The checksum of 'entry'
+    is reused when the size and modification time did not change.
+
+    Parameters
+    ----------
+    path : string (path)
+        Path to the source file.
+    entry : dict, optional
+        Manifest entry of the file. The default is None.
+
+    Returns
+    -------
+    info : dict
+        {'size', 'mtime', 'sha1'} of the file.
+
+    """
+    stat = os.stat(path)
+    info = {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+    if entry and entry.get('size') == info['size'] and entry.get('mtime') == info['mtime']:
+        info['sha1'] = entry['sha1']
+    else:
+        info['sha1'] = file_checksum(path)
+
+    return info
+
+
+def is_cached(cache_path, filetype, source):
+    """
+    Checks if the cache of a file is valid: it was written with the current CNPV_SCHEMA
+    and with the same source file (checksum). If the source file was removed the cache
+    is considered valid.
+
+    Parameters
+    ----------
+    cache_path : string (path)
+        Folder of the cache of the department.
+    filetype : str
+        'MGN', 'VIV' or 'PER'.
+    source : string (path)
+        Path to the CSV file.
+
+    Returns
+    -------
+    boolean
+        True if the cache can be used.
+
+    """
+    entry = read_manifest(cache_path).get(filetype)
+    if not entry or not os.path.isdir(os.path.join(cache_path, filetype)):
+        return False
+
+    if entry['schema'] != cnpv_io.CNPV_SCHEMA[filetype]:
+        return False
+
+    if not os.path.exists(source):
+        return True
+
+    return source_info(source, entry)['sha1'] == entry['sha1']
+
+
+def convert_file(source, cache_path, filetype, engine=None):
+    """
+    Convert a CNPV CSV file to Parquet partitioned by municipality (U_MPIO).
+
+    Parameters
+    ----------
+    source : string (path)
+        Path to the CSV file.
+    cache_path : string (path)
+        Folder of the cache of the department.
+    filetype : str
+        'MGN', 'VIV' or 'PER'.
+    engine : str, optional
+        pandas.read_csv parser engine. The default is None.
+
+    Returns
+    -------
+    None.
+
+    """
+    info = source_info(source)
+    df = cnpv_io.read_cnpv(source, filetype, engine=engine)
+
+    dest = os.path.join(cache_path, filetype)
+    if os.path.isdir(dest):
+        shutil.rmtree(dest)
+
+    df.to_parquet(dest, partition_cols=['U_MPIO'], index=False)
+
+    manifest = read_manifest(cache_path)
+    manifest[filetype] = dict(info, source=os.path.basename(source), schema=cnpv_io.CNPV_SCHEMA[filetype])
+    write_manifest(cache_path, manifest)
+
+    return
+
+
+def convert_department(folder_path, dptocod, depto, cache_dir=None, engine=None, force=False):
+    """
+    Convert the MGN, VIV, PER files of a department to the columnar cache. Files with a
+    valid cache are skipped unless 'force' is True.
+
+    Parameters
+    ----------
+    folder_path : string (path)
+        Path to folder which contains folders and DANE files.
+    dptocod : str
+        Code of the department.
+    depto : str
+        Name of the department.
+    cache_dir : string (path), optional
+        Root folder of the cache. The default is None (inside the department folder).
+    engine : str, optional
+        pandas.read_csv parser engine. The default is None.
+    force : boolean, optional
+        True --> Convert the files even if the cache is valid. The default is False.
+
+    Returns
+    -------
+    cache_path : string (path)
+        Folder of the cache of the department.
+
+    """
+    sources, cache_path = department_paths(folder_path, dptocod, depto, cache_dir)
+    os.makedirs(cache_path, exist_ok=True)
+
+    for filetype, source in sources.items():
+        if force or not is_cached(cache_path, filetype, source):
+            print('Convirtiendo {}'.format(source))
+            convert_file(source, cache_path, filetype, engine)
+
+    return cache_path
+
+
+def load_file(cache_path, filetype, filters=None):
+    """
+    Read a cached file with the dtypes of CNPV_SCHEMA.
+
+    Parameters
+    ----------
+    cache_path : string (path)
+        Folder of the cache of the department.
+    filetype : str
+        'MGN', 'VIV' or 'PER'.
+    filters : list, optional
+        pyarrow filters, e.g. [('U_MPIO', 'in', [1, 2])]. The default is None.
+
+    Returns
+    -------
+    df : pandas DataFrame
+        CNPV data.
+
+    """
+    dtypes = cnpv_io.CNPV_SCHEMA[filetype]
+    df = pd.read_parquet(os.path.join(cache_path, filetype), filters=filters or None)
+
+    # The partition column is read as category
+    df = df[list(dtypes)].astype({'U_MPIO': dtypes['U_MPIO']})
+
+    return df
+
+
+def iter_file(cache_path, filetype, filters=None, batch_size=10**6):
+    """
+    Read a cached file by batches of rows with the dtypes of CNPV_SCHEMA, without
+    loading the whole file.
+
+    Parameters
+    ----------
+    cache_path : string (path)
+        Folder of the cache of the department.
+    filetype : str
+        'MGN', 'VIV' or 'PER'.
+    filters : list, optional
+        List of (column, 'in', values) predicates. The default is None.
+    batch_size : int, optional
+        Maximum number of rows of each batch. The default is 10**6.
+
+    Yields
+    ------
+    df : pandas DataFrame
+        CNPV data.
+
+    """
+    import pyarrow.dataset as ds
+
+    dtypes = cnpv_io.CNPV_SCHEMA[filetype]
+    dataset = ds.dataset(os.path.join(cache_path, filetype), format='parquet', partitioning='hive')
+
+    expression = None
+    for col, op, values in filters or []:
+        predicate = ds.field(col).isin(list(values))
+        expression = predicate if expression is None else expression & predicate
+
+    for batch in dataset.to_batches(columns=list(dtypes), filter=expression, batch_size=batch_size):
+        yield batch.to_pandas().astype({'U_MPIO': dtypes['U_MPIO']})
+
+
+def load_department(folder_path, dptocod, depto, cache_dir=None, filters=None, read_per=True):
+    """
+    Read the MGN, VIV, PER data of a department from the cache if it is valid.
+
+    Parameters
+    ----------
+    folder_path : string (path)
+        Path to folder which contains folders and DANE files.
+    dptocod : str
+        Code of the department.
+    depto : str
+        Name of the department.
+    cache_dir : string (path), optional
+        Root folder of the cache. The default is None (inside the department folder).
+    filters : dict, optional
+        {filetype: pyarrow filters} applied while reading the row groups, see
+        procesamiento_datos.pushdown_filters. The default is None.
+    read_per : boolean, optional
+        False --> per is None (it is streamed with iter_file). The default is True.
+
+    Returns
+    -------
+    tuple or None
+        (mgn, viv, per) DataFrames, or None if any file is not cached.
+
+    """
+    sources, cache_path = department_paths(folder_path, dptocod, depto, cache_dir)
+
+    if not all(is_cached(cache_path, filetype, source) for filetype, source in sources.items()):
+        return None
+
+    filters = filters or {}
+
+    return tuple(load_file(cache_path, filetype, filters.get(filetype)) if read_per or filetype != 'PER' else None
+                 for filetype in CNPV_FILES)
+
+
+#%% Ejecución desde la consola
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convierte los archivos del CNPV a la caché columnar (Parquet).')
+    parser.add_argument('folder_path', help='Ruta con las carpetas de las bases de datos')
+    parser.add_argument('deptos', nargs='+', help='Pares código nombre, ej: 68 Santander 05 Antioquia')
+    parser.add_argument('--cache-dir', default=None, help='Carpeta raíz de la caché')
+    parser.add_argument('--engine', default=None, help='Motor de lectura de pandas.read_csv, ej: pyarrow')
+    parser.add_argument('--force', action='store_true', help='Convierte aunque la caché sea válida')
+    opts = parser.parse_args()
+
+    for dptocod, depto in zip(opts.deptos[::2], opts.deptos[1::2]):
+        convert_department(opts.folder_path, dptocod, depto, opts.cache_dir, opts.engine, opts.force)
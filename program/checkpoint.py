@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+"""
+    Checkpoints en disco de los resultados por municipio. Cada resultado se
+    guarda (pickle) con la huella de los datos y parámetros que lo generaron,
+    de forma que una ejecución interrumpida o repetida solo recalcula los
+    departamentos y municipios que faltan o que cambiaron.
+
+    StageCache guarda además las etapas intermedias (cruce de MGN, VIV, PER y
+    moda por edificación) para reutilizarlas entre ejecuciones con distintos
+    filtros, con un tamaño máximo en disco.
+
+"""
+
+import hashlib
+import json
+import os
+import pickle
+import numpy as np
+import pandas as pd
+
+# Increase when the content of the checkpoints changes
+CHECKPOINT_VERSION = 4
+
+#%% Funciones
+def file_checksum(path, blocksize=2**24):
+    """
+    Calculates the SHA-1 checksum of a file reading it by blocks.
+
+    Parameters
+    ----------
+    path : string (path)
+        Path to the file.
+    blocksize : int, optional
+        Number of bytes read at once. The default is 16 MB.
+
+    Returns
+    -------
+    str
+        Hexadecimal SHA-1 checksum.
+
+    """
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            sha.update(block)
+
+    return sha.hexdigest()
+
+
+def fingerprint(*parts):
+    """
+    SHA-1 of any combination of JSON serializable values (lists, dicts, numbers, strings).
+
+    Returns
+    -------
+    str
+        Hexadecimal SHA-1.
+
+    """
+    text = json.dumps([CHECKPOINT_VERSION, parts], sort_keys=True, default=str)
+
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def partition_fingerprints(df, col="U_MPIO"):
+    """
+    SHA-1 of the rows of each partition of a DataFrame, computed from the pandas row
+    hashes. Two partitions with the same columns, dtypes and rows have the same fingerprint.
+
+    Parameters
+    ----------
+    df : pandas DataFrame
+        Data, e.g. the MGN, VIV or PER data of a department.
+    col : str, optional
+        Column with the partition code. The default is "U_MPIO".
+
+    Returns
+    -------
+    dict
+        {partition code: hexadecimal SHA-1}.
+
+    """
+    if df is None or not len(df):
+        return {}
+
+    header = repr(list(zip(df.columns, df.dtypes.astype(str)))).encode('utf-8')
+    hashes = pd.util.hash_pandas_object(df, index=False).to_numpy()
+
+    codes = df[col].to_numpy()
+    order = np.argsort(codes, kind='stable')
+    codes, hashes = codes[order], hashes[order]
+    bounds = np.r_[0, np.flatnonzero(codes[1:] != codes[:-1]) + 1, len(codes)]
+
+    fingerprints = {}
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        sha = hashlib.sha1(header)
+        sha.update(hashes[start:end].tobytes())
+        fingerprints[codes[start].item()] = sha.hexdigest()
+
+    return fingerprints
+
+
+class CheckpointStore(object):
+    """
+    Results saved on disk by group (e.g. a department and a set of parameters) and name
+    (e.g. a municipality). Every entry is saved with a key, usually a fingerprint of its
+    inputs, and get only returns it while the key is the same.
+
+    Parameters
+    ----------
+    path : string (path)
+        Root folder of the checkpoints.
+
+    """
+    def __init__(self, path):
+        self.path = path
+        self.manifests = {}
+        os.makedirs(path, exist_ok=True)
+
+    def get(self, group, name, key):
+        """
+        Saved value of an entry, None if it does not exist or was saved with another key.
+        """
+        if self._manifest(group).get(name) != key:
+            return None
+
+        try:
+            with open(self._file(group, name), 'rb') as f:
+                return pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def put(self, group, name, key, value):
+        """
+        Save the value of an entry. The file is written first and then registered in the
+        manifest of the group, so an interrupted write is never read.
+        """
+        path = self._file(group, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+
+        manifest = self._manifest(group)
+        manifest[name] = key
+        with open(self._file(group, 'manifest.json') + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(self._file(group, 'manifest.json') + '.tmp', self._file(group, 'manifest.json'))
+
+    def _file(self, group, name):
+        name = name if name.endswith('.json') else name + '.pkl'
+
+        return os.path.join(self.path, group, name)
+
+    def _manifest(self, group):
+        if group not in self.manifests:
+            path = self._file(group, 'manifest.json')
+            manifest = {}
+            if os.path.exists(path):
+                with open(path) as f:
+                    manifest = json.load(f)
+            self.manifests[group] = manifest
+
+        return self.manifests[group]
+
+
+class StageCache(object):
+    """
+    Results of intermediate stages of the pipeline saved on disk by a content key, e.g.
+    the fingerprint of the input partition and of the parameters of the stage. The size
+    on disk is bounded: when it exceeds max_bytes the least recently used entries are
+    removed.
+
+    Parameters
+    ----------
+    path : string (path)
+        Folder of the cache.
+    max_bytes : int, optional
+        Maximum size of the cache. The default is 4 GB.
+
+    """
+    def __init__(self, path, max_bytes=4 * 2**30):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.size = None
+        os.makedirs(path, exist_ok=True)
+
+    def get(self, key):
+        """
+        Saved value of a key, None if it is not in the cache.
+        """
+        path = self._file(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+            # The modification time is the last use of the entry
+            os.utime(path)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+        return value
+
+    def put(self, key, value):
+        """
+        Save the value of a key and remove the least recently used entries if the cache
+        is larger than max_bytes.
+        """
+        path = self._file(key)
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+
+        if self.size is None:
+            self.evict()
+        else:
+            self.size += os.path.getsize(path)
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def memoize(self, key, func, *args, **kwargs):
+        """
+        Value of func(*args, **kwargs). It is only calculated if key is not in the cache.
+        """
+        value = self.get(key)
+        if value is None:
+            value = func(*args, **kwargs)
+            self.put(key, value)
+
+        return value
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache is smaller than max_bytes.
+        """
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith('.pkl'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        self.size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if self.size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                self.size -= size
+            except OSError:
+                pass
+
+    def _file(self, key):
+        return os.path.join(self.path, key + '.pkl')
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+    Lectura de los archivos MGN, VIV y PER del CNPV 2018: columnas y tipos
+    compactos (CNPV_SCHEMA) y lectores con filtros aplicados por bloques. Lo
+    usan procesamiento_datos y la caché en Parquet (cache_cnpv).
+
+"""
+
+import pandas as pd
+
+# Columns used by the pipeline and their compact dtypes for every file type.
+# Variables with missing values in the DANE files are read as float32 (or nullable Int)
+# so that the NaN fill of filter_files keeps working.
+CNPV_SCHEMA = {
+    'MGN': {'U_MPIO': 'int16',
+            'UA_CLASE': 'int8',
+            'U_SECT_RUR': 'Int16',
+            'U_SECC_RUR': 'Int16',
+            'UA2_CPOB': 'Int16',
+            'U_SECT_URB': 'Int16',
+            'U_SECC_URB': 'Int16',
+            'U_MZA': 'Int16',
+            'U_EDIFICA': 'Int32',
+            'COD_ENCUESTAS': 'int32',
+            'COD_DANE_ANM': 'str'},
+    'VIV': {'U_MPIO': 'int16',
+            'UA_CLASE': 'int8',
+            'COD_ENCUESTAS': 'int32',
+            'UVA_USO_UNIDAD': 'int8',
+            'V_TIPO_VIV': 'float32',
+            'V_MAT_PARED': 'float32',
+            'V_MAT_PISO': 'float32',
+            'VA1_ESTRATO': 'float32'},
+    'PER': {'U_MPIO': 'int16',
+            'UA_CLASE': 'int8',
+            'COD_ENCUESTAS': 'int32',
+            'P_NROHOG': 'float32',
+            'P_NRO_PER': 'Int16',
+            'P_SEXO': 'int8',
+            'P_EDADR': 'int8'}
+    }
+
+
+#%% Funciones
+def apply_filters(df, filters):
+    """
+    Keep the rows of df that fulfill every (column, 'in', values) predicate.
+    """
+    for col, op, values in filters:
+        df = df[df[col].isin(values)]
+    
+    return df
+
+
+def read_cnpv(path, filetype, schema=True, engine=None, filters=None, chunksize=10**6):
+    """
+    Read a CNPV file only with the columns and dtypes of CNPV_SCHEMA. If filters are given
+    the file is read by chunks and each chunk is filtered, so that the discarded rows are
+    never held in memory (the pyarrow engine does not support chunks, the file is filtered
+    after reading it).
+
+    Parameters
+    ----------
+    path : string (path)
+        Path to the CSV file.
+    filetype : str
+        'MGN', 'VIV' or 'PER'.
+    schema : boolean, optional
+        False --> Read every column with the default dtypes. The default is True.
+    engine : str, optional
+        pandas.read_csv parser engine, e.g. 'pyarrow' (requires pyarrow). The default is None (pandas default).
+    filters : list, optional
+        List of (column, 'in', values) predicates, see pushdown_filters. The default is None.
+    chunksize : int, optional
+        Number of rows of each chunk when filters are given. The default is 10**6.
+
+    Returns
+    -------
+    df : pandas DataFrame
+        CNPV data.
+
+    """
+    kwargs = {}
+    if engine is not None:
+        kwargs['engine'] = engine
+    
+    if schema:
+        dtypes = CNPV_SCHEMA[filetype]
+        kwargs['usecols'] = list(dtypes)
+        kwargs['dtype'] = dtypes
+    
+    if filters and engine != 'pyarrow':
+        df = pd.concat(iter_cnpv(path, filetype, schema, engine, filters, chunksize), ignore_index=True)
+    else:
+        df = apply_filters(pd.read_csv(path, **kwargs), filters or [])
+    
+    return df
+
+
+def iter_cnpv(path, filetype, schema=True, engine=None, filters=None, chunksize=10**6):
+    """
+    Read a CNPV file by chunks of 'chunksize' rows, each chunk filtered with 'filters'.
+    Same parameters as read_cnpv. The pyarrow engine does not support chunks, the whole
+    file is yielded as a single chunk.
+
+    Yields
+    ------
+    chunk : pandas DataFrame
+        Filtered rows of the CNPV file.
+
+    """
+    kwargs = {}
+    if engine is not None:
+        kwargs['engine'] = engine
+    
+    if schema:
+        dtypes = CNPV_SCHEMA[filetype]
+        kwargs['usecols'] = list(dtypes)
+        kwargs['dtype'] = dtypes
+    
+    if engine == 'pyarrow':
+        yield apply_filters(pd.read_csv(path, **kwargs), filters or [])
+        return
+    
+    for chunk in pd.read_csv(path, chunksize=chunksize, **kwargs):
+        yield apply_filters(chunk, filters or [])
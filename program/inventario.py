@@ -52,7 +52,14 @@ result_dptos, resumen_dptos, resumen_mpios, result_nedifstr, result_mode, result
 #%% Save
 # Result dptos archivo base para calcular la matriz de tipologías
 # ut.save_csv(result_dptos, "output_resultcombinacionColombia")
+# o en Parquet por departamento, es el result_path de modelo_exposicion.py
+# ut.save_table(result_dptos, "output_resultcombinacionColombia", "parquet", partition="departamento")
 # Resumen dptos dataframe con el resumen de conteo por municipio
 # ut.save_csv(resumen_dptos, "output_resumenconteo")
 # Resumen mpios dataframe con el resumen de conteo por manazana y municipio
 # ut.save_csv(resumen_mpios, "output_resumenconteoManzana")
+
+#%% Tablas por material (el archivo de resultados se lee una sola vez)
+# cube = ut.MaterialCube.from_file("output_resultcombinacionColombia")
+# ut.save_csv(cube.pivot("Material Pared", "No. edificaciones"), "NedificacionesXMatPared")
+# ut.save_csv(cube.pivot("Material Pared", "TPER"), "NpersonasXMatPared")
@@ -15,7 +15,7 @@ import pros_taxonomy as tax
 import utilities as ut
 
 mapping_path = r'D:/Esquema_clasificacion_181021_3.xlsx' #ruta a archivo de mapping
-result_path = r'D:\Universidad\[10]Décimo Semestre\Ingeniería Sísmica\Procesamiento datos del censo\GitHub\program/santander_ESTR.csv' #ruta a archivo con los resultados de número de edificaciones por combinación
+result_path = r'D:\Universidad\[10]Décimo Semestre\Ingeniería Sísmica\Procesamiento datos del censo\GitHub\program/santander_ESTR.csv' #ruta a archivo con los resultados de número de edificaciones por combinación (csv, Parquet, Feather o carpeta de ut.save_table)
 
 
 # deptcod = ['68']
@@ -38,9 +38,10 @@ exe_subdivi = False #True: se ejecuta a nivel manzana
 #%% Ejecución cálculo de matriz de tipologías
 exclude = [5001, 11001, 76001] #Se excluyen Medellín, Bogotá y Cali
 
-conteo_mpios, mpios_list, mapping_list, mapping, detailed_1, detailed_2 = tax.read_input(mapping_path, result_path, mza=exe_subdivi)
+mapping_tables = tax.load_mapping(mapping_path) #esquema de clasificación con los esquemas compilados, se lee de la caché
+conteo_mpios, mpios_list, mapping_list, mapping, detailed_1, detailed_2 = tax.read_input(mapping_path, result_path, mza=exe_subdivi, mapping_tables=mapping_tables)
 
-tipologias, tiporesumen = tax.taxonomy(conteo_mpios, mpios_list, mapping_list, mapping, detailed_1, detailed_2, deptcod, exclude, mza=exe_subdivi)
+tipologias, tiporesumen = tax.taxonomy(conteo_mpios, mpios_list, mapping_list, mapping, detailed_1, detailed_2, deptcod, exclude, mza=exe_subdivi, schemes=mapping_tables.schemes)
 
 #%% Agregar tipologías por # pisos
 
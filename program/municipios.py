@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+    Registro de los municipios de Colombia (mpios_list.csv) indexado por el
+    código DIVIPOLA. El código de 4 o 5 dígitos se descompone en el código del
+    departamento y en el código del municipio dentro del departamento (U_MPIO
+    en los archivos del CNPV), ej: 5001 --> ('05', 1), 68001 --> ('68', 1).
+
+"""
+
+import os
+from collections import namedtuple
+from collections.abc import Mapping
+from functools import lru_cache
+from types import MappingProxyType
+import pandas as pd
+
+MPIOS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mpios_list.csv')
+
+#%% Funciones
+def split_cod(cod):
+    """
+    Department and municipality (U_MPIO) codes of a DIVIPOLA code.
+
+    Parameters
+    ----------
+    cod : int or str
+        DIVIPOLA code, e.g. 5001, '05001' or '68001'.
+
+    Returns
+    -------
+    dpto : int
+        Code of the department, e.g. 5.
+    u_mpio : int
+        Code of the municipality in the department, e.g. 1.
+
+    """
+    return divmod(int(cod), 1000)
+
+
+def format_cod(cod):
+    """
+    DIVIPOLA code with 5 digits, e.g. 5001 --> '05001'.
+    """
+    return '{:05d}'.format(int(cod))
+
+
+class Municipio(namedtuple('Municipio', ['cod', 'dpto', 'u_mpio', 'name', 'dpto_name', 'scheme'])):
+    """
+    Municipality of the registry. cod, dpto and u_mpio are int, scheme is the mapping
+    scheme of the "Lista" sheet (None if it is unknown).
+    """
+    __slots__ = ()
+
+    @property
+    def code(self):
+        """DIVIPOLA code with 5 digits, e.g. '05001'."""
+        return format_cod(self.cod)
+
+    @property
+    def codmpio(self):
+        """Code of the municipality in the department with 3 digits, e.g. '001'."""
+        return '{:03d}'.format(self.u_mpio)
+
+
+class MunicipalityRegistry(Mapping):
+    """
+    Immutable mapping {DIVIPOLA code: Municipio} with the municipalities in the order of
+    mpios_list, and lookups by department and by (department, U_MPIO).
+
+    Parameters
+    ----------
+    mpios_list : pandas DataFrame
+        List of municipalities (COD, Departamento, Departamento_name, Municipio_name).
+    mapping_list : pandas DataFrame, optional
+        "Lista" sheet of the mapping xlsx file, gives the scheme of each municipality.
+        The default is None.
+
+    """
+
+    def __init__(self, mpios_list, mapping_list=None):
+        schemes = {}
+        if mapping_list is not None:
+            esquema = mapping_list["Esquema"].where(mapping_list["Esquema"].notna(), None)
+            schemes = dict(zip(mapping_list["Código"].astype(int), esquema))
+
+        mpios = {}
+        deptos = {}
+        for cod, dpto, dpto_name, name in zip(mpios_list["COD"], mpios_list["Departamento"],
+                                              mpios_list["Departamento_name"], mpios_list["Municipio_name"]):
+            cod = int(cod)
+            dpto_cod, u_mpio = split_cod(cod)
+
+            if dpto_cod != int(dpto):
+                raise ValueError('El código {} no pertenece al departamento {}'.format(cod, dpto))
+            if cod in mpios:
+                raise ValueError('Código de municipio repetido: {}'.format(cod))
+
+            mpio = Municipio(cod, dpto_cod, u_mpio, name, dpto_name, schemes.get(cod))
+            mpios[cod] = mpio
+            deptos.setdefault(dpto_cod, []).append(mpio)
+
+        self._mpios = MappingProxyType(mpios)
+        self._deptos = MappingProxyType({dpto: tuple(mpios) for dpto, mpios in deptos.items()})
+
+    def __getitem__(self, cod):
+        return self._mpios[int(cod)]
+
+    def __iter__(self):
+        return iter(self._mpios)
+
+    def __len__(self):
+        return len(self._mpios)
+
+    def __contains__(self, cod):
+        try:
+            return int(cod) in self._mpios
+        except (TypeError, ValueError):
+            return False
+
+    def department(self, dptocod):
+        """
+        Municipalities of a department (code as int or str, e.g. '05'), in file order.
+        """
+        return self._deptos.get(int(dptocod), ())
+
+    def lookup(self, dptocod, u_mpio):
+        """
+        Municipality of a department by its U_MPIO code, None if it does not exist.
+        """
+        return self._mpios.get(int(dptocod) * 1000 + int(u_mpio))
+
+
+def read_mpios_list(path=MPIOS_PATH):
+    """
+    Read the list of the 1122 Colombian municipalities considered by DANE.
+    """
+    return pd.read_csv(path, encoding="ISO-8859-1")
+
+
+@lru_cache(maxsize=None)
+def load_registry(path=MPIOS_PATH):
+    """
+    Registry of the municipalities of mpios_list.csv. It is read once per process.
+
+    Parameters
+    ----------
+    path : string (path), optional
+        Path to the list of municipalities. The default is the mpios_list.csv file
+        next to this module.
+
+    Returns
+    -------
+    MunicipalityRegistry
+
+    """
+    return MunicipalityRegistry(read_mpios_list(path))
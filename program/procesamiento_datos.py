@@ -9,9 +9,58 @@ from __future__ import division
 import numpy as np
 import pandas as pd
 import time
+import os
 import utilities as ut
+import cache_cnpv as cache
+import cnpv_io
+import checkpoint as ck
+import municipios as mun
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from functools import reduce
 
+#%% Etiquetas de las variables del CNPV
+TVIV = {0: 'Sin informacion',
+        1: 'Casa',
+        2: 'Apartamento',
+        3: 'Tipo Cuarto'}
+
+MPARED = {0: 'Sin informacion',
+          1: 'Bloque, ladrillo, piedra, madera pulida',
+          2: 'Concreto vaciado',
+          3: 'Material prefabricado',
+          4: 'Guadua',
+          5: 'Tapia pisada, bahareque, adobe',
+          6: ' Madera burda, tabla, tablon',
+          7: 'Cana, esterilla, otros vegetales',
+          8: 'Materiales de deshecho (Zinc, tela, carton, latas, plasticos, otros)',
+          9: 'No tiene paredes'}
+
+MPISO = {0: 'Sin informacion',
+         1: 'Marmol, parque, madera pulida y lacada',
+         2: 'Baldosa, vinilo, tableta, ladrillo, laminado',
+         3: 'Alfombra',
+         4: 'Cemento, gravilla',
+         5: 'Madera burda, tabla, tablon, otro vegetal',
+         6: 'Tierra, arena, barro'}
+
+ESTTO = {0: 'Sin Estrato',
+         1: 'Estrato 1',
+         2: 'Estrato 2',
+         3: 'Estrato 3',
+         4: 'Estrato 4',
+         5: 'Estrato 5',
+         6: 'Estrato 6',
+         9: 'No sabe el estrato',
+         10: 'Sin informacion'}
+
+# Labels of the MAT combination codes. The results keep the codes, the labels are only
+# set by label_combinations when the results are returned
+COMBINATION_LABELS = {'V_MAT_PARED': MPARED,
+                      'V_MAT_PISO': MPISO,
+                      'V_TIPO_VIV': TVIV,
+                      'VA1_ESTRATO': ESTTO}
+
 #%% Funciones
 def cambio_variable(var, idx):
     """
@@ -30,56 +79,48 @@ def cambio_variable(var, idx):
         Returns the corresponding string value from specified variable.
 
     """
-    TVIV = {0: 'Sin informacion',
-            1: 'Casa',
-            2: 'Apartamento',
-            3: 'Tipo Cuarto'}
-    
-    MPARED = {0: 'Sin informacion',
-              1: 'Bloque, ladrillo, piedra, madera pulida',
-              2: 'Concreto vaciado',
-              3: 'Material prefabricado',
-              4: 'Guadua',
-              5: 'Tapia pisada, bahareque, adobe',
-              6: ' Madera burda, tabla, tablon',
-              7: 'Cana, esterilla, otros vegetales',
-              8: 'Materiales de deshecho (Zinc, tela, carton, latas, plasticos, otros)',
-              9: 'No tiene paredes'}
-    
-    MPISO = {0: 'Sin informacion',
-             1: 'Marmol, parque, madera pulida y lacada',
-             2: 'Baldosa, vinilo, tableta, ladrillo, laminado',
-             3: 'Alfombra',
-             4: 'Cemento, gravilla',
-             5: 'Madera burda, tabla, tablon, otro vegetal',
-             6: 'Tierra, arena, barro'}
-    
-    ESTTO = {0: 'Sin Estrato',
-             1: 'Estrato 1',
-             2: 'Estrato 2',
-             3: 'Estrato 3',
-             4: 'Estrato 4',
-             5: 'Estrato 5',
-             6: 'Estrato 6',
-             9: 'No sabe el estrato',
-             10: 'Sin informacion'}
+    return COMBINATION_LABELS[var[:-len('_VS1')]][idx]
+
+
+def label_combinations(df, cols=None):
+    """
+    Replace the codes of the MAT combination columns by their labels (see COMBINATION_LABELS)
+    with one categorical lookup per column. Vectorized version of cambio_variable.
+
+    Parameters
+    ----------
+    df : pandas DataFrame
+        Results with the codes, e.g. result_nedifstr.
+    cols : list, optional
+        Columns to label. The default is None (the columns of COMBINATION_LABELS in df).
+
+    Returns
+    -------
+    df : pandas DataFrame
+        Copy of df with categorical columns.
 
+    """
+    if cols is None:
+        cols = [col for col in COMBINATION_LABELS if col in df.columns]
     
-    if var == 'V_TIPO_VIV_VS1':
+    df = df.copy()
+    for col in cols:
+        labels = COMBINATION_LABELS[col]
+        categories = pd.unique(np.array(list(labels.values()), dtype=object))
         
-        return TVIV[idx]
-    
-    elif var == 'V_MAT_PARED_VS1':
+        # Code --> position of its label in categories, -1 for unknown codes
+        lookup = np.full(max(labels) + 1, -1)
+        lookup[list(labels)] = pd.Index(categories).get_indexer(list(labels.values()))
         
-        return MPARED[idx]
-    
-    elif var == 'V_MAT_PISO_VS1':
+        codes = np.asarray(df[col], dtype=np.int64)
+        known = (codes >= 0) & (codes < len(lookup))
+        codes = np.where(known, lookup[np.where(known, codes, 0)], -1)
+        if (codes < 0).any():
+            raise ValueError('Códigos desconocidos en {}: {}'.format(col, sorted(set(np.asarray(df[col])[codes < 0]))))
         
-        return MPISO[idx]
+        df[col] = pd.Categorical.from_codes(codes, categories)
     
-    elif var == 'VA1_ESTRATO_VS1':
-        
-        return ESTTO[idx]
+    return df
     
     
 def func_mode(x):
@@ -148,8 +189,129 @@ def func_mode_tviv(x):
         else:
             
             return np.random.randint(1, high=3)
-        
-def read_files(folder_path, dptocod, depto):
+
+
+def conditional_mode(groups, values, excluded=0, fallback=None, seed=None, keys=None):
+    """
+    Vectorized version of func_mode / func_mode_tviv. Calculates the conditional
+    mode of every group at once from the (group, value) counts.
+
+    The rule is the same as the one applied by func_mode for each group:
+        - The most frequent value different from 'excluded' is returned.
+        - If several values share the maximum count and 'excluded' is not more
+          frequent than them, the smallest value is returned (pd.Series.mode order).
+        - If 'excluded' is strictly the most frequent value, the runner-up is
+          returned and ties are broken by first appearance (pd.Series.value_counts order).
+        - If the group only contains 'excluded', 'fallback' is used.
+
+    Parameters
+    ----------
+    groups : array-like of int
+        Group number (0 to n-1) of every value, e.g. from DataFrame.groupby().ngroup().
+    values : array-like
+        Values (MAT or TIPO_VIV codes) to calculate the mode.
+    excluded : int, optional
+        Value ignored by the mode. 0 for MAT variables, 3 for TIPO_VIV. The default is 0.
+    fallback : tuple, optional
+        (low, high) range used to draw a random value with randint when a group only
+        contains the excluded value, as func_mode_tviv does with (1, 3). The values are
+        drawn in group order from the global numpy generator if seed is None. If None,
+        the excluded value is returned. The default is None.
+    seed : int, optional
+        Seed for the fallback random values. The value of each group is taken from the
+        hash of its keys and the seed, so it does not depend on the other groups calculated
+        with it (other municipalities, CLASE values or rows filtered while reading).
+        The default is None.
+    keys : pandas DataFrame, optional
+        Integer columns that identify every group (e.g. the building keys), one row per
+        group ordered by group number. The default is None (the group number).
+
+    Returns
+    -------
+    mode : numpy array
+        Conditional mode of every group ordered by group number.
+
+    """
+    groups = np.asarray(groups)
+    values = np.asarray(values)
+    ngroups = groups.max() + 1 if len(groups) else 0
+    
+    pairs = pd.DataFrame({'g': groups, 'v': values, 'pos': np.arange(len(values))})
+    stats = pairs.groupby(['g', 'v'], sort=True)['pos'].agg(['size', 'min']).reset_index()
+    
+    is_excl = (stats['v'] == excluded).to_numpy()
+    excl_count = np.zeros(ngroups, dtype=np.int64)
+    excl_count[stats.loc[is_excl, 'g'].to_numpy()] = stats.loc[is_excl, 'size'].to_numpy()
+    
+    # Candidates are the most frequent values different from 'excluded'
+    cand = stats[~is_excl]
+    max_count = cand.groupby('g')['size'].transform('max')
+    cand = cand[cand['size'] == max_count]
+    
+    g = cand['g'].to_numpy()
+    dominated = excl_count[g] > cand['size'].to_numpy()
+    tiebreak = np.where(dominated, cand['min'].to_numpy(), cand['v'].to_numpy())
+    order = np.lexsort((tiebreak, g))
+    g = g[order]
+    first = np.ones(len(g), dtype=bool)
+    first[1:] = g[1:] != g[:-1]
+    
+    mode = np.full(ngroups, excluded, dtype=np.result_type(values.dtype, np.int64))
+    mode[g[first]] = cand['v'].to_numpy()[order][first]
+    
+    if fallback is not None:
+        missing = np.ones(ngroups, dtype=bool)
+        missing[g] = False
+        nmissing = missing.sum()
+        if nmissing:
+            if seed is None:
+                mode[missing] = np.random.randint(fallback[0], high=fallback[1], size=nmissing)
+            else:
+                keys = pd.DataFrame({'g': np.arange(ngroups)}) if keys is None else pd.DataFrame(keys)
+                keys = keys.iloc[np.flatnonzero(missing)].astype(np.int64)
+                hashes = pd.util.hash_pandas_object(keys, index=False, hash_key='{:016d}'.format(seed % 10**16)).to_numpy()
+                mode[missing] = fallback[0] + (hashes % np.uint64(fallback[1] - fallback[0])).astype(np.int64)
+    
+    return mode
+
+
+
+def pushdown_filters(filtClase=None, filtUnidad=[1, 2], filtViv=[1, 2, 3]):
+    """
+    Translate the filters of filter_files into predicates for the readers (cnpv_io.read_cnpv
+    and the Parquet cache), so that discarded rows are dropped while reading. As in filter_files,
+    if a filter is not a list it and the following filters are not applied.
+
+    Parameters
+    ----------
+    filtClase : list, optional
+        List containing the numerical values of Clase to be filtered. The default is None.
+    filtUnidad : list, optional
+        List containing the numerical values of USO_UNIDAD to be filtered. The default is [1, 2].
+    filtViv : list, optional
+        List containing the numerical values of TIPO_VIVIENDA to be filtered. The default is [1, 2, 3].
+
+    Returns
+    -------
+    filters : dict
+        {filetype: list of (column, 'in', values)} for 'MGN', 'VIV' and 'PER'.
+
+    """
+    predicates = []
+    if filtClase:
+        predicates += [('MGN', "UA_CLASE", filtClase), ('VIV', "UA_CLASE", filtClase), ('PER', "UA_CLASE", filtClase)]
+    predicates += [('VIV', 'UVA_USO_UNIDAD', filtUnidad), ('VIV', 'V_TIPO_VIV', filtViv)]
+    
+    filters = {'MGN': [], 'VIV': [], 'PER': []}
+    for filetype, col, values in predicates:
+        if not pd.api.types.is_list_like(values):
+            break
+        filters[filetype].append((col, 'in', list(values)))
+    
+    return filters
+
+
+def read_files(folder_path, dptocod, depto, schema=True, engine=None, cache_dir=None, filters=None, read_per=True):
     """
     Read the MGN, VIV, PER files and list containing 1122 Colombian municipalities from the specified folder path
 
@@ -161,6 +323,18 @@ def read_files(folder_path, dptocod, depto):
         Code of the department to import files.
     depto : int
         Name of the department to import files.
+    schema : boolean, optional
+        True --> Only the columns of cnpv_io.CNPV_SCHEMA are read with compact dtypes. The default is True.
+    engine : str, optional
+        pandas.read_csv parser engine, e.g. 'pyarrow'. The default is None.
+    cache_dir : string (path), optional
+        Root folder of the columnar cache (see cache_cnpv). If the department is cached
+        the Parquet files are read instead of the CSV files. The default is None (a
+        'parquet' folder inside the department folder).
+    filters : dict, optional
+        {filetype: predicates} applied while reading, see pushdown_filters. The default is None.
+    read_per : boolean, optional
+        False --> The PER file is not read (it is streamed with iter_personas). The default is True.
 
     Returns
     -------
@@ -169,7 +343,7 @@ def read_files(folder_path, dptocod, depto):
     viv : pandas DataFrame
         VIV data.
     per : pandas DataFrame
-        per data.
+        per data (None if read_per is False).
     mpios_list : pandas DataFrame
         list containing 1122 Colombian municipalities considered by DANE.
 
@@ -179,11 +353,17 @@ def read_files(folder_path, dptocod, depto):
     f_viv = r"CNPV2018_1VIV_A2_{}.CSV".format(dptocod)
     f_per = r"CNPV2018_5PER_A2_{}.CSV".format(dptocod)
         
-    mgn = pd.read_csv(filepath + f_mgn)
-    viv = pd.read_csv(filepath + f_viv)
-    per = pd.read_csv(filepath + f_per)   
+    filters = filters or {}
+    cached = cache.load_department(folder_path, dptocod, depto, cache_dir, filters, read_per) if schema else None
     
-    mpios_list = pd.read_csv("mpios_list.csv", encoding="ISO-8859-1")
+    if cached is not None:
+        mgn, viv, per = cached
+    else:
+        mgn = cnpv_io.read_cnpv(filepath + f_mgn, 'MGN', schema, engine, filters.get('MGN'))
+        viv = cnpv_io.read_cnpv(filepath + f_viv, 'VIV', schema, engine, filters.get('VIV'))
+        per = cnpv_io.read_cnpv(filepath + f_per, 'PER', schema, engine, filters.get('PER')) if read_per else None
+    
+    mpios_list = mun.read_mpios_list()
     
     return mgn, viv, per, mpios_list
 
@@ -221,7 +401,8 @@ def filter_files(mgn, viv, per, filtClase=None, filtUnidad=[1, 2], filtViv=[1, 2
     viv['V_MAT_PARED'] = viv['V_MAT_PARED'].fillna(0)
     viv['V_MAT_PISO'] = viv['V_MAT_PISO'].fillna(0)
     viv['VA1_ESTRATO'] = viv['VA1_ESTRATO'].fillna(10)
-    per["P_NROHOG"] = per["P_NROHOG"].fillna(1)
+    if per is not None:
+        per["P_NROHOG"] = per["P_NROHOG"].fillna(1)
     
     try:
         "An error will occur if the filter input parameter is different from a list"
@@ -232,7 +413,8 @@ def filter_files(mgn, viv, per, filtClase=None, filtUnidad=[1, 2], filtViv=[1, 2
             
             mgn = mgn[mgn["UA_CLASE"].isin(filtClase)]
             viv = viv[viv["UA_CLASE"].isin(filtClase)]
-            per = per[per["UA_CLASE"].isin(filtClase)]
+            if per is not None:
+                per = per[per["UA_CLASE"].isin(filtClase)]
         
         #Filter VIV data by USO_UNIDAD and TIPO_VIV
         viv = viv[viv['UVA_USO_UNIDAD'].isin(filtUnidad)] #Uso vivienda y uso mixto
@@ -243,15 +425,57 @@ def filter_files(mgn, viv, per, filtClase=None, filtUnidad=[1, 2], filtViv=[1, 2
     return mgn, viv, per
 
 
-def organize_personas(perestudio):
+DICEDAD = {1: 'T00', 2:'T05', 3:'T10', 4:'T15', 5:'T20', 6:'T25', 7:'T30', 8:'T35', 
+           9:'T40', 10:'T45', 11:'T50', 12:'T55', 13:'T60', 14:'T65', 15:'T70', 16:'T75', 
+           17:'T80', 18:'T85', 19:'T90', 20:'T95', 21:'T100'}
+
+DICGEN = {1: 'THOM', 2: 'TMUJ'}
+
+# Columns of the organized PERSONAS data, after the keys
+PERSONAS_COLUMNS = ['THOG', 'TPER', 'THOM', 'TMUJ', 
+                    'T00', 'T05', 'T10', 'T15', 'T20', 
+                    'T25', 'T30', 'T35', 'T40', 'T45', 
+                    'T50', 'T55', 'T60', 'T65', 'T70', 
+                    'T75', 'T80', 'T85', 'T90', 'T95', 'T100']
+
+
+def split_mpios(df, col="U_MPIO"):
+    """
+    Partition a DataFrame by municipality in a single pass, so that each municipality
+    is not looked up with a boolean mask over the whole department.
+
+    Parameters
+    ----------
+    df : pandas DataFrame
+        MGN, VIV or PER data of a department.
+    col : str, optional
+        Column with the municipality code. The default is "U_MPIO".
+
+    Returns
+    -------
+    partitions : dict
+        Dictionary {U_MPIO: pandas DataFrame} with the rows of each municipality.
+
+    """
+    partitions = {mpio: data for mpio, data in df.groupby(col, sort=False)}
+    
+    return partitions
+
+
+def organize_personas(perestudio, by=None):
     """
     Stack original PERSONAS data by COD_ENCUESTAS in order to get a DataFrame with same format as
-    VIV and MGN data.
+    VIV and MGN data. All the columns are computed in a single pass: every row gets the integer
+    code of its dwelling and the counts are taken with np.bincount over (dwelling, value) codes.
+    Only dwellings with sex and age data are kept.
 
     Parameters
     ----------
     perestudio : pandas DataFrame
         Personas DataFrame without modifications.
+    by : list, optional
+        Additional columns to group by before COD_ENCUESTAS, e.g. ["U_MPIO"] when
+        the data of a whole department is organized at once. The default is None.
 
     Returns
     -------
@@ -259,36 +483,230 @@ def organize_personas(perestudio):
         Personas DataFrame grouped by COD_ENCUESTAS.
 
     """
-    dicedad = {1: 'T00', 2:'T05', 3:'T10', 4:'T15', 5:'T20', 6:'T25', 7:'T30', 8:'T35', 
-               9:'T40', 10:'T45', 11:'T50', 12:'T55', 13:'T60', 14:'T65', 15:'T70', 16:'T75', 
-               17:'T80', 18:'T85', 19:'T90', 20:'T95', 21:'T100'}
+    keys = (by or []) + ["COD_ENCUESTAS"]
     
-    dicgen = {1: 'THOM', 2: 'TMUJ'}
+    # Code of the dwelling of each row, in sorted order of the keys
+    group = perestudio.groupby(keys, sort=True).ngroup().to_numpy()
+    valid = group >= 0
+    ngroups = group.max() + 1 if valid.any() else 0
     
-    permpio = pd.DataFrame(columns = ['COD_ENCUESTAS',
-                                  'THOG', 'TPER', 'THOM', 'TMUJ', 
-                                  'T00', 'T05', 'T10', 'T15', 'T20', 
-                                  'T25', 'T30', 'T35', 'T40', 'T45', 
-                                  'T50', 'T55', 'T60', 'T65', 'T70', 
-                                  'T75', 'T80', 'T85', 'T90', 'T95', 'T100'])
+    if ngroups == 0:
+        return pd.DataFrame(columns = keys + PERSONAS_COLUMNS)
+    
+    last = np.empty(ngroups, dtype=np.int64)
+    last[group[valid]] = np.flatnonzero(valid)
+    personas = perestudio[keys].iloc[last].reset_index(drop=True)
+    
+    def coded(col):
+        codes, labels = pd.factorize(perestudio[col], sort=True)
+        ok = valid & (codes >= 0)
+        return group[ok].astype(np.int64) * len(labels) + codes[ok], labels
+    
+    # Number of distinct households and persons
+    for col, name in [("P_NROHOG", "THOG"), ("P_NRO_PER", "TPER")]:
+        pairs, labels = coded(col)
+        personas[name] = np.bincount(np.unique(pairs) // max(len(labels), 1), minlength=ngroups)
+    
+    # Number of persons by sex and age group
+    keep = np.ones(ngroups, dtype=bool)
+    extra = []
+    for col, names in [("P_SEXO", DICGEN), ("P_EDADR", DICEDAD)]:
+        pairs, labels = coded(col)
+        counts = np.bincount(pairs, minlength=ngroups * len(labels)).reshape(ngroups, len(labels))
+        keep &= counts.sum(axis=1) > 0
+        
+        for i, label in enumerate(labels):
+            personas[names.get(label, label)] = counts[:, i]
+            if label not in names:
+                extra.append(label)
     
-    pdnro = perestudio.groupby(["COD_ENCUESTAS"])[["P_NROHOG", "P_NRO_PER"]].nunique().reset_index()
-    psexo = perestudio.groupby(["COD_ENCUESTAS", "P_SEXO"]).size().unstack(fill_value=0).reset_index()
-    pedad = perestudio.groupby(["COD_ENCUESTAS", "P_EDADR"]).size().unstack(fill_value=0).reset_index()
+    for name in PERSONAS_COLUMNS:
+        if name not in personas:
+            personas[name] = 0
     
-    pdnro.rename(columns = {"P_NROHOG": "THOG", "P_NRO_PER": "TPER"}, inplace=True)
-    psexo.rename(columns = dicgen, inplace=True)
-    pedad.rename(columns = dicedad, inplace=True)
+    personas = personas.loc[keep, keys + PERSONAS_COLUMNS + extra].reset_index(drop=True)
+    
+    return personas
+
+
+def popcount(masks):
+    """
+    Number of bits set in each value of an int64 array.
+    """
+    bits = np.unpackbits(np.ascontiguousarray(masks, dtype=np.int64).view(np.uint8).reshape(-1, 8), axis=1)
+    
+    return bits.sum(axis=1)
+
+
+def organize_personas_chunked(chunks, by=None):
+    """
+    Streaming version of organize_personas. The PER data is consumed chunk by chunk and
+    only per COD_ENCUESTAS accumulators are kept: the sex and age counts are added, and
+    the distinct P_NROHOG and P_NRO_PER values of each dwelling are kept as bitmasks
+    (bit v is set if the value v was seen), so that the number of households and persons
+    is the number of bits set. Values outside 0..62 are kept as distinct pairs. The memory
+    is proportional to the number of dwellings instead of the number of persons.
+
+    Parameters
+    ----------
+    chunks : iterable of pandas DataFrame
+        Filtered PER data by chunks with P_NROHOG filled, e.g. iter_personas. A dwelling
+        may span several chunks.
+    by : list, optional
+        Same as organize_personas. The default is None.
+
+    Returns
+    -------
+    personas : pandas DataFrame
+        Same as organize_personas(pd.concat(chunks), by).
+
+    """
+    keys = (by or []) + ["COD_ENCUESTAS"]
+    distinct = {"P_NROHOG": "THOG", "P_NRO_PER": "TPER"}
+    
+    sex_parts, age_parts, size_parts = [], [], []
+    mask_parts = {col: [] for col in distinct}
+    extra_parts = {col: [] for col in distinct}
+    key_dtypes = None
+    
+    for chunk in chunks:
+        if key_dtypes is None:
+            key_dtypes = chunk[keys].dtypes.to_dict()
+        size_parts.append(chunk.groupby(keys).size())
+        sex_parts.append(chunk.groupby(keys + ["P_SEXO"]).size())
+        age_parts.append(chunk.groupby(keys + ["P_EDADR"]).size())
+        
+        for col in distinct:
+            pairs = chunk[keys + [col]].dropna().drop_duplicates()
+            values = pairs[col].astype("float64").to_numpy()
+            small = (values >= 0) & (values < 63) & (values == np.floor(values))
+            
+            # Sum of distinct powers of two == bitwise or
+            bits = pairs[keys][small].assign(BITS=np.left_shift(1, values[small].astype(np.int64)))
+            mask_parts[col].append(bits.groupby(keys)["BITS"].sum())
+            extra_parts[col].append(pairs[~small])
+    
+    if not size_parts:
+        return organize_personas(pd.DataFrame(columns=keys + ["P_NROHOG", "P_NRO_PER", "P_SEXO", "P_EDADR"]), by)
+    
+    levels = list(range(len(keys) + 1))
+    dwellings = pd.concat(size_parts).groupby(level=list(range(len(keys)))).sum().index
+    
+    pdnro = pd.DataFrame(index=dwellings)
+    for col, name in distinct.items():
+        # Masks of the same dwelling in several chunks are or-ed
+        masks = pd.concat(mask_parts[col]).sort_index()
+        starts = np.flatnonzero(~masks.index.duplicated())
+        nunique = pd.Series(popcount(np.bitwise_or.reduceat(masks.to_numpy(), starts)) if len(starts) else [],
+                            index=masks.index[starts], dtype="int64")
+        
+        extra = pd.concat(extra_parts[col]).drop_duplicates()
+        nunique = nunique.add(extra.groupby(keys).size(), fill_value=0)
+        
+        pdnro[name] = nunique.reindex(dwellings, fill_value=0).astype("int64")
+    
+    pdnro = pdnro.reset_index()
+    psexo = pd.concat(sex_parts).groupby(level=levels).sum().unstack(fill_value=0).reset_index()
+    pedad = pd.concat(age_parts).groupby(level=levels).sum().unstack(fill_value=0).reset_index()
+    
+    psexo.rename(columns = DICGEN, inplace=True)
+    pedad.rename(columns = DICEDAD, inplace=True)
     
     dfs = [pdnro, psexo, pedad]
-    personas = reduce(lambda left, right: pd.merge(left,right,on='COD_ENCUESTAS'), dfs)
+    personas = reduce(lambda left, right: pd.merge(left,right,on=keys), dfs)
     
-    personas = permpio.append(personas).fillna(0)
+    # Same columns and dtypes as organize_personas, the sex and age groups without persons are 0
+    extra = [col for col in personas.columns if col not in keys + PERSONAS_COLUMNS]
+    personas = personas.reindex(columns=keys + PERSONAS_COLUMNS + extra, fill_value=0).astype(key_dtypes)
     
     return personas
 
 
-def groupby_mode(result, *args):
+def iter_personas(folder_path, dptocod, depto, engine=None, cache_dir=None, filters=None, chunksize=10**6):
+    """
+    PER data of a department by chunks, from the columnar cache if it is valid or from
+    the CSV file. P_NROHOG is filled as in filter_files.
+
+    Parameters
+    ----------
+    folder_path : string (path)
+        Path to folder which contains folders and DANE files.
+    dptocod : str
+        Code of the department.
+    depto : str
+        Name of the department.
+    engine : str, optional
+        pandas.read_csv parser engine. The default is None.
+    cache_dir : string (path), optional
+        Root folder of the columnar cache. The default is None.
+    filters : list, optional
+        PER predicates, see pushdown_filters. The default is None.
+    chunksize : int, optional
+        Number of rows of each chunk. The default is 10**6.
+
+    Yields
+    ------
+    chunk : pandas DataFrame
+        PER data.
+
+    """
+    sources, cache_path = cache.department_paths(folder_path, dptocod, depto, cache_dir)
+    
+    if cache.is_cached(cache_path, 'PER', sources['PER']):
+        chunks = cache.iter_file(cache_path, 'PER', filters, chunksize)
+    else:
+        chunks = cnpv_io.iter_cnpv(sources['PER'], 'PER', engine=engine, filters=filters, chunksize=chunksize)
+    
+    for chunk in chunks:
+        chunk["P_NROHOG"] = chunk["P_NROHOG"].fillna(1)
+        yield chunk
+
+
+def mode_aggregate(result, sumcols, seed=None):
+    """
+    Group DataFrame by U_EDIFICA, sums the 'sumcols' variables and applies the conditional
+    mode (see conditional_mode) to the MAT and TIPO_VIV variables of each building.
+
+    Parameters
+    ----------
+    result : pandas DataFrame
+        DataFrame containing all data merged.
+    sumcols : list
+        Columns to be summed. THOG and TPER must be the first two.
+    seed : int, optional
+        Seed for the TIPO_VIV random tie-break, drawn by building (see conditional_mode).
+        The default is None.
+
+    Returns
+    -------
+    result_mode : pandas DataFrame
+        DataFrame grouped by building.
+
+    """
+    keys = ["U_MPIO", "UA_CLASE", "U_SECT_RUR", "U_SECC_RUR", "UA2_CPOB", "U_SECT_URB", "U_SECC_URB", "U_MZA", "U_EDIFICA"]
+    modes = {'V_MAT_PARED': (0, None),
+             'V_MAT_PISO': (0, None),
+             'V_TIPO_VIV': (3, (1, 3)),
+             'VA1_ESTRATO': (0, None)}
+    
+    grouped = result.groupby(keys)
+    result_mode = grouped[sumcols].sum()
+    
+    ngroup = grouped.ngroup().to_numpy()
+    valid = ngroup >= 0
+    # The random tie-break of each building only depends on its keys, a department gives the same
+    # draws as each municipality alone, with or without the CLASE filter applied while reading
+    buildings = result_mode.index.to_frame(index=False)
+    for col, (excluded, fallback) in modes.items():
+        result_mode[col] = conditional_mode(ngroup[valid], result[col].to_numpy()[valid], 
+                                            excluded, fallback, seed, buildings)
+    
+    result_mode = result_mode[sumcols[:2] + list(modes) + sumcols[2:]].reset_index()
+    
+    return result_mode
+
+
+def groupby_mode(result, *args, seed=None):
     """
     Group DataFrame by MPIO, counts U_EDIFICA and other variables
 
@@ -298,6 +716,9 @@ def groupby_mode(result, *args):
         DataFrame containing all data merged.
     *args : boolean, optional
         True --> Include age groups in the group by.
+    seed : int, optional
+        Seed for the random TIPO_VIV assigned to buildings with only 'Tipo Cuarto' dwellings.
+        The default is None (global numpy random state).
 
     Returns
     -------
@@ -307,39 +728,24 @@ def groupby_mode(result, *args):
         DataFrame with data grouped by MPIO, MATER.
 
     """
-    try:
-        
-        if True in args:
-            result_mode = result.groupby(["U_MPIO", "UA_CLASE", "U_SECT_RUR", "U_SECC_RUR", "UA2_CPOB", "U_SECT_URB", "U_SECC_URB", "U_MZA",\
-                                "U_EDIFICA"]).agg({'THOG':['sum'], 'TPER':['sum'], 'V_MAT_PARED': func_mode,
-                                      'V_MAT_PISO': func_mode, 'V_TIPO_VIV': func_mode_tviv, 'VA1_ESTRATO':func_mode, 'THOM':['sum'], 'TMUJ':['sum'], 
-                                      'T00':['sum'], 'T05':['sum'], 'T10':['sum'], 'T15':['sum'], 'T20':['sum'], 
-                                      'T25':['sum'], 'T30':['sum'], 'T35':['sum'], 'T40':['sum'], 'T45':['sum'], 
-                                      'T50':['sum'], 'T55':['sum'], 'T60':['sum'], 'T65':['sum'], 'T70':['sum'], 
-                                      'T75':['sum'], 'T80':['sum'], 'T85':['sum'], 'T90':['sum'], 'T95':['sum'], 'T100':['sum']}).reset_index()
-                                                   
-            result_mode.columns = result_mode.columns.get_level_values(0)                                     
-            result_nedif = result_mode.groupby(["U_MPIO", "UA_CLASE", "U_SECT_RUR", "U_SECC_RUR", "UA2_CPOB", "U_SECT_URB", "U_SECC_URB", "U_MZA", "V_MAT_PARED",\
-                                                "V_MAT_PISO", "V_TIPO_VIV", 'VA1_ESTRATO']).agg({"U_EDIFICA": ['count'], 'TPER':['sum'], 'THOG':['sum'], 'THOM':['sum'], 'TMUJ':['sum'], 
-                                                'T00':['sum'], 'T05':['sum'], 'T10':['sum'], 'T15':['sum'], 'T20':['sum'], 
-                                                'T25':['sum'], 'T30':['sum'], 'T35':['sum'], 'T40':['sum'], 'T45':['sum'], 
-                                                'T50':['sum'], 'T55':['sum'], 'T60':['sum'], 'T65':['sum'], 'T70':['sum'], 
-                                                'T75':['sum'], 'T80':['sum'], 'T85':['sum'], 'T90':['sum'], 'T95':['sum'], 'T100':['sum']}).reset_index()
-            result_nedif.columns = result_nedif.columns.get_level_values(0)
-        else:
-                 
-            result_mode = result.groupby(["U_MPIO", "UA_CLASE", "U_SECT_RUR", "U_SECC_RUR", "UA2_CPOB", "U_SECT_URB", "U_SECC_URB", "U_MZA",\
-                                   "U_EDIFICA"]).agg({'THOG':['sum'], 'TPER':['sum'], "V_MAT_PARED": func_mode,
-                                       "V_MAT_PISO": func_mode, 'V_TIPO_VIV': func_mode_tviv, 'VA1_ESTRATO': func_mode}).reset_index()
-                                                      
-            result_mode.columns = result_mode.columns.get_level_values(0) 
-        
-            result_nedif = result_mode.groupby(["U_MPIO", "UA_CLASE", "V_MAT_PARED",\
-                                    "V_MAT_PISO", 'V_TIPO_VIV', 'VA1_ESTRATO']).agg({"U_EDIFICA": ['count'], 'TPER':['sum'], 'THOG':['sum']}).reset_index()                                                                      
-            result_nedif.columns = result_nedif.columns.get_level_values(0)
-    except Exception as e:
-        print(e)
-        pass
+    if True in args:
+        result_mode = mode_aggregate(result, ['THOG', 'TPER', 'THOM', 'TMUJ', 
+                                  'T00', 'T05', 'T10', 'T15', 'T20', 
+                                  'T25', 'T30', 'T35', 'T40', 'T45', 
+                                  'T50', 'T55', 'T60', 'T65', 'T70', 
+                                  'T75', 'T80', 'T85', 'T90', 'T95', 'T100'], seed)
+        result_nedif = result_mode.groupby(["U_MPIO", "UA_CLASE", "U_SECT_RUR", "U_SECC_RUR", "UA2_CPOB", "U_SECT_URB", "U_SECC_URB", "U_MZA", "V_MAT_PARED",\
+                                            "V_MAT_PISO", "V_TIPO_VIV", 'VA1_ESTRATO']).agg({"U_EDIFICA": ['count'], 'TPER':['sum'], 'THOG':['sum'], 'THOM':['sum'], 'TMUJ':['sum'], 
+                                            'T00':['sum'], 'T05':['sum'], 'T10':['sum'], 'T15':['sum'], 'T20':['sum'], 
+                                            'T25':['sum'], 'T30':['sum'], 'T35':['sum'], 'T40':['sum'], 'T45':['sum'], 
+                                            'T50':['sum'], 'T55':['sum'], 'T60':['sum'], 'T65':['sum'], 'T70':['sum'], 
+                                            'T75':['sum'], 'T80':['sum'], 'T85':['sum'], 'T90':['sum'], 'T95':['sum'], 'T100':['sum']}).reset_index()
+        result_nedif.columns = result_nedif.columns.get_level_values(0)
+    else:
+        result_mode = mode_aggregate(result, ['THOG', 'TPER'], seed)
+        result_nedif = result_mode.groupby(["U_MPIO", "UA_CLASE", "V_MAT_PARED",\
+                                "V_MAT_PISO", 'V_TIPO_VIV', 'VA1_ESTRATO']).agg({"U_EDIFICA": ['count'], 'TPER':['sum'], 'THOG':['sum']}).reset_index()                                                                      
+        result_nedif.columns = result_nedif.columns.get_level_values(0)
 
     return result_mode, result_nedif
 
@@ -351,8 +757,8 @@ def write_results(result_dptos, result_mode, result_nedif, filtClase, cod, codmp
 
     Parameters
     ----------
-    result_dptos : pandas DataFrame
-        DataFrame containing results grouped by MAT.
+    result_dptos : utilities.ResultCollector
+        Collector of the results grouped by MAT.
     result_mode : pandas DataFrame
         DESCRIPTION.
     result_nedif : pandas DataFrame
@@ -365,31 +771,33 @@ def write_results(result_dptos, result_mode, result_nedif, filtClase, cod, codmp
         DESCRIPTION.
     dptocod : int
         DESCRIPTION.
-    resumen_mpios : pandas DataFrame, optional
-        DataFrame containing results grouped by MPIO and age groups. The default is None.
+    resumen_mpios : utilities.ResultCollector, optional
+        Collector of the results grouped by MPIO and age groups. The default is None.
     *args : boolean, optional
         True --> Include age groups in the group by.
 
     Returns
     -------
-    result_dptos : pandas DataFrame
-        DataFrame containing results grouped by MAT and with numerical values modified by strings.
-    resumen_mpios : pandas DataFrame, optional
-        DataFrame containing results grouped by MPIO and age groups. The default is None.
+    result_nedifstr : pandas DataFrame
+        Results grouped by MAT of the municipality, with the codes of the MAT combination
+        (see label_combinations).
+    result_dptos : utilities.ResultCollector
+        Same collector, with result_nedifstr added.
+    resumen_mpios : utilities.ResultCollector, optional
+        Same collector, with the results grouped by block and age groups added. The default is None.
 
     """
     try:
         if True in args:
             
             if resumen_mpios is not None:
-                resumen_mpios = resumen_mpios.append(result_mode[result_mode["UA_CLASE"].isin(filtClase)].groupby(["U_MPIO", "UA_CLASE", "U_SECT_RUR", 
+                resumen_mpios.add(result_mode[result_mode["UA_CLASE"].isin(filtClase)].groupby(["U_MPIO", "UA_CLASE", "U_SECT_RUR", 
                                                                                                                    "U_SECC_RUR", "UA2_CPOB", "U_SECT_URB", "U_SECC_URB", "U_MZA"
                                                      ]).agg({"U_EDIFICA": ['count'], 'TPER':['sum'], 'THOG':['sum'], 'THOM':['sum'], 'TMUJ':['sum'], 
                                                     'T00':['sum'], 'T05':['sum'], 'T10':['sum'], 'T15':['sum'], 'T20':['sum'], 
                                                     'T25':['sum'], 'T30':['sum'], 'T35':['sum'], 'T40':['sum'], 'T45':['sum'], 
                                                     'T50':['sum'], 'T55':['sum'], 'T60':['sum'], 'T65':['sum'], 'T70':['sum'], 
-                                                    'T75':['sum'], 'T80':['sum'], 'T85':['sum'], 'T90':['sum'], 'T95':['sum'], 'T100':['sum']}).reset_index(), 
-                                                    ignore_index=True)
+                                                    'T75':['sum'], 'T80':['sum'], 'T85':['sum'], 'T90':['sum'], 'T95':['sum'], 'T100':['sum']}).reset_index())
                                                                                                 
                 result_nedifstr = result_nedif[result_nedif["UA_CLASE"].isin(filtClase)].copy() 
 
@@ -412,21 +820,9 @@ def write_results(result_dptos, result_mode, result_nedif, filtClase, cod, codmp
     if len(result_nedif) != 0:
     
         result_nedifstr.loc[:, "No. total edificaciones"] = result_nedif['U_EDIFICA'].sum()
-        
-        result_nedifstr.loc[:, 'V_MAT_PARED'] = \
-            result_nedifstr.loc[:, 'V_MAT_PARED'].apply(lambda x: cambio_variable('V_MAT_PARED_VS1', int(x))).to_list()
     
-        result_nedifstr.loc[:, 'V_MAT_PISO'] = \
-            result_nedifstr.loc[:, 'V_MAT_PISO'].apply(lambda x: cambio_variable('V_MAT_PISO_VS1', int(x))).to_list()
-    
-        result_nedifstr.loc[:, 'V_TIPO_VIV'] = \
-            result_nedifstr.loc[:, 'V_TIPO_VIV'].apply(lambda x: cambio_variable('V_TIPO_VIV_VS1', int(x))).to_list()
-    
-        result_nedifstr.loc[:, 'VA1_ESTRATO'] = \
-            result_nedifstr.loc[:, 'VA1_ESTRATO'].apply(lambda x: cambio_variable('VA1_ESTRATO_VS1', int(x))).to_list()
-        
-        
-    result_dptos = result_dptos.append(result_nedifstr, ignore_index=True)
+    # The MAT combination keeps its codes, the labels are set in func_principal
+    result_dptos.add(result_nedifstr)
     
     if True in args:
         return result_nedifstr, result_dptos, resumen_mpios
@@ -441,24 +837,24 @@ def write_resumen(resumen_dptos, result_mode, result_nedif, mpio, cod):
 
     Parameters
     ----------
-    resumen_dptos : pandas DataFrame
-        DataFrame containing results grouped by MPIO.
+    resumen_dptos : utilities.ResultCollector
+        Collector of the results grouped by MPIO.
     result_mode : pandas DataFrame
         DESCRIPTION.
     result_nedif : pandas DataFrame
         DESCRIPTION.
-    mpio : pandas Series
+    mpio : municipios.Municipio
         Municipality data.
-    cod : int
+    cod : str
         Code.
 
     Returns
     -------
-    resumen_dptos : pandas DataFrame
-        DataFrame containing results grouped by MPIO.
+    resumen_dptos : utilities.ResultCollector
+        Same collector, with the summary of the municipality added.
 
     """
-    resumen_dptos = resumen_dptos.append({'Departamento': (mpio[1]["Departamento"]),
+    resumen_dptos.add_record({'Departamento': mpio.dpto,
                                   'Cod': cod,
                                   'Personas C. Municipal': result_mode[result_mode["UA_CLASE"] == 1]["TPER"].sum(),
                                   'Personas C. Poblado': result_mode[result_mode["UA_CLASE"] == 2]["TPER"].sum(),
@@ -468,11 +864,579 @@ def write_resumen(resumen_dptos, result_mode, result_nedif, mpio, cod):
                                    'Edificaciones C. Poblado': result_mode[result_mode["UA_CLASE"] == 2]["U_EDIFICA"].count(),
                                    'Edificaciones Rural Disperso y Resto': result_mode[result_mode["UA_CLASE"].isin([3, 4])]["U_EDIFICA"].count(),
                                   'Total edificaciones': result_nedif['U_EDIFICA'].sum()
-                                  }, ignore_index =True)
+                                  })
     return resumen_dptos
 
 
-def func_principal(folder_path, deptcod, deptname, filtClase, filtUnidad, filtViv, *args):
+def merge_municipality(vivestudio, mgnestudio, perestudio=None, personas=None):
+    """
+    Merge the VIV, MGN and PER data of a municipality by COD_ENCUESTAS.
+
+    Parameters
+    ----------
+    vivestudio : pandas DataFrame
+        VIV data of the municipality.
+    mgnestudio : pandas DataFrame
+        MGN data of the municipality.
+    perestudio : pandas DataFrame, optional
+        PER data of the municipality, organized with organize_personas. The default is None.
+    personas : pandas DataFrame, optional
+        PER data already organized (streaming). The default is None.
+
+    Returns
+    -------
+    result : pandas DataFrame
+        Merged data, one row for each dwelling.
+
+    """
+    if personas is None:
+        personas = organize_personas(perestudio)
+    
+    dfs = [vivestudio[["COD_ENCUESTAS", "V_MAT_PARED", "V_MAT_PISO", 'V_TIPO_VIV', 'VA1_ESTRATO']],
+           mgnestudio[["COD_ENCUESTAS", "U_MPIO", "UA_CLASE", "U_SECT_RUR", "U_SECC_RUR", "UA2_CPOB", "U_SECT_URB", "U_SECC_URB", "U_MZA", \
+                      "U_EDIFICA", "COD_DANE_ANM"]],                   
+               personas]
+        
+    result = reduce(lambda left,right: pd.merge(left,right,on='COD_ENCUESTAS', how='left'), dfs)
+    
+    result = result.drop_duplicates()
+    
+    result = result.fillna(0)
+    
+    return result
+
+
+def merge_department(mgn, viv, per, u_mpios, personas=None):
+    """
+    Batched version of merge_municipality. Merges the VIV, MGN and PER data of the
+    municipalities u_mpios by U_MPIO and COD_ENCUESTAS.
+
+    Returns
+    -------
+    result : pandas DataFrame
+        Merged data, one row for each dwelling.
+
+    """
+    viv = viv[viv["U_MPIO"].isin(u_mpios)]
+    
+    if personas is None:
+        personas = organize_personas(per[per["U_MPIO"].isin(u_mpios)], ["U_MPIO"])
+    
+    personas = personas[personas["U_MPIO"].isin(u_mpios)].rename(columns={"U_MPIO": "MPIO_PART"})
+    
+    dfs = [viv[["U_MPIO", "COD_ENCUESTAS", "V_MAT_PARED", "V_MAT_PISO", 'V_TIPO_VIV', 'VA1_ESTRATO']].rename(columns={"U_MPIO": "MPIO_PART"}),
+           mgn[["U_MPIO", "COD_ENCUESTAS", "UA_CLASE", "U_SECT_RUR", "U_SECC_RUR", "UA2_CPOB", "U_SECT_URB", "U_SECC_URB", "U_MZA", \
+                "U_EDIFICA", "COD_DANE_ANM"]].assign(MPIO_PART=mgn["U_MPIO"]),
+           personas]
+    
+    result = reduce(lambda left,right: pd.merge(left,right,on=['MPIO_PART', 'COD_ENCUESTAS'], how='left'), dfs)
+    
+    result = result.drop_duplicates()
+    
+    result = result.fillna(0)
+    
+    return result
+
+
+def run_stage(stage_cache, key, func, *args, **kwargs):
+    """
+    Run a stage of the pipeline, func(*args, **kwargs), through the stage cache (see
+    checkpoint.StageCache). The stage is always calculated if stage_cache or key is None.
+    """
+    if stage_cache is None or key is None:
+        return func(*args, **kwargs)
+    
+    return stage_cache.memoize(key, func, *args, **kwargs)
+
+
+def batch_department(mgn, viv, per, mpios_dpto, dptocod, filtClase, *args, seed=None, personas=None, stage_cache=None, keys=None):
+    """
+    Batched alternative to the municipality loop of func_principal. Organizes, merges,
+    groups and writes the results of all the municipalities of a department at once,
+    with every grouped operation keyed by U_MPIO. Assumes that every VIV record has
+    its MGN record, as in the CNPV files.
+
+    Parameters
+    ----------
+    mgn : pandas DataFrame
+        Filtered MGN data of the department.
+    viv : pandas DataFrame
+        Filtered VIV data of the department.
+    per : pandas DataFrame
+        Filtered PER data of the department.
+    mpios_dpto : tuple
+        Municipalities of the department, see municipios.MunicipalityRegistry.department.
+    dptocod : str
+        Code of the department.
+    filtClase : list
+        List containing Clase filter options.
+    *args : booleans
+        Same as func_principal. 1st position -> age groups, 2nd position -> municipality summary.
+    seed : int, optional
+        Seed for the TIPO_VIV random tie-break (see groupby_mode). The default is None.
+    personas : pandas DataFrame, optional
+        PER data already organized by U_MPIO and COD_ENCUESTAS (see organize_personas_chunked).
+        The default is None (organized from per).
+    stage_cache : checkpoint.StageCache, optional
+        Cache of the merge and mode stages. The default is None.
+    keys : dict, optional
+        {U_MPIO: fingerprint} of the data of the municipalities (see municipality_keys),
+        required by stage_cache. The default is None.
+
+    Returns
+    -------
+    result_nedifstr : pandas DataFrame
+        Results grouped by MAT of all the municipalities.
+    resumen_dpto : pandas DataFrame
+        Summary by municipality (empty if not requested).
+    resumen_mpio : pandas DataFrame
+        Results grouped by block and age groups (empty if not requested).
+    result_mode : pandas DataFrame
+        Data grouped by building of all the municipalities.
+    result_nedif : pandas DataFrame
+        Data grouped by MPIO, MATER of all the municipalities.
+
+    """
+    # Municipality code (U_MPIO) --> municipality data
+    present = set(viv["U_MPIO"].unique())
+    mpios = {mpio.u_mpio: mpio for mpio in mpios_dpto if mpio.u_mpio in present}
+    cods = pd.Series({u_mpio: mpio.code for u_mpio, mpio in mpios.items()}, dtype=object)
+    
+    #%% MGV, VIV, PER dataframes are merged by municipality and COD_ENCUESTAS
+    
+    merge_key = mode_key = None
+    if keys is not None:
+        merge_key = ck.fingerprint('merge_department', [keys.get(u_mpio) for u_mpio in mpios], personas is not None)
+        # The mode is only reused when the random tie-break is reproducible
+        mode_key = ck.fingerprint('mode', merge_key, bool(args[0]), seed) if seed is not None else None
+    
+    result = run_stage(stage_cache, merge_key, merge_department, mgn, viv, per, list(mpios), personas)
+    
+    #%% Group and write the results of all municipalities
+    
+    resumen_mpio = pd.DataFrame()
+    if True == args[0]:
+        result_mode, result_nedif = run_stage(stage_cache, mode_key, groupby_mode, result, True, seed=seed)
+        
+        resumen_mpio = result_mode[result_mode["UA_CLASE"].isin(filtClase)].groupby(["U_MPIO", "UA_CLASE", "U_SECT_RUR", 
+                                                                                    "U_SECC_RUR", "UA2_CPOB", "U_SECT_URB", "U_SECC_URB", "U_MZA"
+                                     ]).agg({"U_EDIFICA": ['count'], 'TPER':['sum'], 'THOG':['sum'], 'THOM':['sum'], 'TMUJ':['sum'], 
+                                    'T00':['sum'], 'T05':['sum'], 'T10':['sum'], 'T15':['sum'], 'T20':['sum'], 
+                                    'T25':['sum'], 'T30':['sum'], 'T35':['sum'], 'T40':['sum'], 'T45':['sum'], 
+                                    'T50':['sum'], 'T55':['sum'], 'T60':['sum'], 'T65':['sum'], 'T70':['sum'], 
+                                    'T75':['sum'], 'T80':['sum'], 'T85':['sum'], 'T90':['sum'], 'T95':['sum'], 'T100':['sum']}).reset_index()
+        
+        # As write_results, the total of buildings includes all the CLASE values
+        result_total = result_nedif
+        result_nedifstr = result_nedif[result_nedif["UA_CLASE"].isin(filtClase)].copy()
+    else:
+        result_mode, result_nedif = run_stage(stage_cache, mode_key, groupby_mode, result, False, seed=seed)
+        
+        result_filt = result_mode[result_mode["UA_CLASE"].isin(filtClase)]
+        result_total = result_filt.groupby(["U_MPIO", "V_MAT_PARED",\
+                                "V_MAT_PISO", 'V_TIPO_VIV', 'VA1_ESTRATO']).agg({"U_EDIFICA": ['count'], 'TPER':['sum'], 'THOG':['sum']}).reset_index()                                                                      
+        result_total.columns = result_total.columns.get_level_values(0)
+        result_nedifstr = result_total.copy()
+    
+    result_nedifstr.insert(0, 'cod', result_nedifstr["U_MPIO"].map(cods))
+    
+    if len(result_nedifstr) != 0:
+        
+        # int64 as the scalar sum of write_results (the count of U_EDIFICA may be nullable Int64)
+        result_nedifstr.loc[:, "No. total edificaciones"] = \
+            result_nedifstr["U_MPIO"].map(result_total.groupby("U_MPIO")['U_EDIFICA'].sum()).astype(np.int64)
+    
+    resumen_dpto = pd.DataFrame()
+    if True == args[1]:
+        resumen_dpto = write_resumen_batch(result_mode, result_nedif, mpios)
+    
+    return result_nedifstr, resumen_dpto, resumen_mpio, result_mode, result_nedif
+
+
+def write_resumen_batch(result_mode, result_nedif, mpios):
+    """
+    Batched version of write_resumen. Writes the summary of every municipality at once.
+
+    Parameters
+    ----------
+    result_mode : pandas DataFrame
+        Data grouped by building of all the municipalities.
+    result_nedif : pandas DataFrame
+        Data grouped by MPIO, MATER of all the municipalities.
+    mpios : dict
+        Dictionary {U_MPIO: municipios.Municipio} with the municipalities in output order.
+
+    Returns
+    -------
+    resumen_dpto : pandas DataFrame
+        DataFrame containing results grouped by MPIO.
+
+    """
+    by = result_mode["U_MPIO"]
+    clase = result_mode["UA_CLASE"]
+    rural = clase.isin([3, 4])
+    
+    resumen_dpto = pd.DataFrame({'Departamento': [mpio.dpto for mpio in mpios.values()],
+                                 'Cod': [mpio.code for mpio in mpios.values()]}, index=list(mpios))
+    resumen_dpto['Personas C. Municipal'] = result_mode["TPER"].where(clase == 1, 0).groupby(by).sum()
+    resumen_dpto['Personas C. Poblado'] = result_mode["TPER"].where(clase == 2, 0).groupby(by).sum()
+    resumen_dpto['Personas Rural Disperso y Resto'] = result_mode["TPER"].where(rural, 0).groupby(by).sum()
+    resumen_dpto['Total personas'] = result_nedif.groupby("U_MPIO")['TPER'].sum()
+    resumen_dpto['Edificaciones C. Municipal'] = (clase == 1).groupby(by).sum()
+    resumen_dpto['Edificaciones C. Poblado'] = (clase == 2).groupby(by).sum()
+    resumen_dpto['Edificaciones Rural Disperso y Resto'] = rural.groupby(by).sum()
+    resumen_dpto['Total edificaciones'] = result_nedif.groupby("U_MPIO")['U_EDIFICA'].sum()
+    
+    resumen_dpto = resumen_dpto.fillna(0).reset_index(drop=True)
+    resumen_dpto['Total edificaciones'] = resumen_dpto['Total edificaciones'].astype(np.int64)
+    
+    return resumen_dpto
+
+
+def department_inputs(folder_path, dptocod, depto, checkpoint):
+    """
+    Fingerprint of the MGN, VIV, PER files of a department, used to skip the departments
+    already saved in the checkpoints without reading them. The checksums are saved in the
+    store and reused while the size and modification time of the files do not change.
+
+    Parameters
+    ----------
+    folder_path : string (path)
+        Path to folder which contains folders and DANE files.
+    dptocod : str
+        Code of the department.
+    depto : str
+        Name of the department.
+    checkpoint : checkpoint.CheckpointStore
+        Store of the checkpoints.
+
+    Returns
+    -------
+    str or None
+        Fingerprint of the files, None if any CSV file does not exist (e.g. only the
+        columnar cache is available).
+
+    """
+    sources, _ = cache.department_paths(folder_path, dptocod, depto)
+    if not all(os.path.exists(source) for source in sources.values()):
+        return None
+    
+    group = str(dptocod) + depto
+    previous = checkpoint.get(group, 'fuentes', 'info') or {}
+    info = {filetype: cache.source_info(source, previous.get(filetype)) for filetype, source in sources.items()}
+    checkpoint.put(group, 'fuentes', 'info', info)
+    
+    return ck.fingerprint(sorted((filetype, entry['sha1']) for filetype, entry in info.items()))
+
+
+def municipality_keys(mgn, viv, per):
+    """
+    Fingerprint of the MGN, VIV, PER data of every municipality (U_MPIO) in viv. A
+    municipality is recalculated only when its fingerprint changes.
+
+    Returns
+    -------
+    dict
+        {U_MPIO: hexadecimal SHA-1}.
+
+    """
+    fingerprints = [ck.partition_fingerprints(df) for df in (mgn, viv, per)]
+    
+    return {u_mpio: ck.fingerprint(*[fp.get(u_mpio) for fp in fingerprints]) for u_mpio in fingerprints[1]}
+
+
+def split_department(result_nedifstr, resumen_dpto, resumen_mpio, mpios_dpto):
+    """
+    Split the results of batch_department by municipality.
+
+    Returns
+    -------
+    parts : dict
+        {U_MPIO: (result_nedifstr, resumen_dpto, resumen_mpio)} of each municipality.
+
+    """
+    def by(df, col, values):
+        groups = dict(tuple(df.groupby(col, sort=False))) if col in df else {}
+        empty = df.iloc[:0] if col in df else df
+        return [groups.get(value, empty).reset_index(drop=True) for value in values]
+    
+    codes = [mpio.code for mpio in mpios_dpto]
+    u_mpios = [mpio.u_mpio for mpio in mpios_dpto]
+    
+    return dict(zip(u_mpios, zip(by(result_nedifstr, 'cod', codes), by(resumen_dpto, 'Cod', codes),
+                                 by(resumen_mpio, 'U_MPIO', u_mpios))))
+
+
+def process_department(folder_path, dptocod, depto, filtClase, filtUnidad, filtViv, *args, batch=False, seed=None, engine=None, stream_per=False, checkpoint=None,
+                       stage_cache=None):
+    """
+    Read, filter, organize, group and write the results of a single department.
+    func_principal calls it for every department, sequentially or in worker processes.
+
+    Parameters
+    ----------
+    folder_path : string (path)
+        Path to folder which contains folders and DANE files.
+    dptocod : str
+        Code of the department.
+    depto : str
+        Name of the department.
+    filtClase : list
+        List containing Clase filter options.
+    filtUnidad : list
+        List containing Uso filter options.
+    filtViv : list
+        List containing Tipo_Vivienda filter options.
+    *args : booleans
+        Same as func_principal.
+    batch : boolean, optional
+        Same as func_principal. The default is False.
+    seed : int, optional
+        Same as func_principal. The default is None.
+    engine : str, optional
+        Same as func_principal. The default is None.
+    stream_per : boolean, optional
+        Same as func_principal. The default is False.
+    checkpoint : checkpoint.CheckpointStore, optional
+        Store where the results of every municipality are saved. Municipalities already
+        saved with the same data and parameters are not recalculated, and departments whose
+        files did not change are not read. The default is None.
+    stage_cache : checkpoint.StageCache, optional
+        Cache of the merge and mode stages of every municipality, keyed by the fingerprint
+        of its data. The stages do not depend on filtClase, so runs that only change it
+        reuse them. The mode stage is only cached when seed is given. The default is None.
+
+    Returns
+    -------
+    result_dptos : pandas DataFrame
+        Results grouped by MAT of the department.
+    resumen_dptos : pandas DataFrame
+        Summary by municipality of the department.
+    resumen_mpios : pandas DataFrame
+        Results grouped by block and age groups of the department.
+    result_nedifstr, result_mode, result_nedif : pandas DataFrame
+        Intermediate results of the last municipality (or of the whole department if batch).
+        None if no municipality was processed (or all were read from the checkpoints).
+
+    """
+    result_dptos = ut.ResultCollector()
+    resumen_dptos = ut.ResultCollector()
+    resumen_mpios = ut.ResultCollector()
+    result_nedifstr = result_mode = result_nedif = None
+    
+    def add_parts(parts):
+        for collector, part in zip((result_dptos, resumen_dptos, resumen_mpios), parts):
+            if len(part.columns):
+                collector.add(part)
+    
+    print('Iterando Departamento:{}, Código: {}'.format(depto, dptocod))
+    
+    #%% Checkpoints: the department is not read if it was saved with the same files and parameters
+    if checkpoint is not None:
+        group = os.path.join(str(dptocod) + depto, ck.fingerprint(filtClase, filtUnidad, filtViv, args, seed, stream_per)[:16])
+        inputs = department_inputs(folder_path, dptocod, depto, checkpoint)
+        saved = checkpoint.get(group, 'departamento', inputs) or []
+        parts = [checkpoint.get(group, code, key) for code, key in saved]
+        
+        if saved and all(part is not None for part in parts):
+            for part in parts:
+                add_parts(part)
+            print('Departamento {} leído de los checkpoints'.format(depto))
+            
+            return result_dptos.to_frame(), resumen_dptos.to_frame(), resumen_mpios.to_frame(), None, None, None
+    
+    #%% Read MGN, VIV, PER, files from specified folder path
+    
+    # USO_UNIDAD and TIPO_VIV filters are applied while reading. CLASE is only pushed
+    # down when there are no summaries, because they count the buildings of every CLASE,
+    # and without stage cache, so that the cached stages do not depend on it
+    filters = pushdown_filters(filtClase if not any(args) and stage_cache is None else None, filtUnidad, filtViv)
+    mgn, viv, per, _ = read_files(folder_path, dptocod, depto, engine=engine, filters=filters, read_per=not stream_per)
+    
+    #%% Filter data by CLASE, USO_UNIDAD, TIPO_VIVIENDA
+    mgn, viv, per = filter_files(mgn, viv, per, filtUnidad=filtUnidad, filtViv=filtViv)
+    mpios_dpto = mun.load_registry().department(dptocod)
+    
+    #%% Streaming: the PER file is organized by chunks, it is never held in memory
+    personas_dpto = None
+    if stream_per:
+        chunks = iter_personas(folder_path, dptocod, depto, engine=engine, filters=filters['PER'])
+        personas_dpto = organize_personas_chunked(chunks, ["U_MPIO"])
+    
+    keys, stored = {}, {}
+    if checkpoint is not None or stage_cache is not None:
+        keys = municipality_keys(mgn, viv, personas_dpto if stream_per else per)
+    
+    if checkpoint is not None:
+        for mpio in mpios_dpto:
+            part = checkpoint.get(group, mpio.code, keys.get(mpio.u_mpio))
+            if part is not None:
+                stored[mpio.u_mpio] = part
+    
+    def department_results(result_nedifstr, result_mode, result_nedif):
+        # Results of the department in the order of the municipalities
+        for mpio in mpios_dpto:
+            if mpio.u_mpio in stored:
+                add_parts(stored[mpio.u_mpio])
+        
+        if checkpoint is not None and inputs is not None:
+            saved = [(mpio.code, keys[mpio.u_mpio]) for mpio in mpios_dpto if mpio.u_mpio in stored]
+            checkpoint.put(group, 'departamento', inputs, saved)
+        
+        print('Terminado Departamento: {}'.format(depto))
+        
+        return result_dptos.to_frame(), resumen_dptos.to_frame(), resumen_mpios.to_frame(), result_nedifstr, result_mode, result_nedif
+    
+    #%% Batched execution: the whole department as one set of grouped operations
+    if batch and checkpoint is not None:
+        todo = tuple(mpio for mpio in mpios_dpto if mpio.u_mpio in keys and mpio.u_mpio not in stored)
+        
+        if todo:
+            result_nedifstr, resumen_dpto, resumen_mpio, result_mode, result_nedif = \
+                batch_department(mgn, viv, per, todo, dptocod, filtClase, *args, seed=seed, personas=personas_dpto,
+                                 stage_cache=stage_cache, keys=keys)
+            
+            parts = split_department(result_nedifstr, resumen_dpto, resumen_mpio, todo)
+            for mpio in todo:
+                checkpoint.put(group, mpio.code, keys[mpio.u_mpio], parts[mpio.u_mpio])
+                stored[mpio.u_mpio] = parts[mpio.u_mpio]
+        
+        return department_results(result_nedifstr, result_mode, result_nedif)
+    
+    elif batch:
+        result_nedifstr, resumen_dptos, resumen_mpios, result_mode, result_nedif = \
+            batch_department(mgn, viv, per, mpios_dpto, dptocod, filtClase, *args, seed=seed, personas=personas_dpto,
+                             stage_cache=stage_cache, keys=keys or None)
+        
+        print('Terminado Departamento: {}'.format(depto))
+        
+        return result_nedifstr, resumen_dptos, resumen_mpios, result_nedifstr, result_mode, result_nedif
+    
+    #%% Partition MGN, VIV, PER data by municipality
+    mgn_mpios = split_mpios(mgn)
+    viv_mpios = split_mpios(viv)
+    if stream_per:
+        personas_mpios = split_mpios(personas_dpto)
+    else:
+        per_mpios = split_mpios(per)
+    
+    #%%
+    for mpio in mpios_dpto:
+        mpoestudio = mpio.u_mpio
+        
+        if mpoestudio in stored:
+            
+            print('Municipio {} leído de los checkpoints'.format(mpoestudio))
+            
+        elif mpoestudio in viv_mpios:
+            
+            print('Iterando Municipio: {}'.format(mpoestudio))
+            
+            codmpio = mpio.codmpio
+            cod = mpio.code
+            result_mpio, resumen_dpto, resumen_mpio = ut.ResultCollector(), ut.ResultCollector(), ut.ResultCollector()
+            
+            # Partitions are released once the municipality is processed
+            mgnestudio = mgn_mpios.pop(mpoestudio, mgn.iloc[:0])
+            vivestudio = viv_mpios.pop(mpoestudio)
+            
+            #%% Personas data is organized and stacked as VIV format
+            
+            personas = perestudio = None
+            if stream_per:
+                personas = personas_mpios.pop(mpoestudio, personas_dpto.iloc[:0]).drop(columns="U_MPIO")
+            else:
+                perestudio = per_mpios.pop(mpoestudio, per.iloc[:0])
+
+            #%% MGV, VIV, PER dataframes are merged. The merge does not depend on CLASE, it is reused from the stage cache
+            
+            merge_key = mode_key = None
+            if mpoestudio in keys:
+                merge_key = ck.fingerprint('merge_municipality', keys[mpoestudio], stream_per)
+                # The mode is only reused when the random tie-break is reproducible
+                mode_key = ck.fingerprint('mode', merge_key, bool(args[0]), seed) if seed is not None else None
+            
+            result = run_stage(stage_cache, merge_key, merge_municipality, vivestudio, mgnestudio, perestudio, personas)
+            
+            #%% The data is grouped by desired fields. If optional arg is True data grouping will include number of people by age groups.
+
+            #result_mode, result_nedif = groupby_mode(result, False)
+            
+            #%% Write and filter the results based on CLASE
+            if True == args[0]:
+                result_mode, result_nedif = run_stage(stage_cache, mode_key, groupby_mode, result, True, seed=seed)
+                result_nedifstr, result_mpio, resumen_mpio = write_results(result_mpio, result_mode, result_nedif, filtClase, cod, codmpio, dptocod, resumen_mpio, True)
+                
+            else:
+                result_mode, result_nedif = run_stage(stage_cache, mode_key, groupby_mode, result, False, seed=seed)
+                result_nedifstr, result_mpio = write_results(result_mpio, result_mode, result_nedif, filtClase, cod, codmpio, dptocod, None, False)
+            
+            if True == args[1]:
+                resumen_dpto = write_resumen(resumen_dpto, result_mode, result_nedif, mpio, cod)
+            
+            stored[mpoestudio] = (result_mpio.to_frame(), resumen_dpto.to_frame(), resumen_mpio.to_frame())
+            if checkpoint is not None:
+                checkpoint.put(group, cod, keys[mpoestudio], stored[mpoestudio])
+            
+            print('Terminado Municipio: {}'.format(mpoestudio))
+    
+    return department_results(result_nedifstr, result_mode, result_nedif)
+
+
+def parallel_departments(tasks, workers, max_inflight=None, batch=False, seed=None, engine=None, stream_per=False, checkpoint=None,
+                         stage_cache=None):
+    """
+    Run process_department for every department in a ProcessPoolExecutor. Results are
+    yielded in the same order of 'tasks' and at most 'max_inflight' departments are
+    submitted at once, so that only a few departments are held in memory.
+    
+    Worker processes do not share the numpy global random state, use 'seed' to get
+    reproducible TIPO_VIV tie-breaks. On Windows the calling script must run
+    func_principal under an "if __name__ == '__main__':" block.
+
+    Parameters
+    ----------
+    tasks : list
+        List of tuples with the positional arguments of process_department.
+    workers : int
+        Number of worker processes.
+    max_inflight : int, optional
+        Maximum number of departments submitted and not yet merged. The default is None (workers).
+    batch : boolean, optional
+        Same as func_principal. The default is False.
+    seed : int, optional
+        Same as func_principal. The default is None.
+    engine : str, optional
+        Same as func_principal. The default is None.
+    stream_per : boolean, optional
+        Same as func_principal. The default is False.
+    checkpoint : checkpoint.CheckpointStore, optional
+        Same as process_department. The default is None.
+    stage_cache : checkpoint.StageCache, optional
+        Same as process_department. The default is None.
+
+    Yields
+    ------
+    tuple
+        process_department output of each department.
+
+    """
+    max_inflight = max(max_inflight or workers, 1)
+    
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for task in tasks:
+            if len(pending) >= max_inflight:
+                yield pending.popleft().result()
+            pending.append(executor.submit(process_department, *task, batch=batch, seed=seed, engine=engine, stream_per=stream_per,
+                                           checkpoint=checkpoint, stage_cache=stage_cache))
+        
+        while pending:
+            yield pending.popleft().result()
+
+
+def func_principal(folder_path, deptcod, deptname, filtClase, filtUnidad, filtViv, *args, batch=False, workers=None, max_inflight=None, seed=None, engine=None, stream_per=False, checkpoint_dir=None,
+                   stage_cache_dir=None, stage_cache_bytes=4 * 2**30):
     """
     Principal function which iterate through any number of specified Departments.
 
@@ -493,11 +1457,38 @@ def func_principal(folder_path, deptcod, deptname, filtClase, filtUnidad, filtVi
     *args : booleans
         Two last paremeters ( , ). 1st position -> Specifies if consider age groups in the group by operations.
         2nd position -> Specifies if writes a municipality summary.
+    batch : boolean, optional
+        True --> Each department is processed at once with batch_department instead of 
+        iterating its municipalities. The default is False.
+    workers : int, optional
+        Number of processes to run the departments in parallel. The default is None (sequential).
+    max_inflight : int, optional
+        Maximum number of departments in memory at once when workers is used, which bounds
+        the memory of large departments (Bogotá, Antioquia). The default is None (workers).
+    seed : int, optional
+        Seed for the random TIPO_VIV of buildings with only 'Tipo Cuarto' dwellings
+        (see groupby_mode). The default is None (global numpy random state).
+    engine : str, optional
+        CSV parser engine used to read the DANE files, e.g. 'pyarrow'. The default is None.
+    stream_per : boolean, optional
+        True --> The PER file is read by chunks and organized with organize_personas_chunked,
+        so that the memory depends on the number of dwellings instead of the number of
+        persons (Bogotá, Antioquia). The default is False.
+    checkpoint_dir : string (path), optional
+        Folder where the results of every municipality are saved (see checkpoint.CheckpointStore).
+        A run that is repeated or resumed after a failure only recalculates the municipalities
+        that are missing or whose data or filters changed. The default is None (no checkpoints).
+    stage_cache_dir : string (path), optional
+        Folder of the cache of intermediate stages (see checkpoint.StageCache), reused by runs
+        with other filtClase or summary options. The default is None (no cache).
+    stage_cache_bytes : int, optional
+        Maximum size of the stage cache, the least recently used stages are removed. The default is 4 GB.
 
     Returns
     -------
     result_dptos : TYPE
-        DESCRIPTION.
+        DESCRIPTION. Material Pared, Material Piso, Tipo Vivienda and Estrato are
+        categorical (see label_combinations), use .astype(str) where strings are needed.
     resumen_dptos : TYPE
         DESCRIPTION.
     resumen_mpios : TYPE
@@ -513,77 +1504,38 @@ def func_principal(folder_path, deptcod, deptname, filtClase, filtUnidad, filtVi
     start = time.time()
     
     #%% Manejo y re arreglo de los datos    
-    result_dptos = pd.DataFrame()
-    resumen_dptos = pd.DataFrame()
-    resumen_mpios = pd.DataFrame()
-    for i in range(len(deptcod)):
-        dptocod = deptcod[i]
-        depto = deptname[i]
-        
-        print('Iterando Departamento:{}, Código: {}'.format(depto, dptocod))
-        
-        #%% Read MGN, VIV, PER, files from specified folder path
-        
-        mgn, viv, per, mpios_list = read_files(folder_path, dptocod, depto)
-        
-        #%% Filter data by CLASE, USO_UNIDAD, TIPO_VIVIENDA
-        mgn, viv, per = filter_files(mgn, viv, per, filtUnidad=filtUnidad, filtViv=filtViv)
-        mpios_list = mpios_list[mpios_list["Departamento"] == int(dptocod)]    
+    result_dptos = ut.ResultCollector()
+    resumen_dptos = ut.ResultCollector()
+    resumen_mpios = ut.ResultCollector()
+    
+    result_nedifstr = result_mode = result_nedif = None
+    checkpoint = ck.CheckpointStore(checkpoint_dir) if checkpoint_dir else None
+    stage_cache = ck.StageCache(stage_cache_dir, stage_cache_bytes) if stage_cache_dir else None
+    
+    tasks = [(folder_path, deptcod[i], deptname[i], filtClase, filtUnidad, filtViv) + args for i in range(len(deptcod))]
+    if workers:
+        departments = parallel_departments(tasks, workers, max_inflight, batch=batch, seed=seed, engine=engine, stream_per=stream_per,
+                                           checkpoint=checkpoint, stage_cache=stage_cache)
+    else:
+        departments = (process_department(*task, batch=batch, seed=seed, engine=engine, stream_per=stream_per, checkpoint=checkpoint,
+                                          stage_cache=stage_cache)
+                       for task in tasks)
+    
+    # Departments are merged in the same order of deptcod
+    for result_dpto, resumen_dpto, resumen_mpio, *last in departments:
+        result_dptos.add(result_dpto)
+        resumen_dptos.add(resumen_dpto)
+        resumen_mpios.add(resumen_mpio)
         
-        #%%
-        for mpio in mpios_list.iterrows():
-            if dptocod[0] == '0':
-                dig = 1
-            else:
-                dig = 2            
-            mpoestudio = str(mpio[1]["COD"])[dig:].lstrip("0")
-            mpoestudio = int(mpoestudio)
-            
-            if viv['U_MPIO'].isin([mpoestudio]).any():
-                
-                print('Iterando Municipio: {}'.format(mpoestudio))
-                
-                codmpio = str(mpio[1]["COD"])[dig:]
-                cod = str(dptocod) + codmpio
-                
-                mgnestudio = mgn[mgn["U_MPIO"] == mpoestudio]
-                vivestudio = viv[viv["U_MPIO"] == mpoestudio]
-                perestudio = per[per["U_MPIO"] == mpoestudio]
-                
-                #%% Personas data is organized and stacked as VIV format
-                
-                personas = organize_personas(perestudio)                
-
-                #%% MGV, VIV, PER dataframes are merged.
-                    
-                dfs = [vivestudio[["COD_ENCUESTAS", "V_MAT_PARED", "V_MAT_PISO", 'V_TIPO_VIV', 'VA1_ESTRATO']],
-                       mgnestudio[["COD_ENCUESTAS", "U_MPIO", "UA_CLASE", "U_SECT_RUR", "U_SECC_RUR", "UA2_CPOB", "U_SECT_URB", "U_SECC_URB", "U_MZA", \
-                                  "U_EDIFICA", "COD_DANE_ANM"]],                   
-                           personas]
-                    
-                result = reduce(lambda left,right: pd.merge(left,right,on='COD_ENCUESTAS', how='left'), dfs)
-                
-                result = result.drop_duplicates()
-                
-                result = result.fillna(0)
-                
-                #%% The data is grouped by desired fields. If optional arg is True data grouping will include number of people by age groups.
+        if last[0] is not None:
+            result_nedifstr, result_mode, result_nedif = last
     
-                #result_mode, result_nedif = groupby_mode(result, False)
-                
-                #%% Write and filter the results based on CLASE
-                if True == args[0]:
-                    result_mode, result_nedif = groupby_mode(result, True)
-                    result_nedifstr, result_dptos, resumen_mpios = write_results(result_dptos, result_mode, result_nedif, filtClase, cod, codmpio, dptocod, resumen_mpios, True)
-                    
-                else:
-                    result_mode, result_nedif = groupby_mode(result, False)
-                    result_nedifstr, result_dptos = write_results(result_dptos, result_mode, result_nedif, filtClase, cod, codmpio, dptocod, None, False)
-                
-                if True == args[1]:
-                    resumen_dptos = write_resumen(resumen_dptos, result_mode, result_nedif, mpio, cod)
-                
-                print('Terminado Municipio: {}'.format(mpoestudio))
+    # The codes of the MAT combination are replaced by their labels once, for all the results
+    result_dptos = label_combinations(result_dptos.to_frame())
+    if result_nedifstr is not None:
+        result_nedifstr = label_combinations(result_nedifstr)
+    resumen_dptos = resumen_dptos.to_frame()
+    resumen_mpios = resumen_mpios.to_frame()
     
     try:
         
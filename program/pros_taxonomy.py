@@ -5,8 +5,35 @@ Created on Fri Oct 16 13:49:23 2020
 @author: Juan Camilo Victoria & Santiago Sepúlveda
 """
 
+import hashlib
+import os
+import pickle
+import re
+from collections import namedtuple
 import pandas as pd
 import numpy as np
+import utilities as ut
+import municipios as mun
+import tipologias_gem as tgem
+from checkpoint import file_checksum
+from tipologias_gem import TAXONOMY_PATTERN
+
+# First typology column of the results, the columns from it are rounded
+FIRST_TYPOLOGY = 'ADO|EU/LWAL+DNO/H:1'
+
+# Increase when the content of the mapping cache changes
+MAPPING_CACHE_VERSION = 1
+
+# Default folder of the mapping cache, outside of the input data folders
+MAPPING_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'inventario_edificaciones')
+
+# Municipalities computed at once by the sparse taxonomy, bounds the dense intermediate results
+SPARSE_CHUNK = 50
+
+MappingTables = namedtuple('MappingTables', ['mapping_list', 'mapping', 'detailed_1', 'detailed_2', 'schemes', 'report'])
+
+# Columns of the MAT combination
+COMBINATION_COLUMNS = ["Material Pared", "Material Piso", "Tipo Vivienda"]
 
 #%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
 
@@ -35,16 +62,292 @@ def round_series_retain_integer_sum(xs):
     ys = [R + 1 if i in indices else R for i,R in enumerate(Rs)]
     return ys
 
-def read_input(mapping_path, result_path, mza):
+def round_array_retain_integer_sum(xs):
+    """
+    Round every row of a 2-D array and mantain the sum of each row. Same rounding as
+    round_series_retain_integer_sum (largest remainder, ties go to the last column)
+    for all the rows at once. Missing values are counted as 0, as the fillna(0) of taxonomy.
+
+    Parameters
+    ----------
+    xs : numpy array
+        2-D array of decimal values.
+
+    Returns
+    -------
+    ys : numpy array
+        2-D array of integers.
+
+    """
+    xs = np.asarray(xs, dtype=float)
+    xs = np.where(np.isnan(xs), 0, xs)
+    nrows, ncols = xs.shape
+    
+    # Sequential sum, as the builtin sum
+    N = np.add.accumulate(xs, axis=1)[:, -1] if ncols else np.zeros(nrows)
+    Rs = np.trunc(xs)
+    K = np.round(N - Rs.sum(axis=1))
+    fs = xs - Rs
+    
+    # Rank of each fraction in decreasing order, ties by decreasing column
+    cols = np.broadcast_to(np.arange(ncols), xs.shape)
+    order = np.lexsort((-cols, -fs), axis=1)
+    ranks = np.empty(xs.shape, dtype=np.int64)
+    np.put_along_axis(ranks, order, cols, axis=1)
+    
+    ys = (Rs + (ranks < K[:, None])).astype(np.int64)
+    return ys
+
+def round_table_retain_integer_sum(table):
+    """
+    Round every row of a sparse typology table (see tipologias_gem.TypologyTable) and
+    mantain the sum of each row. Same result as round_array_retain_integer_sum on the
+    dense matrix: the cells in zero never receive a unit, because the number of units
+    to add is at most the number of cells with a fraction.
+
+    Parameters
+    ----------
+    table : tipologias_gem.TypologyTable
+        Table with decimal values.
+
+    Returns
+    -------
+    tipologias_gem.TypologyTable
+        Table with integers.
+
     """
+    row, col = table.row, table.typology
+    xs = table.count.astype(float)
+    xs = np.where(np.isnan(xs), 0, xs)
+    nrows = len(table)
+    
+    starts = np.flatnonzero(np.r_[True, row[1:] != row[:-1]]) if len(row) else np.array([], dtype=np.int64)
+    lengths = np.diff(np.r_[starts, len(row)])
+    
+    # Sequential sum of the cells of each row (in column order), as the dense rounding
+    N = np.zeros(nrows)
+    for k in range(lengths.max() if len(lengths) else 0):
+        has = lengths > k
+        N[row[starts[has]]] += xs[starts[has] + k]
+    
+    Rs = np.trunc(xs)
+    K = np.round(N - np.bincount(row, weights=Rs, minlength=nrows))
+    fs = xs - Rs
+    
+    # Rank of each fraction in its row in decreasing order, ties by decreasing column
+    order = np.lexsort((-col, -fs, row))
+    ranks = np.empty(len(row), dtype=np.int64)
+    ranks[order] = np.arange(len(row)) - np.repeat(starts, lengths)
     
+    ys = (Rs + (ranks < K[row])).astype(np.int64)
+    return table.with_counts(ys)
+
+def read_mapping(mapping_path):
+    """
+    Parse the sheets of the mapping xlsx file.
+
+    Parameters
+    ----------
+    mapping_path : string (path)
+        Absolute or relative path to the mapping xlsx file.
+
+    Returns
+    -------
+    mapping_list : pandas DataFrame
+        "Lista" sheet.
+    mapping : pandas DataFrame
+        "Esquema" sheet.
+    detailed_1 : pandas DataFrame
+        "Esquema_Detallado_1" sheet.
+    detailed_2 : pandas DataFrame
+        "Esquema_Detallado_2" sheet.
+
+    """
+    mapping_ana = pd.ExcelFile(mapping_path)
+    
+    mapping_list = pd.read_excel(mapping_ana, sheet_name="Lista")
+    mapping = pd.read_excel(mapping_ana, sheet_name="Esquema")
+    detailed_1 = pd.read_excel(mapping_ana, sheet_name="Esquema_Detallado_1", index_col=[0, 1]).reset_index()
+    detailed_2 = pd.read_excel(mapping_ana, sheet_name="Esquema_Detallado_2", index_col=[0, 1]).reset_index()
+    
+    return mapping_list, mapping, detailed_1, detailed_2
+
+
+def load_mapping(mapping_path, cache_path=None):
+    """
+    Read the mapping xlsx file through a binary cache. The first time, the sheets are
+    parsed, the schemes are compiled and validated, and everything is saved with pickle.
+    The next runs load the cache while the SHA-1 checksum and the modification time of
+    the workbook do not change.
+
+    Parameters
+    ----------
+    mapping_path : string (path)
+        Absolute or relative path to the mapping xlsx file.
+    cache_path : string (path), optional
+        Path to the cache file. The default is None (a file in MAPPING_CACHE_DIR named
+        after the workbook and a hash of its absolute path).
+
+    Returns
+    -------
+    MappingTables
+        Namedtuple with the sheets (mapping_list, mapping, detailed_1, detailed_2), the
+        compiled schemes (see compile_schemes) and the report of validate_mapping.
+
+    """
+    if cache_path is None:
+        name = os.path.splitext(os.path.basename(mapping_path))[0]
+        digest = hashlib.sha1(os.path.abspath(mapping_path).encode('utf-8')).hexdigest()[:12]
+        cache_path = os.path.join(MAPPING_CACHE_DIR, '{}-{}.mapping.pkl'.format(name, digest))
+    os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+    
+    key = {'sha1': file_checksum(mapping_path), 'mtime': os.stat(mapping_path).st_mtime,
+           'version': MAPPING_CACHE_VERSION}
+    
+    if os.path.exists(cache_path):
+        with open(cache_path, 'rb') as f:
+            cached = pickle.load(f)
+        if cached.get('key') == key:
+            return MappingTables(**cached['tables'])
+    
+    print('Compilando esquema de clasificación {}'.format(mapping_path))
+    mapping_list, mapping, detailed_1, detailed_2 = read_mapping(mapping_path)
+    schemes = compile_schemes(mapping_list, mapping, detailed_1, detailed_2)
+    report = validate_mapping(mapping_list, mapping, detailed_1, detailed_2, schemes)
+    tables = MappingTables(mapping_list, mapping, detailed_1, detailed_2, schemes, report)
+    
+    with open(cache_path, 'wb') as f:
+        pickle.dump({'key': key, 'tables': tables._asdict()}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    
+    return tables
+
+
+def split_distribution(value):
+    """
+    Split a cell of the "Esquema" sheet with typologies and percentages, e.g.
+    "70% W+WO/LN+DNO/H:1 30% W+WO/LN+DNO/H:2" --> [(70.0, "W+WO/LN+DNO/H:1"), (30.0, "W+WO/LN+DNO/H:2")].
+    Raises ValueError if the cell does not have that format.
+    """
+    dist_list = str(value).split()
+    
+    if len(dist_list) % 2 or not all(p.endswith("%") for p in dist_list[::2]):
+        raise ValueError(value)
+    
+    return [(float(p[:-1]), comb) for p, comb in zip(dist_list[::2], dist_list[1::2])]
+
+
+def validate_mapping(mapping_list, mapping, detailed_1, detailed_2, schemes):
+    """
+    Check the mapping sheets. The problems do not stop the calculation, the buildings of
+    the affected combinations are lost or distributed with the wrong percentages:
+        - Cells of "Esquema" with percentages that do not sum to 100 or that can not be read.
+        - Detailed distributions used by a scheme that do not sum to 100.
+        - Schemes without the detailed distribution of "Casa" or "Apartamento".
+        - Typology codes that do not follow the GEM taxonomy format (TAXONOMY_PATTERN).
+        - Municipalities of "Lista" without scheme.
+
+    Parameters
+    ----------
+    mapping_list, mapping, detailed_1, detailed_2 : pandas DataFrame
+        Sheets of the mapping xlsx file, see read_mapping.
+    schemes : dict
+        Output of compile_schemes.
+
+    Returns
+    -------
+    report : pandas DataFrame
+        One row for each problem with the sheet, scheme, row, column and description.
+
+    """
+    report = []
+    
+    def issue(sheet, problem, scheme=None, row=None, column=None):
+        report.append({"Hoja": sheet, "Esquema": scheme, "Fila": row, "Columna": column, "Problema": problem})
+    
+    detailed = {"Detallado_1": detailed_1, "Detallado_2": detailed_2}
+    typologies = set()
+    used = set()
+    
+    for i, row in mapping.iterrows():
+        for key, value in row.iloc[1:].items():
+            
+            if value in detailed:
+                used.add((value, key))
+                if key not in detailed[value].columns:
+                    issue("Esquema", "la hoja Esquema_{} no tiene la columna".format(value), row=i, column=key)
+                continue
+            
+            if len(str(value).split()) == 1:
+                if value != "-":
+                    issue("Esquema", "valor ignorado: {}".format(value), row=i, column=key)
+                continue
+            
+            try:
+                dist = split_distribution(value)
+            except ValueError:
+                issue("Esquema", "no se puede leer la distribución", row=i, column=key)
+                continue
+            
+            typologies.update(comb for _, comb in dist)
+            total = sum(p for p, _ in dist)
+            if abs(total - 100) > 1e-6:
+                issue("Esquema", "los porcentajes suman {:g}".format(total), row=i, column=key)
+    
+    for scheme in mapping_list["Esquema"].dropna().unique():
+        for name, sheet in detailed.items():
+            
+            keys = [key for value, key in used if value == name and key in sheet.columns]
+            if not keys:
+                continue
+            
+            rows = sheet[sheet["Esquema"].str.contains(scheme, regex=False)]
+            typologies.update(rows["Tipología"])
+            
+            viv_types = set(rows["Esquema"].str.split("_").str[-1])
+            missing = {"Apartamento", "Casa"} - viv_types
+            if missing and not viv_types - {"Apartamento", "Casa"}:
+                issue("Esquema_" + name, "sin distribución para {}".format(", ".join(sorted(missing))), scheme=scheme)
+            
+            percentages = rows[keys].apply(pd.to_numeric, errors="coerce")
+            for key in keys:
+                for label, total in percentages[key].groupby(rows["Esquema"]).sum(min_count=1).items():
+                    if not abs(total - 100) <= 1e-6:
+                        issue("Esquema_" + name, "los porcentajes de {} suman {:g}".format(label, total), scheme=scheme, column=key)
+    
+    for comb in sorted(typologies):
+        if not re.match(TAXONOMY_PATTERN, comb):
+            issue("Esquema", "código de tipología desconocido: {}".format(comb))
+    
+    if schemes and not any(FIRST_TYPOLOGY in dist_mater_pivot.columns for dist_mater_pivot in schemes.values()):
+        issue("Esquema", "ningún esquema tiene la tipología {}".format(FIRST_TYPOLOGY))
+    
+    for i, row in mapping_list[mapping_list["Esquema"].isna()].iterrows():
+        issue("Lista", "municipio {} sin esquema".format(row["Código"]), row=i, column="Esquema")
+    
+    report = pd.DataFrame(report, columns=["Hoja", "Esquema", "Fila", "Columna", "Problema"])
+    
+    return report.astype({"Fila": "Int64"})
+
+
+def read_input(mapping_path, result_path, mza, cache=True, mapping_tables=None):
+    """
+    Read the mapping xlsx file, the list of municipalities and the results of the MAT
+    distribution. The problems found in the mapping are printed, see validate_mapping.
 
     Parameters
     ----------
     mapping_path : string (path)
         Absolute or relative path to the mapping xlsx file.
     result_path : string (path)
-        Absolute or relative path to the csv file with results of MAT distribution.
+        Absolute or relative path to the file with results of MAT distribution, csv or
+        any format of utilities.save_table (e.g. Parquet partitioned by department).
+    mza : boolean
+        True --> The results are by block.
+    cache : boolean, optional
+        True --> The mapping is read with load_mapping. The default is True.
+    mapping_tables : MappingTables, optional
+        Output of load_mapping already loaded, it is used instead of reading the mapping
+        again. Its compiled schemes are passed to taxonomy. The default is None.
 
     Returns
     -------
@@ -62,19 +365,362 @@ def read_input(mapping_path, result_path, mza):
         DESCRIPTION.
 
     """
-    mapping_ana = pd.ExcelFile(mapping_path)
-    conteo_mpios = pd.read_csv(result_path)
-    mpios_list = pd.read_csv(r'mpios_list.csv', encoding='ISO-8859-1')
+    conteo_mpios = ut.read_table(result_path)
+    # func_principal saves cod as string, Parquet and Feather keep it (csv reads it as int)
+    conteo_mpios["cod"] = conteo_mpios["cod"].astype(np.int64)
+    mpios_list = mun.read_mpios_list()
     
-    mapping_list = pd.read_excel(mapping_ana, sheet_name="Lista")
-    mapping = pd.read_excel(mapping_ana, sheet_name="Esquema")
-    detailed_1 = pd.read_excel(mapping_ana, sheet_name="Esquema_Detallado_1", index_col=[0, 1]).reset_index()
-    detailed_2 = pd.read_excel(mapping_ana, sheet_name="Esquema_Detallado_2", index_col=[0, 1]).reset_index()
+    if mapping_tables is None and cache:
+        mapping_tables = load_mapping(mapping_path)
+    
+    if mapping_tables is not None:
+        mapping_list, mapping, detailed_1, detailed_2, _, report = mapping_tables
+    else:
+        mapping_list, mapping, detailed_1, detailed_2 = read_mapping(mapping_path)
+        report = validate_mapping(mapping_list, mapping, detailed_1, detailed_2, {})
+    
+    if len(report):
+        print('Advertencias del esquema de clasificación:')
+        print(report.to_string())
     
     return conteo_mpios, mpios_list, mapping_list, mapping, detailed_1, detailed_2
 
 
-def taxonomy(conteo_mpios, mpios_list, mapping_list, mapping, detailed_1, detailed_2, deptcod, exclude, mza=False):
+def compile_scheme(mapping, detailed_1, detailed_2, scheme):
+    """
+    Distribution of typologies of a mapping scheme. The "Esquema" sheet gives, for every
+    wall and floor material, either the typologies with their percentage (e.g. "70% W+WO/LN+DNO/H:1
+    30% W+WO/LN+DNO/H:2") or the detailed sheet where the distribution by dwelling type is.
+
+    Parameters
+    ----------
+    mapping : pandas DataFrame
+        "Esquema" sheet.
+    detailed_1 : pandas DataFrame
+        "Esquema_Detallado_1" sheet.
+    detailed_2 : pandas DataFrame
+        "Esquema_Detallado_2" sheet.
+    scheme : str
+        Scheme of the "Lista" sheet, e.g. "Resto".
+
+    Returns
+    -------
+    dist_mater_pivot : pandas DataFrame
+        One row for each Material Pared, Material Piso, Tipo Vivienda combination and one
+        column for each typology, with the fraction of buildings of the combination.
+
+    """
+    detailed = {"Detallado_1": detailed_1[detailed_1["Esquema"].str.contains(scheme, regex=False)],
+                "Detallado_2": detailed_2[detailed_2["Esquema"].str.contains(scheme, regex=False)]}
+    
+    dist_mater = []
+    for i, row in mapping.iterrows():
+        
+        mat_pared = row["Material paredes/piso"]
+        
+        for key, value in row.iloc[1:].items():
+            
+            if value in detailed:
+                
+                for j, comb in detailed[value].iterrows():
+                    
+                    viv_type = comb["Esquema"].split("_")[-1]
+                    
+                    if viv_type not in ["Apartamento", "Casa"]:
+                        viv_type = "No aplica"
+                    
+                    dist_mater.append({"Material Pared": mat_pared, "Material Piso": key, 
+                                       "Tipo Vivienda": viv_type, "Combinación": comb["Tipología"],
+                                       "Porcentaje": float(comb[key]/100)})
+            
+            else:
+                
+                dist_list = value.split()
+                
+                if len(dist_list) != 1:
+                    
+                    for p in range(0, len(dist_list), 2):
+                        
+                        dist_mater.append({"Material Pared": mat_pared, "Material Piso": key, 
+                                           "Tipo Vivienda": "No aplica", "Combinación": dist_list[p+1],
+                                           "Porcentaje": float(dist_list[p][:-1])/100})
+    
+    dist_mater_pivot = pd.pivot_table(pd.DataFrame(dist_mater), index=['Material Pared', 'Material Piso', 'Tipo Vivienda'], columns=['Combinación'], values=['Porcentaje'], aggfunc=np.sum).fillna(0).reset_index()   
+    dist_mater_pivot.columns = pd.Index(list(dist_mater_pivot.columns.get_level_values(0)[:3]) + list(dist_mater_pivot.columns.get_level_values(1)[3:]))
+    
+    dist_mater_pivot["Material Pared"] = dist_mater_pivot["Material Pared"].str.strip()
+    dist_mater_pivot["Material Piso"] = dist_mater_pivot["Material Piso"].str.strip()
+    dist_mater_pivot["Tipo Vivienda"] = dist_mater_pivot["Tipo Vivienda"].str.strip()
+    
+    return dist_mater_pivot
+
+
+def compile_schemes(mapping_list, mapping, detailed_1, detailed_2):
+    """
+    Compile the distribution of every scheme of the "Lista" sheet, see compile_scheme.
+
+    Returns
+    -------
+    schemes : dict
+        {scheme: dist_mater_pivot}.
+
+    """
+    schemes = {}
+    for scheme in mapping_list["Esquema"].dropna().unique():
+        schemes[scheme] = compile_scheme(mapping, detailed_1, detailed_2, scheme)
+    
+    return schemes
+
+
+def combination_dtypes(conteo_mpios, dists):
+    """
+    Categorical dtype of each column of the MAT combination, shared by the results and
+    the scheme distributions so that they are joined by their integer codes. The labels
+    are stripped and the categories are sorted, so grouping by the codes gives the order
+    of the labels.
+
+    Parameters
+    ----------
+    conteo_mpios : pandas DataFrame
+        Input data with the results of the MAT distribution.
+    dists : list
+        Distributions of the schemes, see compile_scheme.
+
+    Returns
+    -------
+    dtypes : dict
+        {column: pandas CategoricalDtype}.
+
+    """
+    dtypes = {}
+    for col in COMBINATION_COLUMNS:
+        labels = set(pd.Index(pd.Categorical(conteo_mpios[col]).categories).astype(str).str.strip())
+        for dist_mater_pivot in dists:
+            labels.update(dist_mater_pivot[col])
+        dtypes[col] = pd.CategoricalDtype(sorted(labels))
+    
+    return dtypes
+
+
+def encode_combinations(df, dtypes):
+    """
+    Columns of the MAT combination of df as categoricals of dtypes (see combination_dtypes).
+    Only the categories are stripped, not every row.
+
+    Returns
+    -------
+    df : pandas DataFrame
+        Copy of df with categorical columns.
+
+    """
+    df = df.copy()
+    for col, dtype in dtypes.items():
+        values = pd.Categorical(df[col])
+        labels = pd.Index(values.categories).astype(str).str.strip()
+        codes = dtype.categories.get_indexer(labels)[values.codes]
+        df[col] = pd.Categorical.from_codes(np.where(values.codes < 0, -1, codes), dtype=dtype)
+    
+    return df
+
+
+def decode_combinations(df):
+    """
+    Columns of the MAT combination of df back to strings (object dtype), as the results
+    of taxonomy were before the encoding. Inverse of encode_combinations.
+    """
+    return df.astype({col: object for col in COMBINATION_COLUMNS
+                      if col in df.columns and isinstance(df[col].dtype, pd.CategoricalDtype)})
+
+
+def combination_counts(conteo_mpios):
+    """
+    Number of buildings by municipality and MAT combination. Material Pared and Material
+    Piso totals are also returned, they are used by the "No aplica" rows of the
+    distribution, which do not depend on the Tipo Vivienda.
+
+    Parameters
+    ----------
+    conteo_mpios : pandas DataFrame
+        Input data with the results of the MAT distribution, encoded with encode_combinations.
+
+    Returns
+    -------
+    by_tviv : pandas Series
+        No. edificaciones indexed by (cod, Material Pared, Material Piso, Tipo Vivienda) codes.
+    by_mat : pandas Series
+        No. edificaciones indexed by (cod, Material Pared, Material Piso) codes.
+
+    """
+    keys = [conteo_mpios["cod"]] + [conteo_mpios[col].cat.codes for col in COMBINATION_COLUMNS]
+    
+    by_tviv = conteo_mpios["No. edificaciones"].groupby(keys).sum()
+    by_mat = conteo_mpios["No. edificaciones"].groupby(keys[:3]).sum()
+    
+    return by_tviv, by_mat
+
+
+def count_matrix(by_tviv, by_mat, dist_mater_pivot, mpios):
+    """
+    Number of buildings of each municipality for each row of a scheme distribution. The
+    "No aplica" rows take every Tipo Vivienda of the Material Pared, Material Piso.
+
+    Parameters
+    ----------
+    by_tviv, by_mat : pandas Series
+        Output of combination_counts.
+    dist_mater_pivot : pandas DataFrame
+        Distribution of the scheme, see compile_scheme, encoded with encode_combinations.
+    mpios : array
+        Codes of the municipalities.
+
+    Returns
+    -------
+    counts : numpy array
+        (municipality x distribution row) matrix.
+
+    """
+    nrows = len(dist_mater_pivot)
+    cods = np.repeat(mpios, nrows)
+    pared = np.tile(dist_mater_pivot["Material Pared"].cat.codes.to_numpy(), len(mpios))
+    piso = np.tile(dist_mater_pivot["Material Piso"].cat.codes.to_numpy(), len(mpios))
+    tviv = np.tile(dist_mater_pivot["Tipo Vivienda"].cat.codes.to_numpy(), len(mpios))
+    noaplica = np.tile((dist_mater_pivot["Tipo Vivienda"] == "No aplica").to_numpy(), len(mpios))
+    
+    counts_tviv = by_tviv.reindex(pd.MultiIndex.from_arrays([cods, pared, piso, tviv]), fill_value=0).to_numpy()
+    counts_mat = by_mat.reindex(pd.MultiIndex.from_arrays([cods, pared, piso]), fill_value=0).to_numpy()
+    
+    counts = np.where(noaplica, counts_mat, counts_tviv)
+    
+    return counts.reshape(len(mpios), nrows)
+
+
+def taxonomy_matrix(conteo_mpios, mpios, schemes):
+    """
+    Typology distribution of many municipalities at once (not by block). The municipalities
+    are grouped by scheme and, for each scheme, the count matrix (see count_matrix) scales
+    the rows of the distribution matrix.
+
+    Parameters
+    ----------
+    conteo_mpios : pandas DataFrame
+        Input data with the results of the MAT distribution, encoded with encode_combinations.
+    mpios : list
+        (cod, mpio_name, scheme) of the municipalities, in the order of the output.
+    schemes : dict
+        Compiled distribution of the schemes, see compile_schemes, encoded with encode_combinations.
+
+    Returns
+    -------
+    tipologias : pandas DataFrame
+        Same as taxonomy (before rounding).
+    tiporesumen : pandas DataFrame
+        Same as taxonomy (before rounding).
+
+    """
+    by_tviv, by_mat = combination_counts(conteo_mpios)
+    mpios = pd.DataFrame(mpios, columns=["cod", "mpio_name", "scheme"])
+    
+    blocks = ut.ResultCollector()
+    for scheme, group in mpios.groupby("scheme", sort=False):
+        dist_mater_pivot = schemes[scheme]
+        nrows = len(dist_mater_pivot)
+        
+        counts = count_matrix(by_tviv, by_mat, dist_mater_pivot, group["cod"].to_numpy())
+        values = counts[:, :, None] * dist_mater_pivot.iloc[:, 3:].to_numpy()[None, :, :]
+        
+        block = dist_mater_pivot.iloc[np.tile(np.arange(nrows), len(group)), :3].reset_index(drop=True)
+        block = pd.concat([block, pd.DataFrame(values.reshape(-1, values.shape[2]), columns=dist_mater_pivot.columns[3:])], axis=1)
+        block.insert(0, 'cod', np.repeat(group["cod"].to_numpy(), nrows))
+        block.insert(1, 'mpio_name', np.repeat(group["mpio_name"].to_numpy(), nrows))
+        block["order"] = np.repeat(group.index.to_numpy(), nrows)
+        
+        blocks.add(block)
+    
+    # Rows in the order of the municipalities. Typologies missing in a municipality are set to 0
+    tipologias = blocks.to_frame()
+    tipologias = tipologias.sort_values("order", kind="mergesort").drop(columns="order").reset_index(drop=True).fillna(0)
+    
+    tiporesumen = tipologias.drop(columns=["Material Pared", "Material Piso", "Tipo Vivienda"])
+    tiporesumen = tiporesumen.groupby(["cod", "mpio_name"], sort=False).sum().reset_index()
+    
+    return tipologias, tiporesumen
+
+
+def taxonomy_blocks(conteo_mpios, mpios, schemes):
+    """
+    Typology distribution by block (manzana) of many municipalities at once. The
+    Tipo Vivienda of the Material Pared, Material Piso combinations with a "No aplica"
+    distribution is set to "No aplica", the data is grouped by block and combination and
+    joined with the distribution of the scheme, which is scaled by the number of buildings.
+
+    Parameters
+    ----------
+    conteo_mpios : pandas DataFrame
+        Input data with the results of the MAT distribution by block, encoded with encode_combinations.
+    mpios : list
+        (cod, mpio_name, scheme) of the municipalities, in the order of the output.
+    schemes : dict
+        Compiled distribution of the schemes, see compile_schemes, encoded with encode_combinations.
+
+    Returns
+    -------
+    tipologias : pandas DataFrame
+        Same as taxonomy (before rounding).
+    tiporesumen : pandas DataFrame
+        Same as taxonomy (before rounding).
+
+    """
+    mat = COMBINATION_COLUMNS
+    keys = ["Municipio", "UA_CLASE", "U_SECT_RUR", "U_SECC_RUR", "UA2_CPOB", "U_SECT_URB", "U_SECC_URB", "U_MZA"]
+    counts = ['No. edificaciones',
+              'TPER', 'THOG', 'THOM', 'TMUJ', 
+              'T00', 'T05', 'T10', 'T15', 'T20', 
+              'T25', 'T30', 'T35', 'T40', 'T45', 
+              'T50', 'T55', 'T60', 'T65', 'T70', 
+              'T75', 'T80', 'T85', 'T90', 'T95', 'T100']
+    
+    conteo = conteo_mpios
+    mpios = pd.DataFrame(mpios, columns=["cod", "mpio_name", "scheme"])
+    
+    blocks = ut.ResultCollector()
+    for scheme, group in mpios.groupby("scheme", sort=False):
+        dist_mater_pivot = schemes[scheme]
+        typologies = list(dist_mater_pivot.columns[3:])
+        
+        conteo_scheme = conteo[conteo["cod"].isin(group["cod"])].copy()
+        
+        noaplica = dist_mater_pivot.loc[dist_mater_pivot["Tipo Vivienda"] == "No aplica", mat[:2]]
+        rewrite = pd.MultiIndex.from_frame(conteo_scheme[mat[:2]]).isin(pd.MultiIndex.from_frame(noaplica))
+        conteo_scheme.loc[rewrite, "Tipo Vivienda"] = "No aplica"
+        
+        # Blocks are numbered in order of appearance
+        conteo_scheme["block"] = conteo_scheme.groupby(["cod"] + keys, sort=False).ngroup()
+        conteo_mza = conteo_scheme.groupby(["block", "cod"] + keys + mat, observed=True)[counts].sum().reset_index()
+        # With observed=True the groups are not sorted by category, the codes follow the sorted labels
+        conteo_mza = conteo_mza.sort_values(["block"] + mat, kind="mergesort").reset_index(drop=True)
+        conteo_mza["row"] = np.arange(len(conteo_mza))
+        
+        # The merge (by the category codes) does not keep the order of the blocks
+        dist_mater_mza = conteo_mza.merge(dist_mater_pivot, on=mat).sort_values("row", kind="mergesort")
+        dist_mater_mza[typologies] = dist_mater_mza[typologies].mul(dist_mater_mza["No. edificaciones"], axis=0)
+        
+        dist_mater_mza["mpio_name"] = dist_mater_mza["cod"].map(dict(zip(group["cod"], group["mpio_name"])))
+        dist_mater_mza["order"] = dist_mater_mza["cod"].map(dict(zip(group["cod"], group.index)))
+        
+        blocks.add(dist_mater_mza[["cod", "mpio_name"] + keys + mat + counts + typologies + ["order"]])
+    
+    # Rows in the order of the municipalities. Typologies missing in a municipality are set to 0
+    tipologias = blocks.to_frame()
+    tipologias = tipologias.sort_values("order", kind="mergesort").reset_index(drop=True)
+    
+    tiporesumen = tipologias.drop(columns=mat)
+    tiporesumen = tiporesumen.groupby(["order", "cod", "mpio_name"] + keys).sum().reset_index().drop(columns="order").fillna(0)
+    tipologias = tipologias.drop(columns="order").fillna(0)
+    
+    return tipologias, tiporesumen
+
+
+def taxonomy(conteo_mpios, mpios_list, mapping_list, mapping, detailed_1, detailed_2, deptcod, exclude, mza=False, schemes=None, sparse=False):
     """
     Principal function. Calculate the taxonomy distribution based on mapping and MAT distribution.
     Returns two main dataframes which one contains taxonomy matrix grouped by municipality and 
@@ -98,201 +744,80 @@ def taxonomy(conteo_mpios, mpios_list, mapping_list, mapping, detailed_1, detail
         List containing one or more department code.
     exclude : list
         List with municipalitites to be excluded.
+    mza : boolean, optional
+        True --> The taxonomy is calculated by block (manzana). The default is False.
+    schemes : dict, optional
+        Compiled distribution of the schemes, see compile_schemes. Schemes that are not
+        in the dict are compiled the first time they are used. The default is None.
+    sparse : boolean, optional
+        True --> The outputs are sparse tables (see tipologias_gem.TypologyTable) with only
+        the typologies with buildings of each row, computed by chunks of SPARSE_CHUNK
+        municipalities. to_dense gives the same DataFrames as sparse=False. The default is False.
 
     Returns
     -------
-    tipologias : pandas DataFrame
+    tipologias : pandas DataFrame or tipologias_gem.TypologyTable
         Contains the number of buildings by typology and MAT combination for each municipality.
-    tiporesumen : list
+        The MAT combination columns are strings (object dtype), as in the input csv.
+    tiporesumen : list or tipologias_gem.TypologyTable
         Contains the number of buildings by typology for each municipality.
 
     """
-    tipologias = pd.DataFrame()
-    tiporesumen = pd.DataFrame()
+    schemes = dict(schemes or {})
+    registry = mun.MunicipalityRegistry(mpios_list, mapping_list)
+    exclude = set(exclude)
+    
+    mpios_tax = []
     for dptocod in deptcod:
-        
-        dptocod = int(dptocod)
-        mpios_dpto = mpios_list[mpios_list["Departamento"] == dptocod]
+        for mpio in registry.department(dptocod):
             
-        for mpiocod in mpios_dpto['COD']:
+            if mpio.cod in exclude:
+                continue
             
-            mpios_filtered = mpios_dpto[mpios_dpto['COD'].isin([mpiocod])]
+            if mpio.scheme is None:
+                raise ValueError('El municipio {} no tiene esquema en la hoja "Lista"'.format(mpio.cod))
             
-            if mpiocod in exclude:
-                pass
-            else:
-                for m, data in mpios_filtered.iterrows():
-                    mpio = int(data["COD"])
-                    mpioname = data["Municipio_name"]
-                    print("Iterando municipio:{}, {}".format(mpio, mpioname))
-                    #%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
-                    mpio_list = mapping_list[mapping_list["Código"] == mpio]
-                    mpio_mapping = mpio_list["Esquema"]
-                    mpio_mapp = mpio_mapping.tolist()[0]
-                    dist_mater = pd.DataFrame()
-
-                    for i, row in mapping.iterrows():
-                        
-                        mat_pared = row["Material paredes/piso"]
-                        
-                        for key, value in row.iloc[1:].iteritems():
-                        
-                            if (value == "Detallado_1" or value == "Detallado_2"):
-                                
-                                if value == "Detallado_1":
-                                    
-                                    dist_comb = detailed_1[detailed_1["Esquema"].str.contains(mpio_mapp, regex=False)]
-                                else:
-                                    dist_comb = detailed_2[detailed_2["Esquema"].str.contains(mpio_mapp, regex=False)]
-                                
-                                
-                                for j, row in dist_comb.iterrows():
-                                    
-                                    viv_type = row["Esquema"].split("_")[-1]
-                                    
-                                    if viv_type not in ["Apartamento", "Casa"]:
-                                        viv_type = "No aplica"
-                                    
-                                    porcentaje = row[key]
-                                    
-                                    dist_mater = dist_mater.append({"Material Pared": mat_pared, "Material Piso": key, 
-                                                       "Tipo Vivienda": viv_type, "Combinación": row["Tipología"],
-                                                       "Porcentaje": float(porcentaje/100)}, ignore_index=True)
-                                
-                            else:
-                                
-                                dist_list = value.split()
-                                
-                                if len(dist_list) != 1:
-                                    
-                                    for p in range(0, len(dist_list), 2):
-                                        
-                                        dist_mater = dist_mater.append({"Material Pared": mat_pared, "Material Piso": key, 
-                                                           "Tipo Vivienda": "No aplica", "Combinación": dist_list[p+1],
-                                                           "Porcentaje": float(dist_list[p][:-1])/100}, ignore_index=True)
-       
-                    dist_mater_pivot = pd.pivot_table(dist_mater, index=['Material Pared', 'Material Piso', 'Tipo Vivienda'], columns=['Combinación'], values=['Porcentaje'], aggfunc=np.sum).fillna(0).reset_index()   
-                    dist_mater_pivot.columns = pd.Index(list(dist_mater_pivot.columns.get_level_values(0)[:3]) + list(dist_mater_pivot.columns.get_level_values(1)[3:]))
-                    
-                    dist_mater_pivot["Material Pared"] = dist_mater_pivot["Material Pared"].str.strip()
-                    dist_mater_pivot["Material Piso"] = dist_mater_pivot["Material Piso"].str.strip()
-                    dist_mater_pivot["Tipo Vivienda"] = dist_mater_pivot["Tipo Vivienda"].str.strip()
-                    
-                    conteo_estudio = conteo_mpios[conteo_mpios["cod"] == mpio]
-                    
-                    conteo_estudio.iloc[:]["Material Pared"] = conteo_estudio["Material Pared"].str.strip()
-                    conteo_estudio.iloc[:]["Material Piso"] = conteo_estudio["Material Piso"].str.strip()
-                    conteo_estudio.iloc[:]["Tipo Vivienda"] = conteo_estudio["Tipo Vivienda"].str.strip()
-                    
-                    if mza:
-                        subdivi = conteo_estudio[["cod", "Municipio", "UA_CLASE", "U_SECT_RUR", 
-                                            "U_SECC_RUR", "UA2_CPOB", "U_SECT_URB", 
-                                            "U_SECC_URB", "U_MZA"]].copy()
-                        subdivi = subdivi.drop_duplicates()
-                        
-                        dist_mater_mza = pd.DataFrame()
-                        for i, j in subdivi.iterrows():
-                            dist_mater_pmza = dist_mater_pivot.copy()
-                            
-                            jframe = j.to_frame().T
-                            conteo_mza = conteo_estudio.merge(jframe, on=["cod", "Municipio", "UA_CLASE", "U_SECT_RUR", 
-                                                            "U_SECC_RUR", "UA2_CPOB", "U_SECT_URB", 
-                                                            "U_SECC_URB", "U_MZA"])
-                                                                                          
-                            for index, row in dist_mater_pivot.iterrows():
-                                if row["Tipo Vivienda"] == "No aplica":
-                                    is_in = conteo_mza.isin([row["Material Pared"], row["Material Piso"], row["Tipo Vivienda"]])
-                                    if is_in["Material Pared"].any() == True and is_in["Material Piso"].any() == True and is_in["Tipo Vivienda"].all() == False:
-                                        
-                                        cidx= conteo_mza.index[(conteo_mza["Material Pared"] == row["Material Pared"]) & 
-                                               (conteo_mza["Material Piso"] == row["Material Piso"])].tolist()
-                                        conteo_mza.loc[cidx, "Tipo Vivienda"] = "No aplica"
-                                    
-                                    nedif_comb = conteo_mza[(conteo_mza["Material Pared"] == row["Material Pared"])\
-                                            & (conteo_mza["Material Piso"] == row["Material Piso"])]["No. edificaciones"].sum()
-                                else:
-                                    nedif_comb = conteo_mza[(conteo_mza["Material Pared"] == row["Material Pared"])\
-                                            & (conteo_mza["Material Piso"] == row["Material Piso"]) \
-                                            & (conteo_mza["Tipo Vivienda"] == row["Tipo Vivienda"])]["No. edificaciones"]
-                                
-                                    nedif_comb = nedif_comb.to_list()
-                                    if not nedif_comb:
-                                        nedif_comb = 0
-                                    else:
-                                        nedif_comb = sum(nedif_comb)
-                                        
-                                dist_mater_pmza.iloc[index, 3:] = dist_mater_pmza.iloc[index, 3:] * nedif_comb
-                            
-                            conteo_mza = conteo_mza.groupby(["Municipio", "UA_CLASE", "U_SECT_RUR", 
-                                                            "U_SECC_RUR", "UA2_CPOB", "U_SECT_URB", 
-                                                            "U_SECC_URB", "U_MZA", 'Material Pared','Material Piso', 'Tipo Vivienda'])[['No. edificaciones',
-                                      'TPER', 'THOG', 'THOM', 'TMUJ', 
-                                      'T00', 'T05', 'T10', 'T15', 'T20', 
-                                      'T25', 'T30', 'T35', 'T40', 'T45', 
-                                      'T50', 'T55', 'T60', 'T65', 'T70', 
-                                      'T75', 'T80', 'T85', 'T90', 'T95', 'T100']].sum().reset_index()
-                            
-                            dist_mater_merge = conteo_mza.merge(dist_mater_pmza,on=['Material Pared','Material Piso', 'Tipo Vivienda'])
-                            
-                            dist_mater_mza = dist_mater_mza.append(dist_mater_merge, ignore_index=True)
-                        
-                        dist_mater_pivot = dist_mater_mza        
-                        
-                    else:
-                        
-                        for index, row in dist_mater_pivot.iterrows():
-                            
-                            if row["Tipo Vivienda"] == "No aplica":
-                                nedif_comb = conteo_estudio[(conteo_estudio["Material Pared"] == row["Material Pared"])\
-                                        & (conteo_estudio["Material Piso"] == row["Material Piso"])]["No. edificaciones"].sum()
-                            else:
-                                nedif_comb = conteo_estudio[(conteo_estudio["Material Pared"] == row["Material Pared"])\
-                                        & (conteo_estudio["Material Piso"] == row["Material Piso"]) \
-                                        & (conteo_estudio["Tipo Vivienda"] == row["Tipo Vivienda"])]["No. edificaciones"]
-                            
-                                nedif_comb = nedif_comb.to_list()
-                                if not nedif_comb:
-                                    nedif_comb = 0
-                                else:
-                                    nedif_comb = sum(nedif_comb)
-                                    
-                            dist_mater_pivot.iloc[index, 3:] = dist_mater_pivot.iloc[index, 3:] * nedif_comb
-                            
-                                   
-    
-                    # if mza:
-                        # dist_mater_pivot.iloc[:, 37:] = dist_mater_pivot.iloc[:, 37:].apply(round_series_retain_integer_sum, axis=1).to_list()
-    
-                    # else:
-                    #     dist_mater_pivot.iloc[:, 3:] = dist_mater_pivot.iloc[:, 3:].apply(round_series_retain_integer_sum, axis=1).to_list()
-                    
-                    dist_mater_pivot.insert(0, 'cod', mpio)
-                    dist_mater_pivot.insert(1, 'mpio_name', mpioname)
-                    
-                    dist_mater_res = dist_mater_pivot.drop(columns=["Material Pared", 
-                                                                    "Material Piso", 
-                                                                    "Tipo Vivienda"])
-                    
-                    if mza:
-                        dist_mater_res = dist_mater_res.groupby(["cod", "mpio_name", "Municipio", "UA_CLASE", "U_SECT_RUR", 
-                                                            "U_SECC_RUR", "UA2_CPOB", "U_SECT_URB", 
-                                                            "U_SECC_URB", "U_MZA"]).sum().reset_index()
-                    else:
-                        dist_mater_res = dist_mater_res.groupby(["cod", "mpio_name"]).sum().reset_index()
-                    
-                    tipologias = tipologias.append(dist_mater_pivot, ignore_index=True)
-                    tiporesumen = tiporesumen.append(dist_mater_res, ignore_index=True)
-                    
-                    
-                    print("Terminado municipio:{}, {}".format(mpio, mpioname))
+            # The distribution of each scheme is compiled once
+            if mpio.scheme not in schemes:
+                schemes[mpio.scheme] = compile_scheme(mapping, detailed_1, detailed_2, mpio.scheme)
             
-                    tipologias = tipologias.fillna(0)
-                    tiporesumen = tiporesumen.fillna(0)
+            mpios_tax.append((mpio.cod, mpio.name, mpio.scheme))
     
+    # The MAT combination is joined by integer codes instead of strings
+    used = list(dict.fromkeys(scheme for _, _, scheme in mpios_tax))
+    dtypes = combination_dtypes(conteo_mpios, [schemes[scheme] for scheme in used])
+    conteo_mpios = encode_combinations(conteo_mpios, dtypes)
+    schemes = {scheme: encode_combinations(schemes[scheme], dtypes) for scheme in used}
     
-    idx = tipologias.columns.get_loc('ADO|EU/LWAL+DNO/H:1')
-    tipologias.iloc[:, idx:] = tipologias.iloc[:, idx:].apply(round_series_retain_integer_sum, axis=1).to_list()
-    idx = tiporesumen.columns.get_loc('ADO|EU/LWAL+DNO/H:1')
-    tiporesumen.iloc[:, idx:] = tiporesumen.iloc[:, idx:].apply(round_series_retain_integer_sum, axis=1).to_list()
-
-    return tipologias, tiporesumen
\ No newline at end of file
+    print("Calculando tipologías de {} municipios".format(len(mpios_tax)))
+    
+    if sparse:
+        # The rows of a municipality are in a single chunk, the sums of every row are the same of the dense outputs
+        tables, resumen = [], []
+        for i in range(0, len(mpios_tax), SPARSE_CHUNK):
+            chunk = mpios_tax[i:i + SPARSE_CHUNK]
+            conteo = conteo_mpios[conteo_mpios["cod"].isin([cod for cod, _, _ in chunk])]
+            
+            tipologias, tiporesumen = (taxonomy_blocks if mza else taxonomy_matrix)(conteo, chunk, schemes)
+            tables.append(tgem.TypologyTable.from_dense(tipologias))
+            resumen.append(tgem.TypologyTable.from_dense(tiporesumen))
+        
+        tipologias = round_table_retain_integer_sum(tgem.TypologyTable.concat(tables))
+        tiporesumen = round_table_retain_integer_sum(tgem.TypologyTable.concat(resumen))
+        tipologias.rows = decode_combinations(tipologias.rows)
+        tiporesumen.rows = decode_combinations(tiporesumen.rows)
+        
+        return tipologias, tiporesumen
+    
+    if mza:
+        tipologias, tiporesumen = taxonomy_blocks(conteo_mpios, mpios_tax, schemes)
+    else:
+        tipologias, tiporesumen = taxonomy_matrix(conteo_mpios, mpios_tax, schemes)
+    
+    idx = tipologias.columns.get_loc(FIRST_TYPOLOGY)
+    tipologias.iloc[:, idx:] = round_array_retain_integer_sum(tipologias.iloc[:, idx:].to_numpy())
+    idx = tiporesumen.columns.get_loc(FIRST_TYPOLOGY)
+    tiporesumen.iloc[:, idx:] = round_array_retain_integer_sum(tiporesumen.iloc[:, idx:].to_numpy())
+    
+    # The MAT combination is only encoded inside taxonomy, the outputs keep the string labels
+    return decode_combinations(tipologias), decode_combinations(tiporesumen)
\ No newline at end of file
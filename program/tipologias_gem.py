@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+"""
+    Esquema de las columnas de tipologías (taxonomía GEM) de las salidas de
+    pros_taxonomy ('tipologias', 'tiporesumen' y por manzana). Cada etiqueta,
+    ej: 'CR/LWAL+DUL/H:6,10', se separa una sola vez en material (CR), sistema
+    lateral (LWAL), ductilidad (DUL) y rango de pisos (6,10), y los índices de
+    los grupos de columnas se guardan para agregar por cualquier combinación
+    de atributos con una sola suma vectorizada.
+
+    TypologyTable guarda las mismas salidas en formato largo disperso (fila,
+    tipología, número de edificaciones), sin las celdas en cero.
+
+"""
+
+import re
+from collections import namedtuple
+import numpy as np
+import pandas as pd
+
+# GEM taxonomy code, e.g. "CR/LINF+DUL/H:6,10", "MATO/LN" or "UNK"
+TAXONOMY_PATTERN = r"^(UNK|[A-Z]+([+|][A-Z]+)*(/[A-Z]+([+|][A-Z]+)*)*(/H:\d+(,\d+)?)?)$"
+
+# Attributes of a typology, in the order of the GEM code
+ATTRIBUTES = ('material', 'system', 'ductility', 'other', 'height')
+
+# Aggregation of utilities.aggregate: every number of storeys of a typology
+STOREYS = ('material', 'system', 'ductility', 'other')
+
+#%% Funciones
+class Typology(namedtuple('Typology', ('label',) + ATTRIBUTES)):
+    """
+    Typology parsed from its GEM code, e.g. 'CR/LWAL+DUL/H:6,10' --> material 'CR',
+    system 'LWAL', ductility 'DUL', height '6,10'. Missing attributes are None, e.g. 'UNK'
+    only has material and 'MATO/LN' has no ductility nor height.
+    """
+    __slots__ = ()
+
+    def name(self, by=STOREYS):
+        """
+        GEM code with only the attributes of 'by', e.g. name(('material', 'system')) --> 'CR/LWAL'.
+        """
+        values = {attr: getattr(self, attr) if attr in by else None for attr in ATTRIBUTES}
+
+        name = values['material'] or ''
+        if values['system']:
+            name += '/' + values['system']
+        if values['ductility']:
+            name += ('+' if values['system'] else '/') + values['ductility']
+        if values['other']:
+            name += '/' + values['other']
+        if values['height']:
+            name += '/H:' + values['height']
+
+        return name.lstrip('/') or 'UNK'
+
+
+def parse_typology(label):
+    """
+    Parse a GEM code (see TAXONOMY_PATTERN) into a Typology.
+
+    Parameters
+    ----------
+    label : str
+        Typology code, e.g. 'ADO|EU/LWAL+DNO/H:1'.
+
+    Returns
+    -------
+    Typology
+
+    """
+    if not re.match(TAXONOMY_PATTERN, label):
+        raise ValueError('La tipología {} no tiene el formato de la taxonomía GEM'.format(label))
+
+    parts = label.split('/')
+    height = parts.pop()[2:] if parts[-1].startswith('H:') else None
+
+    material = parts[0]
+    system = ductility = None
+    if len(parts) > 1:
+        system, _, ductility = parts[1].partition('+')
+    other = '/'.join(parts[2:]) or None
+
+    return Typology(label, material, system or None, ductility or None, other, height)
+
+
+def typology_start(columns):
+    """
+    Position of the first typology column. The typologies are the last columns of the
+    outputs of pros_taxonomy, the block is the longest run of GEM codes at the end.
+
+    Parameters
+    ----------
+    columns : list or pandas Index
+        Columns of the DataFrame.
+
+    Returns
+    -------
+    int
+        Position of the first typology, len(columns) if there are no typologies.
+
+    """
+    start = len(columns)
+    while start > 0 and isinstance(columns[start - 1], str) and re.match(TAXONOMY_PATTERN, columns[start - 1]):
+        start -= 1
+
+    return start
+
+
+class TypologySchema(object):
+    """
+    Typology columns of a DataFrame parsed once, with the column groups of every
+    aggregation computed once and reused.
+
+    Parameters
+    ----------
+    labels : list
+        Typology columns (GEM codes), in the order of the DataFrame.
+
+    """
+    def __init__(self, labels):
+        self.labels = tuple(labels)
+        self.typologies = tuple(parse_typology(label) for label in self.labels)
+        self._groups = {}
+
+    @classmethod
+    def from_frame(cls, df):
+        """
+        Schema of the typology columns of df (see typology_start).
+        """
+        return cls(df.columns[typology_start(df.columns):])
+
+    def attribute(self, attr):
+        """
+        Values of an attribute (see ATTRIBUTES) for every typology column.
+        """
+        return [getattr(typology, attr) for typology in self.typologies]
+
+    def groups(self, by=STOREYS):
+        """
+        Groups of typology columns with the same attributes of 'by'.
+
+        Parameters
+        ----------
+        by : tuple, optional
+            Attributes kept in the groups, see ATTRIBUTES. The default is STOREYS
+            (typologies aggregated by number of storeys).
+
+        Returns
+        -------
+        names : list
+            Sorted names of the groups, e.g. 'CR/LWAL+DUL'.
+        codes : numpy array
+            Group (position in names) of every typology column.
+        order : numpy array
+            Positions of the columns sorted by group.
+        starts : numpy array
+            Position in 'order' of the first column of each group.
+
+        """
+        by = tuple(attr for attr in ATTRIBUTES if attr in by)
+
+        if by not in self._groups:
+            names, codes = np.unique([typology.name(by) for typology in self.typologies], return_inverse=True)
+            order = np.argsort(codes, kind='stable')
+            starts = np.flatnonzero(np.r_[True, np.diff(codes[order]) != 0]) if len(codes) else np.array([], dtype=int)
+            self._groups[by] = (list(names), codes, order, starts)
+
+        return self._groups[by]
+
+    def reduce(self, values, by=STOREYS):
+        """
+        Sum of the typology columns of values (rows x typologies) by group, see groups.
+        Missing values are counted as 0.
+
+        Returns
+        -------
+        names : list
+            Names of the groups.
+        reduced : numpy array
+            rows x groups.
+
+        """
+        names, _, order, starts = self.groups(by)
+        values = np.asarray(values)
+
+        if values.dtype.kind == 'f':
+            values = np.nan_to_num(values)
+
+        if not len(starts):
+            return names, np.zeros((len(values), 0), dtype=values.dtype)
+
+        return names, np.add.reduceat(values[:, order], starts, axis=1)
+
+    def aggregate(self, df, by=STOREYS):
+        """
+        Aggregate the typology columns of df by the attributes of 'by'. The other columns
+        are kept.
+
+        Parameters
+        ----------
+        df : pandas DataFrame
+            'tipologias', 'tiporesumen' or block output, with the typology columns of the schema.
+        by : tuple, optional
+            Attributes kept, see groups. The default is STOREYS.
+
+        Returns
+        -------
+        pandas DataFrame
+            Other columns of df and one column for each group.
+
+        """
+        start = len(df.columns) - len(self.labels)
+        if tuple(df.columns[start:]) != self.labels:
+            raise ValueError('Las columnas de tipologías no coinciden con el esquema')
+
+        names, reduced = self.reduce(df.iloc[:, start:].to_numpy(), by)
+
+        return pd.concat([df.iloc[:, :start], pd.DataFrame(reduced, index=df.index, columns=names)], axis=1)
+
+
+class TypologyTable(object):
+    """
+    Sparse long-format typology matrix: the other columns of each row and only the
+    non-zero (row, typology, count) cells, sorted by row and typology. Each row maps to
+    only a few typologies, so at block level it is much smaller than the dense output.
+
+    Parameters
+    ----------
+    rows : pandas DataFrame
+        Other columns of the rows (e.g. cod, mpio_name, blocks, MAT combination).
+    row : numpy array
+        Row (position in rows) of every cell.
+    typology : numpy array
+        Typology (position in typologies) of every cell.
+    count : numpy array
+        Number of buildings of every cell.
+    typologies : list
+        Typology labels, in the column order of the dense output.
+
+    """
+    def __init__(self, rows, row, typology, count, typologies):
+        self.rows = rows.reset_index(drop=True)
+        self.typologies = tuple(typologies)
+
+        order = np.lexsort((typology, row))
+        self.row = np.asarray(row, dtype=np.int64)[order]
+        self.typology = np.asarray(typology, dtype=np.int32)[order]
+        self.count = np.asarray(count)[order]
+
+    def __len__(self):
+        return len(self.rows)
+
+    @classmethod
+    def from_dense(cls, df):
+        """
+        Table of a dense output of pros_taxonomy, the typologies are its last columns
+        (see typology_start).
+        """
+        start = typology_start(df.columns)
+        values = df.iloc[:, start:].to_numpy()
+        row, typology = np.nonzero(values)
+
+        return cls(df.iloc[:, :start], row, typology, values[row, typology], df.columns[start:])
+
+    @classmethod
+    def concat(cls, tables):
+        """
+        Rows of many tables, one after the other. The typologies are in order of
+        appearance, as the columns of pandas.concat of the dense outputs.
+        """
+        typologies = {}
+        for table in tables:
+            for label in table.typologies:
+                typologies.setdefault(label, len(typologies))
+
+        rows, row, typology, count = [], [], [], []
+        offset = 0
+        for table in tables:
+            codes = np.array([typologies[label] for label in table.typologies], dtype=np.int32)
+            rows.append(table.rows)
+            row.append(table.row + offset)
+            typology.append(codes[table.typology])
+            count.append(table.count)
+            offset += len(table)
+
+        if not tables:
+            return cls(pd.DataFrame(), [], [], [], [])
+
+        return cls(pd.concat(rows, ignore_index=True), np.concatenate(row), np.concatenate(typology),
+                   np.concatenate(count), list(typologies))
+
+    def with_counts(self, count):
+        """
+        Same rows and cells with other counts (e.g. rounded), cells with count 0 are dropped.
+        """
+        keep = np.asarray(count) != 0
+
+        return TypologyTable(self.rows, self.row[keep], self.typology[keep], np.asarray(count)[keep], self.typologies)
+
+    def aggregate(self, by=STOREYS, schema=None):
+        """
+        Aggregate the typologies by the attributes of 'by', see TypologySchema.groups.
+        The groups are the typologies of the returned table.
+        """
+        schema = schema or TypologySchema(self.typologies)
+        names, codes, _, _ = schema.groups(by)
+
+        cells = pd.DataFrame({'row': self.row, 'group': codes[self.typology], 'count': self.count})
+        cells = cells.groupby(['row', 'group'], sort=True)['count'].sum().reset_index()
+
+        return TypologyTable(self.rows, cells['row'].to_numpy(), cells['group'].to_numpy(), cells['count'].to_numpy(), names)
+
+    def to_dense(self):
+        """
+        Dense DataFrame with one column for each typology, as the outputs of pros_taxonomy.
+        """
+        values = np.zeros((len(self.rows), len(self.typologies)), dtype=self.count.dtype if len(self.count) else float)
+        values[self.row, self.typology] = self.count
+
+        return pd.concat([self.rows, pd.DataFrame(values, columns=list(self.typologies))], axis=1)
+
+    def to_long(self, label="Tipología", value="Edificaciones"):
+        """
+        Long DataFrame with one row for each cell: the other columns of its row, the
+        typology (categorical) and the number of buildings.
+        """
+        long = self.rows.iloc[self.row].reset_index(drop=True)
+        long[label] = pd.Categorical.from_codes(self.typology, list(self.typologies))
+        long[value] = self.count
+
+        return long
@@ -5,17 +5,43 @@ Created on Wed Jul  7 11:50:34 2021
 @author: Juan Camilo Victoria & Santiago Sepúlveda
 """
 
+import json
+import os
+import numpy as np
 import pandas as pd
 import unidecode
+import tipologias_gem as tgem
+
+# Output formats of save_table {format: function(df, path)}, the extension of the files is '.' + format.
+# Other formats can be added with a writer here and a reader in READERS.
+WRITERS = {'csv': lambda df, path: df.to_csv(path, index=False),
+           'csv.gz': lambda df, path: df.to_csv(path, index=False),
+           'parquet': lambda df, path: df.to_parquet(path, index=False),
+           'feather': lambda df, path: df.reset_index(drop=True).to_feather(path)}
+
+# Readers of read_table {format: function(path)}, in the order tried when the path has no extension
+READERS = {'parquet': pd.read_parquet,
+           'feather': pd.read_feather,
+           'csv.gz': pd.read_csv,
+           'csv': pd.read_csv}
+
+# Partitions of save_table computed from the DIVIPOLA code (COD or cod column)
+CODE_PARTITIONS = {'departamento': lambda cod: cod // 1000, 'municipio': lambda cod: cod}
+
+# Dimensions and measures of MaterialCube
+CUBE_DIMENSIONS = ("Material Pared", "Material Piso", "Tipo Vivienda", "Estrato")
+CUBE_MEASURES = ("No. edificaciones", "TPER", "THOG")
 
 def nvalxmat(csv, col, val):
     """
-    Makes a pivot table to know number of buildings/people/homes grouped by material of wall/floor or building type
+    Makes a pivot table to know number of buildings/people/homes grouped by material of wall/floor or building type.
+    To make several pivot tables of the same file use a MaterialCube, the file is read once.
 
     Parameters
     ----------
-    csv : pandas DataFrame
-        CSV file which contains number of buildings by material combination.
+    csv : string (path) or MaterialCube
+        File which contains number of buildings by material combination, with or without
+        extension (see read_table).
     col : string
         may be any of "Material Pared", "Material Piso", "Tipo Vivienda".
     val : string
@@ -23,17 +49,120 @@ def nvalxmat(csv, col, val):
 
     Returns
     -------
-    None.
+    pivot : pandas DataFrame
+        COD and one column for each value of col.
 
     """
+    cube = csv if isinstance(csv, MaterialCube) else MaterialCube.from_file(csv, dims=[col], measures=[val])
     
-    file = "{}.csv".format(csv)
-    csv_file = pd.read_csv(r"{}".format(file))
+    return cube.pivot(col, val)
+
+class MaterialCube(object):
+    """
+    Sums of the measures (No. edificaciones, TPER, THOG) of the results by municipality and
+    MAT combination, computed with a single group by. Every pivot table of nvalxmat is
+    sliced from the cube in memory, the totals by municipality and each dimension are
+    computed once and reused.
+
+    Parameters
+    ----------
+    df : pandas DataFrame
+        Results by MAT combination, e.g. result_dptos.
+    dims : tuple, optional
+        Dimensions of the cube, the ones that are not in df are ignored. The default is CUBE_DIMENSIONS.
+    measures : tuple, optional
+        Measures summed, the ones that are not in df are ignored. The default is CUBE_MEASURES.
+    index : string, optional
+        Column with the code of the municipality. The default is "COD".
+
+    """
+    def __init__(self, df, dims=CUBE_DIMENSIONS, measures=CUBE_MEASURES, index="COD"):
+        self.index = index
+        self.dims = [dim for dim in dims if dim in df.columns]
+        self.measures = [measure for measure in measures if measure in df.columns]
+        self.margins = {}
+        
+        self.cube = df.groupby([index] + self.dims, sort=False, observed=True, dropna=False)[self.measures].sum().reset_index()
+        
+        # Without sorting, the categories are reordered by appearance
+        for dim in self.dims:
+            if isinstance(df[dim].dtype, pd.CategoricalDtype):
+                self.cube[dim] = self.cube[dim].cat.set_categories(df[dim].cat.categories)
     
-    pivot = csv_file.pivot_table(index=["COD"], columns=[col], values=val, 
-                  aggfunc = "sum", fill_value = 0).reset_index()
+    @classmethod
+    def from_file(cls, path, dims=CUBE_DIMENSIONS, measures=CUBE_MEASURES, index="COD", partitions=None):
+        """
+        Cube of a results file, read once with read_table (any format of save_table).
+        """
+        return cls(read_table(path, partitions), dims, measures, index)
+    
+    def margin(self, col):
+        """
+        Sums of every measure by municipality and the values of a dimension.
 
-    return pivot
+        Returns
+        -------
+        pandas DataFrame
+            Indexed by (index, col), one column for each measure.
+
+        """
+        if col not in self.dims:
+            raise ValueError('{} no es una dimensión del cubo: {}'.format(col, self.dims))
+        
+        if col not in self.margins:
+            self.margins[col] = self.cube.groupby([self.index, col], observed=False)[self.measures].sum()
+        
+        return self.margins[col]
+    
+    def pivot(self, col, val):
+        """
+        Pivot table of a measure by municipality (rows) and the values of a dimension
+        (columns), same as DataFrame.pivot_table with aggfunc "sum" and fill_value 0.
+
+        Parameters
+        ----------
+        col : string
+            Dimension, e.g. "Material Pared".
+        val : string
+            Measure, e.g. "No. edificaciones".
+
+        Returns
+        -------
+        pivot : pandas DataFrame
+            index and one column for each value of col.
+
+        """
+        if val not in self.measures:
+            raise ValueError('{} no es una medida del cubo: {}'.format(val, self.measures))
+        
+        pivot = self.margin(col)[val].unstack(fill_value=0)
+        
+        # As pivot_table, the sums without decimals are integers (e.g. TPER)
+        for value in pivot.columns:
+            if pivot[value].dtype.kind == 'f' and np.array_equal(pivot[value], np.trunc(pivot[value])):
+                pivot[value] = pivot[value].astype(np.int64)
+        
+        return pivot.reset_index()
+    
+    def pivots(self, cols=None, vals=None):
+        """
+        Pivot tables of every dimension and measure, e.g. the number of buildings and of
+        people by wall material.
+
+        Parameters
+        ----------
+        cols : list, optional
+            Dimensions. The default is None (every dimension).
+        vals : list, optional
+            Measures. The default is None (every measure).
+
+        Returns
+        -------
+        dict
+            {(col, val): pivot table}.
+
+        """
+        return {(col, val): self.pivot(col, val) for col in cols or self.dims for val in vals or self.measures}
 
 def changetilde(df):
     
@@ -43,30 +172,216 @@ def changetilde(df):
         
     return df
 
-def save_csv(result, name):
+def save_csv(result, name, dense=False):
     """
     Save any DataFrame in csv format
 
     Parameters
     ----------
-    result : pandas DataFrame
+    result : pandas DataFrame or tipologias_gem.TypologyTable
         DESCRIPTION.
     name : string
         DESCRIPTION.
+    dense : boolean, optional
+        Only for a TypologyTable. True --> It is saved with one column for each typology,
+        False --> one row for each typology with buildings (long format). The default is False.
 
     Returns
     -------
     None.
 
     """
-    result.to_csv("{}.csv".format(name), index=False)
+    save_table(result, name, 'csv', dense=dense)
     
     return
 
+def save_table(result, name, fmt='csv', partition=None, dtypes=None, dense=False):
+    """
+    Save any DataFrame in any format of WRITERS, e.g. Parquet, Feather or compressed csv,
+    in one file or in one file for each partition.
+
+    Parameters
+    ----------
+    result : pandas DataFrame or tipologias_gem.TypologyTable
+        Results to save.
+    name : string
+        Path without extension.
+    fmt : string, optional
+        'csv', 'csv.gz', 'parquet' or 'feather'. The default is 'csv'.
+    partition : string, optional
+        'departamento' or 'municipio' (from the DIVIPOLA code) or any column of result. The
+        files and a manifest.json with the dtypes are saved in the folder name + '.' + fmt.
+        The default is None (one file).
+    dtypes : dict, optional
+        {column: dtype} set before saving, e.g. {'COD': 'int32', 'Tipo Vivienda': 'category'}.
+        The default is None.
+    dense : boolean, optional
+        Only for a TypologyTable, see save_csv. The default is False.
+
+    Returns
+    -------
+    path : string (path)
+        File or folder saved.
+
+    """
+    if fmt not in WRITERS:
+        raise ValueError('Formato desconocido: {}, debe ser uno de {}'.format(fmt, list(WRITERS)))
+    
+    if isinstance(result, tgem.TypologyTable):
+        result = result.to_dense() if dense else result.to_long()
+    
+    if dtypes:
+        result = result.astype(dtypes)
+    
+    path = "{}.{}".format(name, fmt)
+    if partition is None:
+        WRITERS[fmt](result, path)
+        return path
+    
+    if partition in CODE_PARTITIONS:
+        code = "COD" if "COD" in result.columns else "cod"
+        keys = CODE_PARTITIONS[partition](result[code].astype(np.int64))
+        label = '{:02d}' if partition == 'departamento' else '{:05d}'
+    else:
+        keys = result[partition]
+    
+    os.makedirs(path, exist_ok=True)
+    manifest = {'format': fmt, 'partition': partition, 'files': [],
+                'dtypes': result.dtypes.astype(str).to_dict(),
+                'categories': {col: result[col].cat.categories.tolist() for col in result.columns
+                               if isinstance(result[col].dtype, pd.CategoricalDtype)}}
+    
+    for i, (key, part) in enumerate(result.groupby(keys, sort=False, observed=True)):
+        key = key.item() if isinstance(key, np.generic) else key
+        file = "{}={}.{}".format(partition, label.format(key) if partition in CODE_PARTITIONS else '{:04d}'.format(i), fmt)
+        WRITERS[fmt](part, os.path.join(path, file))
+        manifest['files'].append([key, file])
+    
+    with open(os.path.join(path, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2, default=str)
+    
+    return path
+
+def read_table(path, partitions=None):
+    """
+    Read a file saved with save_table (or any csv), the format is detected from the
+    extension. If path has no extension, the formats of READERS are tried in order.
+
+    Parameters
+    ----------
+    path : string (path)
+        File or partitioned folder, with or without extension.
+    partitions : list, optional
+        Only for a partitioned folder, partitions read, e.g. ['05', '68'] with 'departamento'.
+        The default is None (every partition).
+
+    Returns
+    -------
+    pandas DataFrame
+        Results with the dtypes saved.
+
+    """
+    fmt = next((fmt for fmt in sorted(READERS, key=len, reverse=True) if path.endswith('.' + fmt)), None)
+    if fmt is None:
+        fmt = next((fmt for fmt in READERS if os.path.exists("{}.{}".format(path, fmt))), None)
+        if fmt is None:
+            raise FileNotFoundError('No existe {} en ninguno de los formatos {}'.format(path, list(READERS)))
+        path = "{}.{}".format(path, fmt)
+    
+    if not os.path.isdir(path):
+        return READERS[fmt](path)
+    
+    with open(os.path.join(path, 'manifest.json')) as f:
+        manifest = json.load(f)
+    
+    files = manifest['files']
+    if partitions is not None:
+        if manifest['partition'] in CODE_PARTITIONS:
+            partitions = [int(key) for key in partitions]
+        files = [(key, file) for key, file in files if key in partitions]
+    
+    dtypes = dict(manifest['dtypes'])
+    dtypes.update({col: pd.CategoricalDtype(categories) for col, categories in manifest['categories'].items()})
+    
+    parts = [READERS[manifest['format']](os.path.join(path, file)).astype(dtypes) for _, file in files]
+    if not parts:
+        return pd.DataFrame({col: pd.Series(dtype=dtype) for col, dtype in dtypes.items()})
+    
+    return pd.concat(parts, ignore_index=True)
+
+class ResultCollector(object):
+    """
+    Collects the partial results (DataFrames or single rows) of a loop and concatenates
+    them once in to_frame, instead of calling DataFrame.append in every iteration, which
+    copies the whole accumulated DataFrame each time.
+
+    Parameters
+    ----------
+    spill_dir : string (path), optional
+        Folder where every part is written (pickle) as soon as it is added, so that
+        only the part being processed is held in memory. The default is None (in memory).
+    name : string, optional
+        Prefix of the files written in spill_dir. The default is 'part'.
+
+    """
+    def __init__(self, spill_dir=None, name='part'):
+        self.spill_dir = spill_dir
+        self.name = name
+        self.parts = []
+        self.records = []
+        
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+    
+    def add(self, df):
+        """
+        Add a DataFrame.
+        """
+        self._flush_records()
+        self._store(df)
+    
+    def add_record(self, record):
+        """
+        Add a single row, as a dict {column: value}.
+        """
+        self.records.append(record)
+    
+    def to_frame(self):
+        """
+        Concatenate all the parts in the order they were added.
+
+        Returns
+        -------
+        pandas DataFrame
+            Parts concatenated with a new index. Empty DataFrame if nothing was added.
+
+        """
+        self._flush_records()
+        frames = [pd.read_pickle(part) if isinstance(part, str) else part for part in self.parts]
+        
+        if not frames:
+            return pd.DataFrame()
+        
+        return pd.concat(frames, ignore_index=True, sort=False)
+    
+    def _flush_records(self):
+        if self.records:
+            self._store(pd.DataFrame(self.records))
+            self.records = []
+    
+    def _store(self, df):
+        if self.spill_dir is None:
+            self.parts.append(df)
+        else:
+            path = os.path.join(self.spill_dir, '{}_{:06d}.pkl'.format(self.name, len(self.parts)))
+            df.to_pickle(path)
+            self.parts.append(path)
+
 def setmax(df):
     """
     Set to 1 the typology with maximum number of buildings of the 'tiporesumen' output. 
-    Helps to identify and to plot in maps the most common typology.
+    Helps to identify and to plot in maps the most common typology. dominant_typologies
+    gives the same typology as a single categorical column, for large or block outputs.
 
     Parameters
     ----------
@@ -79,50 +394,100 @@ def setmax(df):
         DESCRIPTION.
 
     """
-    idxmax_row = df.iloc[:, 2:].idxmax(axis=1)
+    values = df.iloc[:, 2:].to_numpy(dtype=float)
+    idxmax_row = np.argmax(np.where(np.isnan(values), -np.inf, values), axis=1)
+    
+    onehot = np.zeros(values.shape, dtype=bool)
+    onehot[np.arange(len(values)), idxmax_row] = True
+    
+    # The typology columns keep their dtype
     vis_data = df.copy()
     vis_data.iloc[:, 2:] = 0
-    
-    for i, row in vis_data.iterrows():
-        vis_data.loc[i, idxmax_row[i]] = 1.0
+    vis_data.iloc[:, 2:] = vis_data.iloc[:, 2:].mask(onehot, 1)
     
     return vis_data
 
-def cutstr(string):
-    if string.split('/')[-1][0] == 'H':
-        name = "/".join(string.split('/')[:-1])
+def dominant_typologies(tipo, k=1, by=None, schema=None):
+    """
+    Dominant typology (or the k typologies with more buildings) of every row of a
+    taxonomy output, in one pass over the typology columns. Instead of the one-hot
+    matrix of setmax, each typology is a categorical column (code and label) with its
+    number of buildings and its share of the row.
+
+    Parameters
+    ----------
+    tipo : pandas DataFrame
+        'tipologias', 'tiporesumen' or block DataFrame output.
+    k : int, optional
+        Number of typologies of each row. The default is 1.
+    by : tuple, optional
+        Attributes of the typologies (see tipologias_gem.ATTRIBUTES), e.g. ('material',)
+        gives the dominant material. The default is None (the typologies).
+    schema : tipologias_gem.TypologySchema, optional
+        Schema of the typology columns of tipo. The default is None (parsed from tipo).
+
+    Returns
+    -------
+    dominant : pandas DataFrame
+        Other columns of tipo and, for i in 1..k, "Tipología i", "Edificaciones i" and
+        "Participación i". Rows without buildings have no typology and share 0; ties
+        keep the first typology, as setmax.
+
+    """
+    if schema is None:
+        schema = tgem.TypologySchema.from_frame(tipo)
+    
+    start = len(tipo.columns) - len(schema.labels)
+    values = tipo.iloc[:, start:].to_numpy()
+    if by is None:
+        names = list(schema.labels)
+        values = np.nan_to_num(values) if values.dtype.kind == 'f' else values
     else:
-        name = string
-    return name
+        names, values = schema.reduce(values, by)
+    
+    k = min(k, len(names))
+    total = values.sum(axis=1)
+    # Stable sort, ties keep the column order
+    top = np.argsort(-values, axis=1, kind='stable')[:, :k]
+    counts = np.take_along_axis(values, top, axis=1)
+    shares = np.divide(counts, total[:, None], out=np.zeros(counts.shape), where=total[:, None] > 0)
+    
+    dominant = tipo.iloc[:, :start].copy()
+    for i in range(k):
+        codes = np.where(counts[:, i] > 0, top[:, i], -1)
+        dominant["Tipología {}".format(i + 1)] = pd.Categorical.from_codes(codes, names)
+        dominant["Edificaciones {}".format(i + 1)] = counts[:, i]
+        dominant["Participación {}".format(i + 1)] = shares[:, i]
+    
+    return dominant
 
-def aggregate(tipo):
+def aggregate(tipo, by=tgem.STOREYS, schema=None):
     """
     Aggregates typologies by all number of storeys.
 
     Parameters
     ----------
-    tipo : pandas DataFrame
-        'tipologias' DataFrame output.
+    tipo : pandas DataFrame or tipologias_gem.TypologyTable
+        'tipologias', 'tiporesumen' or block output, dense or sparse (taxonomy with sparse=True).
+    by : tuple, optional
+        Attributes of the typologies kept (see tipologias_gem.ATTRIBUTES), e.g. ('material',)
+        aggregates by material. The default is every attribute but the number of storeys.
+    schema : tipologias_gem.TypologySchema, optional
+        Schema of the typology columns of tipo, reused between calls. The default is None
+        (parsed from tipo).
 
     Returns
     -------
-    tipoagg : pandas DataFrame
+    tipoagg : pandas DataFrame or tipologias_gem.TypologyTable
         DataFrame with number of buildings by typology aggregated by number of storeys.
     """
-    tipoaggu = tipo.copy()
-    idx = tipoaggu.columns.get_loc('ADO|EU/LWAL+DNO/H:1')
-    
-    colnames = tipoaggu.columns[idx:].tolist()
-    nnames = {}
-    for name in colnames:
-        nnames[name]  = cutstr(name)
+    if isinstance(tipo, tgem.TypologyTable):
+        return tipo.aggregate(by, schema)
     
-    tipoaggu.rename(nnames, axis=1,
-                      inplace=True)
+    if schema is None:
+        schema = tgem.TypologySchema.from_frame(tipo)
     
-    tipoaggr=tipoaggu.iloc[:,idx:].groupby(tipoaggu.columns[idx:], axis=1).sum()
-    
-    tipoagg = pd.merge(tipoaggu.iloc[:,:idx], tipoaggr, left_index=True, right_index=True)
+    tipoagg = schema.aggregate(tipo, by)
     
     return tipoagg
 
@@ -148,6 +513,32 @@ colorlist = ["forestgreen",
              "mediumpurple",
              "chocolate"]
 
+def dominantRules(field, categories, colorlist):
+    """
+    Rules of the symbology of a QGIS layer joined with the 'dominant_typologies' output,
+    one rule for each typology of the field, e.g. "Tipología 1". Use it with qgisApplyRules.
+
+    Parameters
+    ----------
+    field : string
+        Name of the field with the typology in the layer.
+    categories : list
+        Typologies with a rule, e.g. dominant["Tipología 1"].cat.categories.
+    colorlist : list
+        List with color names that will be related with each rule.
+
+    Returns
+    -------
+    rules : list
+        (label, expression, color, scale) of every rule.
+
+    """
+    rules = []
+    for category, color in zip(categories, colorlist):
+        rules.append((category, '"{}" = \'{}\''.format(field, category), color, None))
+    
+    return rules
+
 def qgisRuleSymbology(fieldi, nrange, colorlist):
     """
     Function to set rules symbology in QGIS layer. Works with 'setmax' output.
@@ -178,7 +569,28 @@ def qgisRuleSymbology(fieldi, nrange, colorlist):
     for i in range(nrange):
         label = fields[fieldi+i].split("_")[-1]
         rules.append(('{}'.format(label), '"' + fields[fieldi+i] + '"' + '= 1', colorlist[i], None))
+    
+    qgisApplyRules(rules)
+    
+    return
+
+def qgisApplyRules(rules):
+    """
+    Set the rules symbology of the active QGIS layer, see qgisRuleSymbology and dominantRules.
+    This function only works in the QGIS python console.
+
+    Parameters
+    ----------
+    rules : list
+        (label, expression, color name, scale) of every rule, scale is None or (min, max).
+
+    Returns
+    -------
+    None.
 
+    """
+    layer = iface.activeLayer()
+    
     #$$ Create new symbology
     symbol = QgsSymbol.defaultSymbol(layer.geometryType())
     renderer = QgsRuleBasedRenderer(symbol)
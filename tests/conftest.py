@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+"""
+Los módulos del programa se importan desde la carpeta program, como en inventario.py.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'program'))
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""
+Paridad entre la ejecución por municipio y la ejecución por departamento
+(batch=True) de procesamiento_datos.func_principal, y entre la lectura con y sin
+el filtro de CLASE aplicado en los lectores, con datos sintéticos.
+"""
+
+import pandas as pd
+import pytest
+import benchmark
+import procesamiento_datos as pdat
+
+DEPTOS = [('05', 'Sintetico'), ('68', 'Sintetico')]
+
+
+@pytest.fixture(scope='module')
+def folder(tmp_path_factory):
+    path = tmp_path_factory.mktemp('cnpv')
+    for i, (dptocod, depto) in enumerate(DEPTOS):
+        benchmark.write_synthetic(str(path), dptocod, depto, n_viv=6000, n_mpios=6, seed=i)
+
+    return str(path)
+
+
+@pytest.mark.parametrize('filtClase', [[1], [1, 2], [1, 2, 3]])
+@pytest.mark.parametrize('args', [(True, True), (False, True)])
+def test_batch_equals_loop(folder, filtClase, args):
+    deptcod, deptname = [list(values) for values in zip(*DEPTOS)]
+    runs = [pdat.func_principal(folder, deptcod, deptname, filtClase, [1, 2], [1, 2, 3], *args, batch=batch, seed=3)[:3]
+            for batch in (False, True)]
+
+    for loop, batch in zip(*runs):
+        pd.testing.assert_frame_equal(loop.reset_index(drop=True), batch.reset_index(drop=True))
+
+
+@pytest.mark.parametrize('batch', [False, True])
+def test_pushdown_equals_no_pushdown(folder, tmp_path, batch):
+    # CLASE is only pushed down to the readers without summaries and without stage cache
+    deptcod, deptname = [list(values) for values in zip(*DEPTOS)]
+    runs = [pdat.func_principal(folder, deptcod, deptname, [2, 3], [1, 2], [1, 2, 3], False, False, batch=batch, seed=3,
+                                stage_cache_dir=stage_cache_dir)[0]
+            for stage_cache_dir in (None, str(tmp_path))]
+
+    pd.testing.assert_frame_equal(runs[0].reset_index(drop=True), runs[1].reset_index(drop=True))
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+procesamiento_datos.conditional_mode da la misma moda condicionada que func_mode y
+func_mode_tviv aplicadas grupo por grupo, con empates y grupos con solo el valor excluido.
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+import procesamiento_datos as pdat
+
+
+def random_groups(values, p, n=2000, seed=0):
+    # Small groups so that ties and groups with only the excluded value are frequent
+    rng = np.random.RandomState(seed)
+    groups = np.repeat(np.arange(n), rng.randint(1, 7, size=n))
+    rng.shuffle(groups)
+
+    return groups, rng.choice(values, len(groups), p=p).astype(np.float32)
+
+
+def expected_modes(groups, values, func):
+    return np.array([func(pd.Series(values[groups == g])) for g in range(groups.max() + 1)])
+
+
+@pytest.mark.parametrize('p', [[0.4, 0.3, 0.3], [0.7, 0.15, 0.15], [0.2, 0.4, 0.4]])
+def test_func_mode(p):
+    groups, values = random_groups([0, 1, 2], p)
+
+    np.testing.assert_array_equal(pdat.conditional_mode(groups, values, 0), expected_modes(groups, values, pdat.func_mode))
+
+
+@pytest.mark.parametrize('p', [[0.3, 0.3, 0.4], [0.15, 0.15, 0.7]])
+def test_func_mode_tviv(p):
+    groups, values = random_groups([1, 2, 3], p)
+
+    # Without seed the fallback is drawn in group order from the global generator, as func_mode_tviv
+    np.random.seed(1)
+    expected = expected_modes(groups, values, pdat.func_mode_tviv)
+    np.random.seed(1)
+    np.testing.assert_array_equal(pdat.conditional_mode(groups, values, 3, (1, 3)), expected)
+
+
+def test_ties():
+    groups = np.array([0, 0, 1, 1, 1, 1, 2, 2, 2, 2, 3, 3, 4, 4, 4])
+    values = np.array([2, 1, 0, 0, 2, 1, 0, 0, 1, 2, 0, 0, 0, 2, 1])
+
+    np.testing.assert_array_equal(pdat.conditional_mode(groups, values, 0), expected_modes(groups, values, pdat.func_mode))
+    np.testing.assert_array_equal(pdat.conditional_mode(groups, values, 0), [1, 2, 1, 0, 1])
+
+
+def test_seeded_fallback():
+    groups, values = random_groups([1, 2, 3], [0.15, 0.15, 0.7])
+    keys = pd.DataFrame({'U_MPIO': np.arange(groups.max() + 1) % 7, 'U_EDIFICA': np.arange(groups.max() + 1)})
+
+    mode = pdat.conditional_mode(groups, values, 3, (1, 3), seed=5, keys=keys)
+    only_excluded = np.array([(values[groups == g] == 3).all() for g in range(len(keys))])
+    assert only_excluded.any()
+    assert set(mode[only_excluded]) == {1, 2}
+
+    # The groups with other values follow func_mode_tviv
+    expected = expected_modes(groups, values, pdat.func_mode_tviv)
+    np.testing.assert_array_equal(mode[~only_excluded], expected[~only_excluded])
+    np.testing.assert_array_equal(pdat.conditional_mode(groups, values, 3, (1, 3), seed=5, keys=keys), mode)
+
+    # The draw of each group only depends on its keys, not on the other groups
+    kept = np.flatnonzero(keys['U_EDIFICA'] % 3 != 0)
+    rows = np.isin(groups, kept)
+    subset = pdat.conditional_mode(np.searchsorted(kept, groups[rows]), values[rows], 3, (1, 3), seed=5, keys=keys.iloc[kept])
+    np.testing.assert_array_equal(subset, mode[kept])
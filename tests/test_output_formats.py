@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+Los resultados de procesamiento_datos.func_principal guardados con utilities.save_table
+en Parquet o Feather dan las mismas tipologías que el csv.
+"""
+
+import os
+import pandas as pd
+import pytest
+import benchmark
+import procesamiento_datos as pdat
+import pros_taxonomy as tax
+import utilities as ut
+
+pytest.importorskip('pyarrow')
+
+DEPTOS = [('05', 'Sintetico'), ('68', 'Sintetico')]
+MAPPING_PATH = os.path.join(os.path.dirname(__file__), os.pardir, 'files', 'Esquema_clasificacion.xlsx')
+
+
+@pytest.fixture(scope='module')
+def result(tmp_path_factory):
+    path = tmp_path_factory.mktemp('cnpv')
+    for i, (dptocod, depto) in enumerate(DEPTOS):
+        benchmark.write_synthetic(str(path), dptocod, depto, n_viv=6000, n_mpios=6, seed=i)
+
+    deptcod, deptname = [list(values) for values in zip(*DEPTOS)]
+    return pdat.func_principal(str(path), deptcod, deptname, [1, 2, 3], [1, 2], [1, 2, 3], True, True, seed=3)[0]
+
+
+@pytest.fixture(scope='module')
+def mapping_tables(tmp_path_factory):
+    return tax.load_mapping(MAPPING_PATH, cache_path=str(tmp_path_factory.mktemp('mapping') / 'mapping.pkl'))
+
+
+def run_taxonomy(path, mapping_tables):
+    ins = tax.read_input(MAPPING_PATH, path, False, mapping_tables=mapping_tables)
+    present = set(ins[0]['cod'])
+    exclude = [5001, 11001, 76001] + [cod for cod in ins[1]['COD'] if cod not in present]
+
+    return tax.taxonomy(*ins, [dptocod for dptocod, _ in DEPTOS], exclude, schemes=mapping_tables.schemes)
+
+
+@pytest.mark.parametrize('fmt, partition', [('parquet', None), ('parquet', 'departamento'),
+                                            ('feather', None), ('feather', 'municipio')])
+def test_taxonomy_equals_csv(tmp_path, result, mapping_tables, fmt, partition):
+    expected = run_taxonomy(ut.save_table(result, str(tmp_path / 'csv'), 'csv'), mapping_tables)
+    assert expected[1].loc[:, tax.FIRST_TYPOLOGY:].to_numpy().sum() > 0
+
+    path = ut.save_table(result, str(tmp_path / fmt), fmt, partition=partition)
+    for tipologias, tipologias_csv in zip(run_taxonomy(path, mapping_tables), expected):
+        pd.testing.assert_frame_equal(tipologias.reset_index(drop=True), tipologias_csv.reset_index(drop=True))
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+Redondeo de las matrices de tipologías: las versiones vectorizadas (densa y
+TypologyTable) conservan la suma de cada fila y desempatan igual que
+round_series_retain_integer_sum.
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+import pros_taxonomy as tax
+import tipologias_gem as tgem
+
+
+def random_rows(rng, nrows, ncols):
+    """
+    Rows with an integer sum: random shares, exact .5 ties, equal fractions, only
+    integers, zeros and missing values.
+    """
+    xs = np.zeros((nrows, ncols))
+    for i, kind in enumerate(rng.randint(0, 6, nrows)):
+        if kind == 0:
+            xs[i] = rng.randint(0, 50) * rng.dirichlet(np.ones(ncols))
+        elif kind == 1:
+            xs[i] = rng.randint(0, 5, ncols)
+            halves = rng.choice(ncols, 2 * rng.randint(0, ncols // 2 + 1), replace=False)
+            xs[i, halves] += 0.5
+        elif kind == 2:
+            share = rng.choice(ncols, rng.randint(1, ncols + 1), replace=False)
+            xs[i, share] = rng.randint(1, 10) / len(share)
+        elif kind == 3:
+            xs[i] = rng.randint(0, 5, ncols)
+        elif kind == 4:
+            xs[i, rng.randint(ncols)] = rng.randint(0, 3)
+        # kind 5: all zero
+
+    xs[rng.random_sample(xs.shape) < 0.05] = np.nan
+
+    return xs
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_rounding_matches_series(seed):
+    rng = np.random.RandomState(seed)
+    xs = random_rows(rng, 20, rng.randint(1, 13))
+    filled = np.nan_to_num(xs)
+
+    ys = tax.round_array_retain_integer_sum(xs)
+
+    expected = np.array([tax.round_series_retain_integer_sum(list(row)) for row in filled]).reshape(xs.shape)
+    np.testing.assert_array_equal(ys, expected)
+    # The rows without missing values have an integer sum, it is kept
+    whole = ~np.isnan(xs).any(axis=1)
+    np.testing.assert_array_equal(ys[whole].sum(axis=1), np.round(xs[whole].sum(axis=1)))
+
+    labels = ['CR/LWAL+DUL/H:{}'.format(i + 1) for i in range(xs.shape[1])]
+    dense = pd.concat([pd.DataFrame({'cod': np.arange(len(xs))}), pd.DataFrame(xs, columns=labels)], axis=1)
+    table = tax.round_table_retain_integer_sum(tgem.TypologyTable.from_dense(dense))
+
+    np.testing.assert_array_equal(table.to_dense()[labels].to_numpy(), ys)
+    assert (table.count != 0).all()
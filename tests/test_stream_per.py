@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"""
+La lectura del archivo PER por bloques (stream_per=True) da los mismos resultados,
+con los mismos dtypes, que la lectura completa.
+"""
+
+import pandas as pd
+import pytest
+import benchmark
+import procesamiento_datos as pdat
+
+DEPTOS = [('05', 'Sintetico'), ('68', 'Sintetico')]
+
+
+@pytest.fixture(scope='module')
+def folder(tmp_path_factory):
+    path = tmp_path_factory.mktemp('cnpv')
+    for i, (dptocod, depto) in enumerate(DEPTOS):
+        benchmark.write_synthetic(str(path), dptocod, depto, n_viv=6000, n_mpios=6, seed=i)
+
+    return str(path)
+
+
+@pytest.mark.parametrize('batch', [False, True])
+@pytest.mark.parametrize('args', [(True, True), (False, True)])
+def test_stream_per_equals_read(folder, batch, args):
+    deptcod, deptname = [list(values) for values in zip(*DEPTOS)]
+    runs = [pdat.func_principal(folder, deptcod, deptname, [1, 2, 3], [1, 2], [1, 2, 3], *args, batch=batch, seed=3,
+                                stream_per=stream_per)[:3]
+            for stream_per in (False, True)]
+
+    for read, stream in zip(*runs):
+        pd.testing.assert_frame_equal(read.reset_index(drop=True), stream.reset_index(drop=True))
+
+
+def test_organize_personas_chunked(folder):
+    per = pd.concat(pdat.iter_personas(folder, *DEPTOS[0]), ignore_index=True)
+    expected = pdat.organize_personas(per, ["U_MPIO"])
+
+    chunks = pdat.iter_personas(folder, *DEPTOS[0], chunksize=1000)
+    pd.testing.assert_frame_equal(pdat.organize_personas_chunked(chunks, ["U_MPIO"]), expected)